@@ -0,0 +1,72 @@
+"""
+Benchmark of the hash algorithms available for bucket checks:
+throughput of each algorithm on one large file and on many small files,
+read from disk with the hash cache bypassed.
+
+Run with: PYTHONPATH=. python benchmarks/bench_hash_algorithms.py
+"""
+
+import os
+import tempfile
+import timeit
+from functools import partial
+from typing import Callable, List
+
+from serverctl_deployd.hashing import _hash_uncached
+from serverctl_deployd.models.config import HashAlgorithm
+
+LARGE_FILE_SIZE = 256 * 1024 * 1024
+SMALL_FILE_SIZE = 4 * 1024
+SMALL_FILE_COUNT = 5000
+REPEAT = 3
+
+
+def _write_files(directory: str) -> List[str]:
+    """Write the large file followed by the small files"""
+    paths = [os.path.join(directory, "large.bin")]
+    with open(paths[0], "wb") as large_file:
+        for _ in range(LARGE_FILE_SIZE // (1024 * 1024)):
+            large_file.write(os.urandom(1024 * 1024))
+    for index in range(SMALL_FILE_COUNT):
+        path = os.path.join(directory, f"small-{index}.conf")
+        with open(path, "wb") as small_file:
+            small_file.write(os.urandom(SMALL_FILE_SIZE))
+        paths.append(path)
+    return paths
+
+
+def _hash_all(paths: List[str], algorithm: str) -> None:
+    """Hash every file of a list"""
+    for path in paths:
+        _hash_uncached(path, algorithm)
+
+
+def _throughput(run: Callable[[], object], size: int) -> float:
+    """Return the best throughput of a run in MiB/s"""
+    seconds = min(timeit.repeat(run, number=1, repeat=REPEAT))
+    return size / seconds / (1024 * 1024)
+
+
+def main() -> None:
+    """Run the benchmark and print the throughput per algorithm"""
+    with tempfile.TemporaryDirectory() as directory:
+        paths = _write_files(directory)
+        large_path, small_paths = paths[0], paths[1:]
+        print(f"large: 1 file of {LARGE_FILE_SIZE // (1024 * 1024)} MiB, "
+              f"small: {SMALL_FILE_COUNT} files of "
+              f"{SMALL_FILE_SIZE // 1024} KiB")
+        print(f"{'algorithm':<10} {'large MiB/s':>12} {'small MiB/s':>12}")
+        for algorithm in HashAlgorithm:
+            large = _throughput(
+                partial(_hash_uncached, large_path, algorithm.value),
+                LARGE_FILE_SIZE
+            )
+            small = _throughput(
+                partial(_hash_all, small_paths, algorithm.value),
+                SMALL_FILE_SIZE * SMALL_FILE_COUNT
+            )
+            print(f"{algorithm.value:<10} {large:12.1f} {small:12.1f}")
+
+
+if __name__ == "__main__":
+    main()
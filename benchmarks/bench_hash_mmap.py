@@ -0,0 +1,105 @@
+"""
+Benchmark of the ways to feed a file to its digest, across file sizes:
+a new buffer per file, one reused buffer, and a memory mapping.
+Files are read from the page cache, as rehashed config files are.
+
+Run with: PYTHONPATH=. python benchmarks/bench_hash_mmap.py
+"""
+
+import hashlib
+import mmap
+import os
+import tempfile
+import timeit
+from functools import partial
+from typing import Callable, Dict
+
+CHUNK_SIZE = 128 * 1024
+SIZES = [4 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024,
+         16 * 1024 * 1024, 64 * 1024 * 1024, 256 * 1024 * 1024]
+# Bytes hashed per size and method, so that small sizes hash many files
+TOTAL_SIZE = 512 * 1024 * 1024
+REPEAT = 3
+
+_shared_buffer = bytearray(CHUNK_SIZE)
+
+
+def _new_buffer(file_path: str) -> str:
+    """Read into a buffer allocated for the file"""
+    file_hash = hashlib.sha256()
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as conf_file:
+        while True:
+            size = conf_file.readinto(view)
+            if not size:
+                break
+            file_hash.update(view[:size])
+    return file_hash.hexdigest()
+
+
+def _reused_buffer(file_path: str) -> str:
+    """Read into a buffer shared by all files"""
+    file_hash = hashlib.sha256()
+    view = memoryview(_shared_buffer)
+    with open(file_path, "rb", buffering=0) as conf_file:
+        while True:
+            size = conf_file.readinto(view)
+            if not size:
+                break
+            file_hash.update(view[:size])
+    return file_hash.hexdigest()
+
+
+def _mapped(file_path: str) -> str:
+    """Hash the file straight from a memory mapping"""
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb", buffering=0) as conf_file, \
+            mmap.mmap(conf_file.fileno(), 0,
+                      access=mmap.ACCESS_READ) as mapping:
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapping) as view:
+            file_hash.update(view)
+    return file_hash.hexdigest()
+
+
+def _hash_repeatedly(method: Callable[[str], str], file_path: str,
+                     count: int) -> None:
+    """Hash a file count times"""
+    for _ in range(count):
+        method(file_path)
+
+
+METHODS: Dict[str, Callable[[str], str]] = {
+    "new buffer": _new_buffer,
+    "reused buffer": _reused_buffer,
+    "mmap": _mapped,
+}
+
+
+def main() -> None:
+    """Run the benchmark and print the throughput per size and method"""
+    print(f"{'size':>10} " + " ".join(f"{name:>14}" for name in METHODS)
+          + "   (MiB/s)")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in SIZES:
+            file_path = os.path.join(directory, f"{size}.bin")
+            with open(file_path, "wb") as conf_file:
+                for _ in range(0, size, 1024 * 1024):
+                    conf_file.write(os.urandom(min(size, 1024 * 1024)))
+            count = max(TOTAL_SIZE // size, 1)
+            results = []
+            for method in METHODS.values():
+                assert method(file_path) == _new_buffer(file_path)
+                seconds = min(timeit.repeat(
+                    partial(_hash_repeatedly, method, file_path, count),
+                    number=1, repeat=REPEAT
+                ))
+                results.append(size * count / seconds / (1024 * 1024))
+            print(f"{size // 1024:>8}Ki "
+                  + " ".join(f"{result:14.1f}" for result in results))
+            os.remove(file_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of ignore pattern matching:
+fnmatch on every file and pattern against the compiled matcher.
+
+Run with: PYTHONPATH=. python benchmarks/bench_ignore_patterns.py
+"""
+
+import random
+import string
+import timeit
+from fnmatch import fnmatch
+from typing import List, Set
+
+from serverctl_deployd.patterns import ignore_matcher
+
+FILE_COUNT = 20000
+REPEAT = 5
+
+
+def _make_patterns() -> Set[str]:
+    """Build a realistic mix of ignore patterns"""
+    patterns = {f"*.{extension}" for extension in (
+        "swp", "swo", "bak", "tmp", "orig", "rej", "old", "dpkg-dist",
+        "dpkg-old", "pyc", "log", "pid", "lock", "sock", "cache", "part"
+    )}
+    patterns.update({".git", ".svn", "node_modules", "__pycache__",
+                     ".DS_Store", "Thumbs.db", "lost+found"})
+    patterns.update({"backup-*", "tmp*", "~*", ".#*"})
+    patterns.update({"*.bak[0-9]", "core.[0-9]*", "*.conf.[0-9]*",
+                     "?.swp", "*~"})
+    return patterns
+
+
+def _make_names() -> List[str]:
+    """Build file names of which roughly a tenth is ignored"""
+    random.seed(0)
+    extensions = ["conf"] * 8 + ["swp", "bak"]
+    return [
+        "".join(random.choices(string.ascii_lowercase, k=10))
+        + "." + random.choice(extensions)
+        for _ in range(FILE_COUNT)
+    ]
+
+
+def main() -> None:
+    """Run the benchmark and print the timings"""
+    patterns = _make_patterns()
+    names = _make_names()
+
+    def with_fnmatch() -> int:
+        return sum(
+            1 for name in names
+            if any(fnmatch(name, pattern) for pattern in patterns)
+        )
+
+    def with_matcher() -> int:
+        is_ignored = ignore_matcher(patterns)
+        return sum(1 for name in names if is_ignored(name))
+
+    assert with_fnmatch() == with_matcher()
+    fnmatch_time = min(timeit.repeat(with_fnmatch, number=1, repeat=REPEAT))
+    matcher_time = min(timeit.repeat(with_matcher, number=1, repeat=REPEAT))
+    print(f"{FILE_COUNT} files, {len(patterns)} patterns")
+    print(f"fnmatch:  {fnmatch_time * 1000:8.2f} ms")
+    print(f"compiled: {matcher_time * 1000:8.2f} ms")
+    print(f"speedup:  {fnmatch_time / matcher_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
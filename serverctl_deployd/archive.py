@@ -0,0 +1,360 @@
+"""
+Streaming tar archives for config bucket backups
+"""
+
+import gzip
+import io
+import json
+import logging
+import os
+import tarfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import DirEntry, fstat
+from pathlib import PurePosixPath
+from stat import S_IMODE
+from typing import (IO, AsyncIterator, Deque, Iterable, Iterator, List,
+                    Optional, Tuple, cast)
+
+import anyio.from_thread
+
+from serverctl_deployd.dependencies import get_settings
+from serverctl_deployd.hashing import hash_file
+from serverctl_deployd.models.config import ArchiveRestore, Compression
+from serverctl_deployd.staging import (StagedFile, cleanup, stage_chunks,
+                                       stage_deletion)
+
+CHUNK_SIZE = 128 * 1024
+# Name of the member listing the files deleted since the manifest
+# a differential backup was taken against
+TOMBSTONE_MEMBER = ".serverctl-deleted.json"
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class InvalidArchive(Exception):
+    """The archive can not be restored"""
+
+
+def _padding(size: int, block_size: int) -> bytes:
+    """Return the NUL padding needed to fill the last block"""
+    remainder = size % block_size
+    return tarfile.NUL * (block_size - remainder) if remainder else b""
+
+
+def _file_member(name: str, entry: DirEntry[str]) -> Iterator[bytes]:
+    """
+    Yield the header and the data blocks of a file as tar bytes,
+    reading the file in chunks
+    """
+    try:
+        conf_file = open(  # pylint: disable=consider-using-with
+            entry.path, 'rb', buffering=0
+        )
+    except FileNotFoundError:
+        logging.warning("%s was removed before it could be archived",
+                        entry.path)
+        return
+    with conf_file:
+        file_stat = fstat(conf_file.fileno())
+        tar_info = tarfile.TarInfo(name)
+        tar_info.size = file_stat.st_size
+        tar_info.mtime = int(file_stat.st_mtime)
+        tar_info.mode = S_IMODE(file_stat.st_mode)
+        tar_info.uid = file_stat.st_uid
+        tar_info.gid = file_stat.st_gid
+        yield tar_info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING,
+                             "surrogateescape")
+
+        remaining = tar_info.size
+        while remaining > 0:
+            chunk = conf_file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                # The header already promised tar_info.size bytes
+                logging.warning("%s was truncated while being archived",
+                                entry.path)
+                chunk = tarfile.NUL * min(CHUNK_SIZE, remaining)
+            remaining -= len(chunk)
+            yield chunk
+        yield _padding(tar_info.size, tarfile.BLOCKSIZE)
+
+
+def _bytes_member(name: str, data: bytes) -> bytes:
+    """Return an in-memory file as tar bytes"""
+    tar_info = tarfile.TarInfo(name)
+    tar_info.size = len(data)
+    tar_info.mtime = int(time.time())
+    return tar_info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING,
+                          "surrogateescape") \
+        + data + _padding(len(data), tarfile.BLOCKSIZE)
+
+
+def tar_stream(
+    members: Iterable[Tuple[str, DirEntry[str]]],
+    tombstones: Optional[List[str]] = None
+) -> Iterator[bytes]:
+    """
+    Yield an uncompressed tar archive of (arcname, entry) pairs
+    without holding more than one chunk of a file in memory.
+    If tombstones are given, they are stored first as a JSON list
+    in the TOMBSTONE_MEMBER file.
+    """
+    size = 0
+    if tombstones is not None:
+        tombstone_block = _bytes_member(
+            TOMBSTONE_MEMBER, json.dumps(tombstones).encode()
+        )
+        size += len(tombstone_block)
+        yield tombstone_block
+    for name, entry in members:
+        for block in _file_member(name, entry):
+            size += len(block)
+            yield block
+    end_of_archive = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    size += len(end_of_archive)
+    yield end_of_archive + _padding(size, tarfile.RECORDSIZE)
+
+
+def gzip_stream(chunks: Iterable[bytes],
+                level: int = zlib.Z_DEFAULT_COMPRESSION) -> Iterator[bytes]:
+    """Compress a stream of bytes into a gzip stream"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+# zlib releases the GIL while compressing, so the blocks of pgzip
+# backups are compressed in parallel on this pool
+compression_pool = ThreadPoolExecutor(
+    max_workers=get_settings().compression_workers,
+    thread_name_prefix="compress"
+)
+
+
+def _gzip_member(block: bytes, level: int) -> bytes:
+    """Compress a block of data into a complete gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _blocks(chunks: Iterable[bytes], block_size: int) -> Iterator[bytes]:
+    """Regroup a stream of bytes into blocks of block_size bytes"""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= block_size:
+            yield bytes(buffer[:block_size])
+            del buffer[:block_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def parallel_gzip_stream(chunks: Iterable[bytes],
+                         level: int = zlib.Z_DEFAULT_COMPRESSION,
+                         block_size: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Compress a stream of bytes into a multi-member gzip stream,
+    compressing blocks of the stream independently on the compression
+    pool. Gzip readers decompress the concatenated members as a single
+    stream. At most two blocks per worker are held in memory.
+    """
+    settings = get_settings()
+    block_size = block_size or settings.compression_block_size
+    max_in_flight = 2 * settings.compression_workers
+    in_flight: Deque[Future[bytes]] = deque()
+    is_empty = True
+    try:
+        for block in _blocks(chunks, block_size):
+            is_empty = False
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+            in_flight.append(
+                compression_pool.submit(_gzip_member, block, level)
+            )
+        while in_flight:
+            yield in_flight.popleft().result()
+        if is_empty:
+            yield _gzip_member(b"", level)
+    finally:
+        # Blocks of an abandoned stream are not compressed
+        for future in in_flight:
+            future.cancel()
+
+
+def compress_stream(chunks: Iterable[bytes], compression: Compression,
+                    level: int = zlib.Z_DEFAULT_COMPRESSION
+                    ) -> Iterable[bytes]:
+    """Compress a stream of bytes with the requested compression"""
+    if compression == Compression.GZIP:
+        return gzip_stream(chunks, level)
+    if compression == Compression.PGZIP:
+        return parallel_gzip_stream(chunks, level)
+    return chunks
+
+
+class AsyncStreamReader(io.RawIOBase):
+    """
+    Read-only file object over an async stream of bytes, such as the
+    body of a request, for use from a worker thread. Each chunk is
+    awaited on the event loop when the reader needs it, so the stream
+    is consumed as it is read instead of being buffered first.
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes]) -> None:
+        super().__init__()
+        self._chunks = chunks
+        self._chunk = b""
+
+    async def _next_chunk(self) -> bytes:
+        """Await the next chunk of the stream"""
+        # anext() is only a builtin from Python 3.10
+        return await self._chunks.__anext__()  # pylint: disable=C2801
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: memoryview) -> int:  # type: ignore[override]
+        while not self._chunk:
+            try:
+                self._chunk = anyio.from_thread.run(self._next_chunk)
+            except StopAsyncIteration:
+                return 0
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def _is_in_bucket(directory_path: str, path: str) -> bool:
+    """Return whether a path resolves to a location inside the bucket"""
+    bucket = os.path.realpath(directory_path)
+    return os.path.commonpath([bucket, os.path.realpath(path)]) == bucket
+
+
+def _member_target(directory_path: str, name: str) -> str:
+    """
+    Return the path a member of an archive is restored to, refusing
+    names which would lead out of the bucket, through .. or through
+    a symbolic link to a directory outside of it, names of directories
+    of the bucket, which are neither replaced nor deleted, and names
+    below a file of the bucket
+    """
+    member_path = PurePosixPath(name)
+    if not member_path.parts or member_path.is_absolute() \
+            or ".." in member_path.parts:
+        raise InvalidArchive(f"Unsafe member name {name}")
+    target = os.path.join(directory_path, *member_path.parts)
+    if not _is_in_bucket(directory_path, os.path.dirname(target)):
+        raise InvalidArchive(f"Unsafe member name {name}")
+    for depth in range(1, len(member_path.parts)):
+        ancestor = os.path.join(directory_path, *member_path.parts[:depth])
+        if not os.path.lexists(ancestor):
+            break
+        if not os.path.isdir(ancestor):
+            raise InvalidArchive(
+                f"Member {name} is below a file of the bucket"
+            )
+    if os.path.isdir(target):
+        raise InvalidArchive(f"Member {name} is a directory in the bucket")
+    return target
+
+
+def _member_chunks(member_file: IO[bytes]) -> Iterator[bytes]:
+    """Yield the data of an archive member in chunks"""
+    return iter(lambda: member_file.read(CHUNK_SIZE), b"")
+
+
+def _is_unchanged(staged_file: StagedFile) -> bool:
+    """Return whether a staged file has the content of its target"""
+    try:
+        return os.path.isfile(staged_file.target) \
+            and os.path.getsize(staged_file.target) \
+            == os.path.getsize(str(staged_file.staged)) \
+            and hash_file(staged_file.target) == staged_file.digest
+    except FileNotFoundError:
+        return False
+
+
+def _stage_members(archive: tarfile.TarFile, directory_path: str,
+                   skip_unchanged: bool, staged_files: List[StagedFile],
+                   restore: ArchiveRestore) -> None:
+    """Stage the members of an archive, one at a time"""
+    for member in archive:
+        if member.isdir():
+            continue
+        if not member.isreg():
+            raise InvalidArchive(
+                f"Member {member.name} is not a regular file"
+            )
+        member_file = archive.extractfile(member)
+        assert member_file is not None
+        if member.name == TOMBSTONE_MEMBER:
+            tombstones = json.load(member_file)
+            if not isinstance(tombstones, list) \
+                    or not all(isinstance(name, str) for name in tombstones):
+                raise InvalidArchive("Invalid list of deleted files")
+            for name in tombstones:
+                target = _member_target(directory_path, name)
+                if os.path.lexists(target):
+                    staged_files.append(stage_deletion(target))
+                    restore.deleted.append(name)
+            continue
+        target = _member_target(directory_path, member.name)
+        # The file a symbolic link points to is replaced, not the link
+        if not _is_in_bucket(directory_path, target):
+            raise InvalidArchive(f"Unsafe member name {member.name}")
+        staged_file = stage_chunks(_member_chunks(member_file), target)
+        if skip_unchanged and _is_unchanged(staged_file):
+            os.unlink(str(staged_file.staged))
+            restore.unchanged.append(member.name)
+            continue
+        staged_files.append(staged_file)
+        os.chmod(str(staged_file.staged), S_IMODE(member.mode) & 0o777)
+        restore.restored.append(member.name)
+
+
+def stage_archive(
+    archive_file: io.RawIOBase,
+    directory_path: str,
+    skip_unchanged: bool = True
+) -> Tuple[List[StagedFile], ArchiveRestore]:
+    """
+    Read a backup archive as a stream and stage each of its files in
+    a temporary file next to its target, to be committed together.
+    Gzip and multi-member (pgzip) archives are decompressed on the fly,
+    and the files deleted since a differential backup are staged for
+    deletion. With skip_unchanged, files whose content matches the
+    file on disk are not staged. Raises InvalidArchive for malformed
+    archives and for members which are not regular files, would be
+    written outside of the bucket or conflict with its files, after
+    removing what was staged.
+    """
+    reader = io.BufferedReader(archive_file, CHUNK_SIZE)
+    stream: IO[bytes] = reader
+    if reader.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        stream = cast(IO[bytes], gzip.GzipFile(fileobj=reader, mode="rb"))
+    staged_files: List[StagedFile] = []
+    restore = ArchiveRestore(restored=[], unchanged=[], deleted=[])
+    try:
+        with tarfile.open(fileobj=stream, mode="r|") as archive:
+            _stage_members(archive, directory_path, skip_unchanged,
+                           staged_files, restore)
+    except (tarfile.TarError, EOFError, zlib.error, gzip.BadGzipFile,
+            ValueError) as archive_error:
+        cleanup(staged_files)
+        raise InvalidArchive("Invalid archive") from archive_error
+    except (FileExistsError, NotADirectoryError) as path_error:
+        # A file of the bucket was created where a directory is needed
+        # after the names were checked
+        cleanup(staged_files)
+        raise InvalidArchive(
+            "Members conflict with the files of the bucket"
+        ) from path_error
+    except BaseException:
+        cleanup(staged_files)
+        raise
+    return staged_files, restore
@@ -0,0 +1,126 @@
+"""
+Helpers shared by the routers of config buckets
+"""
+
+import logging
+from os import DirEntry, scandir
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from fastapi import status
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import HTTPException
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from serverctl_deployd.hashing import hash_entries
+from serverctl_deployd.jobs import reload_coalescer
+from serverctl_deployd.models.config import HashAlgorithm
+from serverctl_deployd.patterns import ignore_matcher
+from serverctl_deployd.staging import StagedFile, commit, rollback
+from serverctl_deployd.watcher import bucket_watcher
+
+
+def list_files(path: Path,
+                patterns: Optional[Set[str]],
+                recursive: bool = False) -> Dict[str, DirEntry[str]]:
+    """
+    Get DirEntry objects of the files in a path keyed by their path
+    relative to it, to be used by other functions.
+    In recursive mode subdirectories are walked as well, except for
+    those matching the glob patterns, which are never scanned.
+    """
+    is_ignored = ignore_matcher(patterns)
+    file_list: Dict[str, DirEntry[str]] = {}
+    directories: List[Tuple[str, str]] = [("", str(path))]
+    while directories:
+        prefix, directory = directories.pop()
+        with scandir(directory) as listing:
+            for entry in listing:
+                relative_path = prefix + entry.name
+                if is_ignored(relative_path):
+                    continue
+                if entry.is_file():
+                    file_list[relative_path] = entry
+                # Symlinked directories are not followed to avoid loops
+                elif recursive and entry.is_dir(follow_symlinks=False):
+                    directories.append((relative_path + "/", entry.path))
+    return file_list
+
+
+def get_bucket_hashes(path: Path,
+                      patterns: Optional[Set[str]],
+                      recursive: bool = False,
+                      algorithm: HashAlgorithm = HashAlgorithm.SHA256
+                      ) -> Dict[str, str]:
+    """
+    Get hashes of files in a directory whose file names do not
+    match the glob patterns. Watched buckets are answered
+    from the live index of the bucket watcher, which holds
+    sha256 checksums.
+    """
+    if not recursive and algorithm == HashAlgorithm.SHA256:
+        watched_hashes = bucket_watcher.get_hashes(str(path))
+        if watched_hashes is not None:
+            is_ignored = ignore_matcher(patterns)
+            return {
+                name: file_hash
+                for name, file_hash in watched_hashes.items()
+                if not is_ignored(name)
+            }
+    return hash_entries(list_files(path, patterns, recursive),
+                        algorithm.value)
+
+
+async def run_update_command(
+    update_command: str,
+    directory: str,
+    background: bool
+) -> Optional[JSONResponse]:
+    """
+    Run the update command of a bucket on the job runner. Updates made
+    to the same directory within the debounce window share one run.
+    In background mode a 202 response with the job status is returned
+    right away, otherwise the command is waited for and an error is
+    raised if it did not succeed.
+    """
+    job = reload_coalescer.submit(update_command, directory)
+    if background:
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED,
+            content=jsonable_encoder(job.to_model())
+        )
+    await job.wait()
+    if not job.succeeded:
+        logging.error("Update command %s %s with exit code %s: %s",
+                      update_command, job.status.value, job.exit_code,
+                      job.stderr)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Internal server error"
+        )
+    return None
+
+
+async def commit_and_update(staged_files: List[StagedFile], directory: str,
+                            update_command: Optional[str]) -> None:
+    """
+    Rename the staged files of a bucket into place together, then run
+    its update command once. If the command fails, the files are put
+    back as they were. The staged files are left for the caller to
+    clean up.
+    """
+    try:
+        await run_in_threadpool(commit, staged_files)
+    except OSError as os_error:
+        logging.exception("Error updating files in %s", directory)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Internal server error"
+        ) from os_error
+    if update_command:
+        try:
+            await run_update_command(update_command, directory, False)
+        except HTTPException:
+            await run_in_threadpool(rollback, staged_files)
+            raise
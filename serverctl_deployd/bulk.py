@@ -0,0 +1,182 @@
+"""
+Scheduling of docker-compose operations over many deployments
+"""
+
+import asyncio
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+from uuid import uuid4
+
+from serverctl_deployd.dependencies import get_settings
+from serverctl_deployd.jobs import CommandJob, JobRunner, compose_runner
+from serverctl_deployd.models.deployments import (BulkItemResult, BulkResult,
+                                                  ComposeAction)
+
+
+class DependencyCycle(Exception):
+    """The dependencies between deployments can not be ordered"""
+
+
+def prerequisites(names: List[str], dependencies: Dict[str, List[str]],
+                  reverse: bool = False) -> Dict[str, Set[str]]:
+    """
+    Return the deployments of an operation each deployment waits for:
+    its dependencies, or with reverse the deployments depending on it.
+    Dependencies outside of the operation are left out.
+    Raises DependencyCycle if the dependencies form a cycle.
+    """
+    selected = set(names)
+    waits: Dict[str, Set[str]] = {name: set() for name in names}
+    for name in names:
+        for dependency in dependencies.get(name, []):
+            if dependency not in selected:
+                continue
+            if reverse:
+                waits[dependency].add(name)
+            else:
+                waits[name].add(dependency)
+
+    # Kahn's algorithm: every deployment is reached unless in a cycle
+    remaining = {name: len(waited) for name, waited in waits.items()}
+    unblocks: Dict[str, List[str]] = {name: [] for name in names}
+    for name, waited in waits.items():
+        for other in waited:
+            unblocks[other].append(name)
+    ready = [name for name, count in remaining.items() if not count]
+    reached = 0
+    while ready:
+        reached += 1
+        for name in unblocks[ready.pop()]:
+            remaining[name] -= 1
+            if not remaining[name]:
+                ready.append(name)
+    if reached != len(waits):
+        cycle = sorted(name for name, count in remaining.items() if count)
+        raise DependencyCycle(
+            f"Dependency cycle between deployments {', '.join(cycle)}"
+        )
+    return waits
+
+
+class BulkRun:  # pylint: disable=too-many-instance-attributes
+    """
+    A docker-compose operation over several deployments. Each deployment
+    is submitted to the job runner as soon as the deployments it waits
+    for have succeeded, so independent deployments run as fast as the
+    pool of the runner allows. A deployment is skipped if the operation
+    failed on one it waits for.
+    """
+
+    def __init__(self, runner: JobRunner, action: ComposeAction,
+                 commands: Dict[str, str], keys: Dict[str, str],
+                 waits: Dict[str, Set[str]]) -> None:
+        self.id = uuid4().hex
+        self.action = action
+        self.runner = runner
+        self._commands = commands
+        self._keys = keys
+        self._waits = waits
+        self._jobs: Dict[str, CommandJob] = {}
+        self._skipped: Set[str] = set()
+        self._tasks: Dict[str, "asyncio.Task[None]"] = {}
+
+    def start(self) -> None:
+        """Start scheduling the deployments in the background"""
+        loop = asyncio.get_running_loop()
+        for name in self._commands:
+            self._tasks[name] = loop.create_task(self._run(name))
+
+    async def _run(self, name: str) -> None:
+        """Run the operation on a deployment once it can start"""
+        waited = self._waits.get(name, set())
+        if waited:
+            # asyncio.wait does not cancel the tasks waited for
+            await asyncio.wait([self._tasks[other] for other in waited])
+        if not all(other in self._jobs and self._jobs[other].succeeded
+                   for other in waited):
+            self._skipped.add(name)
+            return
+        job = self.runner.submit(self._commands[name], key=self._keys[name])
+        self._jobs[name] = job
+        await job.wait()
+
+    @property
+    def done(self) -> bool:
+        """Check if the operation finished on every deployment"""
+        return all(task.done() for task in self._tasks.values())
+
+    async def wait(self, timeout: Optional[float] = None) -> None:
+        """Wait for the operation to finish, at most timeout seconds"""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks.values()), timeout=timeout)
+
+    def _result(self, name: str) -> BulkItemResult:
+        """Return the result of the operation on a deployment"""
+        job = self._jobs.get(name)
+        if job is None:
+            return BulkItemResult(
+                name=name,
+                status=None,
+                skipped=name in self._skipped,
+                job_id=None,
+                exit_code=None,
+                duration=None
+            )
+        return BulkItemResult(
+            name=name,
+            status=job.status,
+            skipped=False,
+            job_id=job.id,
+            exit_code=job.exit_code,
+            duration=job.duration
+        )
+
+    def to_model(self) -> BulkResult:
+        """Return the status of the operation"""
+        return BulkResult(
+            id=self.id,
+            action=self.action,
+            done=self.done,
+            results=[self._result(name) for name in self._commands]
+        )
+
+
+class BulkScheduler:
+    """
+    Starts bulk operations on a job runner, and keeps them for status
+    queries up to a bounded history
+    """
+
+    def __init__(self, runner: JobRunner, max_runs: int) -> None:
+        self.runner = runner
+        self.max_runs = max_runs
+        self._runs: OrderedDict[str, BulkRun] = OrderedDict()
+
+    def submit(self, action: ComposeAction, commands: Dict[str, str],
+               keys: Dict[str, str], waits: Dict[str, Set[str]]) -> BulkRun:
+        """
+        Start running the commands of the deployments, each after the
+        deployments it waits for, and return the operation
+        """
+        run = BulkRun(self.runner, action, commands, keys, waits)
+        run.start()
+        self._runs[run.id] = run
+        self._evict()
+        return run
+
+    def get(self, run_id: str) -> Optional[BulkRun]:
+        """Return a bulk operation by its ID"""
+        return self._runs.get(run_id)
+
+    def _evict(self) -> None:
+        """Forget the oldest finished operations beyond the history limit"""
+        excess = len(self._runs) - self.max_runs
+        for run_id in list(self._runs):
+            if excess <= 0:
+                break
+            if self._runs[run_id].done:
+                del self._runs[run_id]
+                excess -= 1
+
+
+bulk_scheduler = BulkScheduler(compose_runner, get_settings().job_history)
@@ -0,0 +1,80 @@
+"""
+Helpers for conditional and range requests on config files
+"""
+
+import re
+from typing import Iterator, Optional, Tuple
+
+CHUNK_SIZE = 128 * 1024
+
+_RANGE_HEADER = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class RangeNotSatisfiable(Exception):
+    """The requested byte range lies outside of the file"""
+
+
+def etag(file_hash: str) -> str:
+    """Return the strong entity tag of a file from its sha256 digest"""
+    return f'"{file_hash}"'
+
+
+def etag_matches(header: str, file_hash: str, weak: bool = False) -> bool:
+    """
+    Check if an If-Match or If-None-Match header matches the entity
+    tag of a file. Weak tags never match in the strong comparison
+    required by If-Match. With weak, as for If-None-Match, they are
+    compared by their opaque value.
+    """
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag(file_hash):
+            return True
+    return False
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a Range header into the inclusive (first, last) byte positions
+    of a file of the given size. Returns None for headers which are not
+    understood, including multiple ranges, so that the full file is sent.
+    Raises RangeNotSatisfiable if the range does not overlap the file.
+    """
+    match = _RANGE_HEADER.fullmatch(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # Suffix range of the last bytes of the file
+        suffix_length = int(last)
+        if suffix_length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - suffix_length, 0), size - 1
+    first_position = int(first)
+    if last and int(last) < first_position:
+        return None
+    if first_position >= size:
+        raise RangeNotSatisfiable()
+    last_position = min(int(last), size - 1) if last else size - 1
+    return first_position, last_position
+
+
+def file_range(file_path: str, first: int, last: int) -> Iterator[bytes]:
+    """Yield the bytes of a file between two inclusive positions"""
+    with open(file_path, "rb") as conf_file:
+        conf_file.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = conf_file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
@@ -19,6 +19,30 @@ class Settings(BaseSettings):  # pylint: disable=too-few-public-methods
     log_level: str = os.getenv("LOGLEVEL", "WARNING").upper()
     deployments_dir: Path = Path(os.getenv("DEPLOYMENTS_DIR",
                                            ".serverctl/"))
+    snapshots_dir: Path = Path(os.getenv("SNAPSHOTS_DIR",
+                                         ".serverctl-snapshots/"))
+    hash_cache_size: int = int(os.getenv("HASH_CACHE_SIZE", "65536"))
+    hash_workers: int = int(os.getenv("HASH_WORKERS",
+                                      str(os.cpu_count() or 1)))
+    hash_mmap_threshold: int = int(os.getenv("HASH_MMAP_THRESHOLD", "0"))
+    batch_check_workers: int = int(os.getenv("BATCH_CHECK_WORKERS", "8"))
+    command_workers: int = int(os.getenv("COMMAND_WORKERS", "4"))
+    command_timeout: float = float(os.getenv("COMMAND_TIMEOUT", "300"))
+    command_output_limit: int = int(os.getenv("COMMAND_OUTPUT_LIMIT",
+                                              "65536"))
+    reload_debounce: float = float(os.getenv("RELOAD_DEBOUNCE", "0"))
+    job_history: int = int(os.getenv("JOB_HISTORY", "1000"))
+    job_stream_buffer: int = int(os.getenv("JOB_STREAM_BUFFER", "1000"))
+    compose_command: str = os.getenv("COMPOSE_COMMAND", "docker-compose")
+    compose_workers: int = int(os.getenv("COMPOSE_WORKERS", "2"))
+    compose_timeout: float = float(os.getenv("COMPOSE_TIMEOUT", "1800"))
+    watch_buckets: bool = os.getenv("WATCH_BUCKETS", "false").lower() \
+        in ("1", "true", "yes")
+    watch_debounce: float = float(os.getenv("WATCH_DEBOUNCE", "0.2"))
+    compression_workers: int = int(os.getenv("COMPRESSION_WORKERS",
+                                             str(os.cpu_count() or 1)))
+    compression_block_size: int = int(os.getenv("COMPRESSION_BLOCK_SIZE",
+                                                str(1024 * 1024)))
 
 
 settings = Settings()
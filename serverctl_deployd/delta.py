@@ -0,0 +1,114 @@
+"""
+rsync style block signatures and deltas of config files
+"""
+
+import base64
+import binascii
+import math
+import os
+import zlib
+from hashlib import sha256
+from typing import Iterator, List, Optional
+
+from serverctl_deployd.hashing import cache_hash
+from serverctl_deployd.models.config import (BlockSignature, FileDelta,
+                                             FileSignature)
+from serverctl_deployd.staging import StagedFile, stage_chunks
+
+CHUNK_SIZE = 128 * 1024
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+
+
+class InvalidDelta(Exception):
+    """The delta can not be applied to the file"""
+
+
+def default_block_size(file_size: int) -> int:
+    """
+    Return a block size close to the square root of the file size,
+    which balances the size of the signature against the amount of
+    data resent around each change
+    """
+    block_size = math.isqrt(file_size) // 1024 * 1024
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def file_signature(file_path: str,
+                   block_size: Optional[int] = None) -> FileSignature:
+    """
+    Return the checksums of the blocks of a file. The weak checksums
+    are Adler-32, which clients can roll over their copy of the file
+    one byte at a time to find the blocks that did not change.
+    """
+    blocks: List[BlockSignature] = []
+    file_hash = sha256()
+    with open(file_path, 'rb') as conf_file:
+        file_stat = os.fstat(conf_file.fileno())
+        block_size = block_size or default_block_size(file_stat.st_size)
+        for block in iter(lambda: conf_file.read(block_size), b""):
+            file_hash.update(block)
+            blocks.append(BlockSignature(
+                weak=zlib.adler32(block),
+                strong=sha256(block).hexdigest()
+            ))
+        end_stat = os.fstat(conf_file.fileno())
+        # Only cache the digest if the file did not change while
+        # it was being read
+        unchanged = (end_stat.st_size, end_stat.st_mtime_ns) \
+            == (file_stat.st_size, file_stat.st_mtime_ns)
+    if unchanged:
+        cache_hash(file_path, file_hash.hexdigest())
+    return FileSignature(
+        file_hash=file_hash.hexdigest(),
+        file_size=file_stat.st_size,
+        block_size=block_size,
+        blocks=blocks
+    )
+
+
+def _delta_chunks(file_path: str, delta: FileDelta) -> Iterator[bytes]:
+    """Yield the content of the file rebuilt from a delta"""
+    with open(file_path, 'rb') as base_file:
+        file_size = os.fstat(base_file.fileno()).st_size
+        block_count = -(-file_size // delta.block_size)
+        for instruction in delta.instructions:
+            if (instruction.data is None) == (instruction.copy_block is None):
+                raise InvalidDelta(
+                    "Instructions must either copy blocks or insert data"
+                )
+            if instruction.data is not None:
+                try:
+                    yield base64.b64decode(instruction.data, validate=True)
+                except binascii.Error as decode_error:
+                    raise InvalidDelta("Invalid base64 data") \
+                        from decode_error
+                continue
+            assert instruction.copy_block is not None
+            if instruction.copy_block < 0 or instruction.block_count < 1 \
+                    or instruction.copy_block + instruction.block_count \
+                    > block_count:
+                raise InvalidDelta("Copied blocks are out of the file")
+            base_file.seek(instruction.copy_block * delta.block_size)
+            remaining = instruction.block_count * delta.block_size
+            while remaining > 0:
+                chunk = base_file.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+def apply_delta(file_path: str, delta: FileDelta) -> StagedFile:
+    """
+    Rebuild a file from a delta into a temporary file next to it,
+    to be committed over the file. Raises InvalidDelta if the delta
+    does not apply or does not produce the expected file.
+    """
+    staged_file = stage_chunks(_delta_chunks(file_path, delta), file_path)
+    if delta.result_hash is not None \
+            and staged_file.digest != delta.result_hash:
+        if staged_file.staged is not None:
+            os.unlink(staged_file.staged)
+        raise InvalidDelta("Delta does not produce the expected file")
+    return staged_file
@@ -4,11 +4,15 @@ Miscellaneous dependencies for the API.
 
 
 from functools import lru_cache
+from pathlib import Path
 
 import docker
 from docker.client import DockerClient
+from fastapi import Depends
 
 from serverctl_deployd.config import Settings
+from serverctl_deployd.registry import DeploymentRegistry
+from serverctl_deployd.store import DeploymentStore
 
 
 async def check_authentication() -> None:
@@ -32,3 +36,29 @@ def get_settings() -> Settings:
     This is only there so that it can be overridden for tests.
     """
     return Settings()
+
+
+@lru_cache()
+def _deployment_store(deployments_dir: Path) -> DeploymentStore:
+    """Return the deployment store of a deployments directory"""
+    return DeploymentStore(deployments_dir)
+
+
+def get_deployment_store(
+    settings: Settings = Depends(get_settings)
+) -> DeploymentStore:
+    """Return the deployment store to be used as a dependency"""
+    return _deployment_store(settings.deployments_dir)
+
+
+@lru_cache()
+def _deployment_registry(deployments_dir: Path) -> DeploymentRegistry:
+    """Return the deployment registry of a deployments directory"""
+    return DeploymentRegistry(_deployment_store(deployments_dir))
+
+
+def get_deployment_registry(
+    settings: Settings = Depends(get_settings)
+) -> DeploymentRegistry:
+    """Return the deployment registry to be used as a dependency"""
+    return _deployment_registry(settings.deployments_dir)
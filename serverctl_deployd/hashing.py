@@ -0,0 +1,257 @@
+"""
+Hashing helpers for config buckets
+"""
+
+import hashlib
+import mmap
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import DirEntry, fstat, stat, stat_result
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from serverctl_deployd.dependencies import get_settings
+from serverctl_deployd.models.config import HashCacheStats
+
+# Algorithm used when none is requested, and by the Merkle digests
+# and ETags unless told otherwise
+DEFAULT_ALGORITHM = "sha256"
+
+StatKey = Tuple[str, int, int, int, int]
+
+
+def _stat_key(file_stat: stat_result, algorithm: str) -> StatKey:
+    """Build the cache key of a file digest from its stat result"""
+    return (
+        algorithm,
+        file_stat.st_dev,
+        file_stat.st_ino,
+        file_stat.st_size,
+        file_stat.st_mtime_ns
+    )
+
+
+class HashCache:
+    """
+    Bounded LRU cache of file digests keyed on the hash algorithm
+    and the (device, inode, size, mtime_ns) of the file
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[StatKey, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: StatKey) -> Optional[str]:
+        """Return the cached digest for a key, if any"""
+        with self._lock:
+            digest = self._entries.get(key)
+            if digest is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return digest
+
+    def put(self, key: StatKey, digest: str) -> None:
+        """Store a digest, evicting the least recently used entries"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = digest
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop all entries and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> HashCacheStats:
+        """Return the counters of the cache"""
+        with self._lock:
+            return HashCacheStats(
+                hits=self.hits,
+                misses=self.misses,
+                entries=len(self._entries),
+                max_entries=self.max_entries
+            )
+
+
+hash_cache = HashCache(get_settings().hash_cache_size)
+
+# hashlib releases the GIL while digesting, so files hashed on this
+# pool are processed in parallel. The pool is shared by all requests
+# to bound the number of hashing threads on the host.
+hash_pool = ThreadPoolExecutor(
+    max_workers=get_settings().hash_workers,
+    thread_name_prefix="hash"
+)
+
+
+_thread_buffers = threading.local()
+
+
+def _read_buffer() -> memoryview:
+    """Return the read buffer of the current thread"""
+    buffer: Optional[memoryview] = getattr(_thread_buffers, "buffer", None)
+    if buffer is None:
+        buffer = memoryview(bytearray(128 * 1024))
+        _thread_buffers.buffer = buffer
+    return buffer
+
+
+def _mapped_digest(conf_file: BinaryIO, algorithm: str) -> Optional[str]:
+    """
+    Return the hex digest of an open file fed straight from a memory
+    mapping of it, or None if the file can not be mapped
+    """
+    try:
+        mapping = mmap.mmap(conf_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    with mapping:
+        if hasattr(mapping, "madvise"):
+            mapping.madvise(mmap.MADV_SEQUENTIAL)
+        file_hash = hashlib.new(algorithm)
+        with memoryview(mapping) as memory_view:
+            file_hash.update(memory_view)
+    return file_hash.hexdigest()
+
+
+def _read_digest(conf_file: BinaryIO, algorithm: str, size: int) -> str:
+    """
+    Read an open file to the end and return its hex digest, into a
+    buffer reused by the thread. Memory mapping is opt-in: if
+    HASH_MMAP_THRESHOLD is set, files of at least that many bytes are
+    hashed from a mapping, which saves copying them from the page cache
+    but kills the process with SIGBUS if the file is truncated meanwhile.
+    """
+    mmap_threshold = get_settings().hash_mmap_threshold
+    if 0 < mmap_threshold <= size:
+        mapped_hash = _mapped_digest(conf_file, algorithm)
+        if mapped_hash is not None:
+            return mapped_hash
+    file_hash = hashlib.new(algorithm)
+    memory_view = _read_buffer()
+    for buffer_size in iter(
+        lambda cf=conf_file, mv=memory_view:  # type: ignore
+        cf.readinto(mv), 0
+    ):
+        file_hash.update(memory_view[:buffer_size])
+    return file_hash.hexdigest()
+
+
+def _hash_uncached(file_path: str, algorithm: str) -> str:
+    """Hash a file from disk and store the digest in the hash cache"""
+    with open(file_path, 'rb', buffering=0) as conf_file:
+        file_stat = fstat(conf_file.fileno())
+        key = _stat_key(file_stat, algorithm)
+        file_hash_str = _read_digest(conf_file, algorithm, file_stat.st_size)
+        # Only cache the digest if the file did not change while
+        # it was being read
+        if _stat_key(fstat(conf_file.fileno()), algorithm) == key:
+            hash_cache.put(key, file_hash_str)
+    return file_hash_str
+
+
+def hash_file(file_path: str, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """
+    Return the hex digest of a file, sha256 unless another hashlib
+    algorithm is given. Unchanged files are served from the hash cache
+    without being read.
+    """
+    cached_hash = hash_cache.get(_stat_key(stat(file_path), algorithm))
+    if cached_hash is not None:
+        return cached_hash
+    return _hash_uncached(file_path, algorithm)
+
+
+def cache_hash(file_path: str, file_hash: str,
+               algorithm: str = DEFAULT_ALGORITHM) -> None:
+    """Store the known digest of a file which was just written"""
+    try:
+        hash_cache.put(_stat_key(stat(file_path), algorithm), file_hash)
+    except FileNotFoundError:
+        pass
+
+
+def hash_entries(entries: Dict[str, DirEntry[str]],
+                 algorithm: str = DEFAULT_ALGORITHM) -> Dict[str, str]:
+    """
+    Return the hex digests of a set of files, keyed like the entries.
+    Cached digests are returned directly and the remaining files are
+    hashed in parallel on the hashing pool.
+    """
+    file_hash_list: Dict[str, str] = {}
+    uncached: List[Tuple[str, str, int]] = []
+    for name, entry in entries.items():
+        file_stat = entry.stat()
+        cached_hash = hash_cache.get(_stat_key(file_stat, algorithm))
+        if cached_hash is None:
+            uncached.append((name, entry.path, file_stat.st_size))
+        else:
+            file_hash_list[name] = cached_hash
+
+    if len(uncached) == 1:
+        name, file_path, _ = uncached[0]
+        file_hash_list[name] = _hash_uncached(file_path, algorithm)
+    elif uncached:
+        # Largest files go first so that a big file submitted last
+        # does not leave the other workers idle at the end
+        uncached.sort(key=lambda item: item[2], reverse=True)
+        futures: List[Tuple[str, Future[str]]] = [
+            (name, hash_pool.submit(_hash_uncached, file_path, algorithm))
+            for name, file_path, _ in uncached
+        ]
+        for name, future in futures:
+            file_hash_list[name] = future.result()
+
+    return {name: file_hash_list[name] for name in entries}
+
+
+def node_digest(children: Dict[str, str],
+                algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """
+    Return the digest of a Merkle tree node from the digests of its
+    children. Names of directory children end with a slash.
+    """
+    node_hash = hashlib.new(algorithm)
+    for name in sorted(children):
+        node_hash.update(name.encode("utf-8", "surrogateescape"))
+        node_hash.update(b"\0")
+        node_hash.update(children[name].encode())
+        node_hash.update(b"\n")
+    return node_hash.hexdigest()
+
+
+def merkle_tree(file_hashes: Dict[str, str],
+                algorithm: str = DEFAULT_ALGORITHM) -> Dict[str, Dict[str, str]]:
+    """
+    Build the Merkle tree of a bucket from the hashes of its files,
+    whose names may be slash separated relative paths.
+    Returns the children of every directory node, keyed by the path
+    of the directory. The root directory has the empty path.
+    """
+    tree: Dict[str, Dict[str, str]] = {"": {}}
+    for name, file_hash in file_hashes.items():
+        parent, _, base_name = name.rpartition("/")
+        tree.setdefault(parent, {})[base_name] = file_hash
+        while parent:
+            parent = parent.rpartition("/")[0]
+            tree.setdefault(parent, {})
+
+    # Deepest directories go first so that the digests of their
+    # children are known when they are hashed
+    for directory in sorted(tree, key=lambda path: path.count("/"),
+                            reverse=True):
+        if directory:
+            parent, _, base_name = directory.rpartition("/")
+            tree[parent][base_name + "/"] = node_digest(tree[directory],
+                                                        algorithm)
+    return tree
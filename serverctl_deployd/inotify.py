@@ -0,0 +1,85 @@
+"""
+Thin ctypes wrapper around the Linux inotify API
+"""
+
+import ctypes
+import ctypes.util
+import os
+import struct
+from typing import List, Tuple
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """Thin ctypes wrapper around the Linux inotify API"""
+
+    def __init__(self) -> None:
+        libc_name = ctypes.util.find_library("c")
+        try:
+            self._libc = ctypes.CDLL(libc_name, use_errno=True)
+            init = self._libc.inotify_init1
+        except (OSError, AttributeError) as load_error:
+            raise OSError("inotify is not available on this host") \
+                from load_error
+        self._fd: int = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def fileno(self) -> int:
+        """Return the inotify file descriptor"""
+        return self._fd
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """Watch a path and return its watch descriptor"""
+        watch_descriptor: int = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), mask
+        )
+        if watch_descriptor < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return watch_descriptor
+
+    def remove_watch(self, watch_descriptor: int) -> None:
+        """Stop watching a watch descriptor"""
+        self._libc.inotify_rm_watch(self._fd, watch_descriptor)
+
+    def read_events(self) -> List[Tuple[int, int, str]]:
+        """Return the pending (wd, mask, name) events without blocking"""
+        events: List[Tuple[int, int, str]] = []
+        while True:
+            try:
+                buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buffer):
+                watch_descriptor, mask, _, name_length = \
+                    _EVENT_HEADER.unpack_from(buffer, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(
+                    buffer[offset:offset + name_length].rstrip(b"\0")
+                )
+                offset += name_length
+                events.append((watch_descriptor, mask, name))
+
+    def close(self) -> None:
+        """Close the inotify file descriptor"""
+        os.close(self._fd)
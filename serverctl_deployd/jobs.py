@@ -0,0 +1,470 @@
+"""
+Asynchronous runner for shell commands such as config reloads
+"""
+
+import asyncio
+import logging
+import os
+import signal
+from asyncio.subprocess import Process
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import AsyncIterator, Deque, Dict, NamedTuple, Optional, Set, Tuple
+from uuid import uuid4
+
+from serverctl_deployd.dependencies import get_settings
+from serverctl_deployd.models.jobs import Job, JobStats, JobStatus
+
+READ_SIZE = 64 * 1024
+
+
+def _utcnow() -> datetime:
+    """Return the current time in UTC"""
+    return datetime.now(timezone.utc)
+
+
+class OutputLine(NamedTuple):
+    """
+    A line of output of a command, from "stdout" or "stderr",
+    or the number of lines a subscriber missed, from "dropped"
+    """
+    stream: str
+    text: str
+
+
+class OutputSubscription:
+    """
+    Lines of output of a running job, buffered for one subscriber.
+    The buffer is bounded: if the subscriber falls behind, the oldest
+    lines are dropped rather than holding back the job, and the number
+    of lines dropped is reported in their place.
+    """
+
+    def __init__(self, max_lines: int) -> None:
+        self.max_lines = max_lines
+        self.closed = False
+        self._lines: Deque[OutputLine] = deque()
+        self._dropped = 0
+        self._event = asyncio.Event()
+
+    def publish(self, line: OutputLine) -> None:
+        """Buffer a line, dropping the oldest one if the buffer is full"""
+        if len(self._lines) >= self.max_lines:
+            self._lines.popleft()
+            self._dropped += 1
+        self._lines.append(line)
+        self._event.set()
+
+    def close(self) -> None:
+        """Mark the end of the output"""
+        self.closed = True
+        self._event.set()
+
+    async def lines(self, keepalive: float) -> AsyncIterator[
+            Optional[OutputLine]]:
+        """
+        Yield the lines as they are published until the output ends.
+        None is yielded when no line was published for keepalive
+        seconds.
+        """
+        while True:
+            if self._dropped:
+                yield OutputLine("dropped", str(self._dropped))
+                self._dropped = 0
+            while self._lines and not self._dropped:
+                yield self._lines.popleft()
+            if self._dropped:
+                continue
+            if self.closed:
+                return
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), keepalive)
+            except asyncio.TimeoutError:
+                yield None
+
+
+class CommandJob:  # pylint: disable=too-many-instance-attributes
+    """A command submitted to the job runner"""
+
+    def __init__(self, command: str, key: Optional[str] = None,
+                 max_output: int = 65536, max_lines: int = 1000) -> None:
+        self.id = uuid4().hex
+        self.command = command
+        self.key = key
+        self.status = JobStatus.PENDING
+        self.exit_code: Optional[int] = None
+        self.created_at = _utcnow()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.task: Optional[asyncio.Task[None]] = None
+        self.max_output = max_output
+        self.max_lines = max_lines
+        self._output = {"stdout": bytearray(), "stderr": bytearray()}
+        # Recent lines, replayed to subscribers joining a running job
+        self._history: Deque[OutputLine] = deque(maxlen=max_lines)
+        self._subscriptions: Set[OutputSubscription] = set()
+
+    @property
+    def stdout(self) -> str:
+        """Return the end of the standard output captured so far"""
+        return self._output["stdout"].decode(errors="replace")
+
+    @property
+    def stderr(self) -> str:
+        """Return the end of the standard error captured so far"""
+        return self._output["stderr"].decode(errors="replace")
+
+    def write_output(self, stream: str, data: bytes) -> None:
+        """
+        Capture output of the command, keeping only the last max_output
+        bytes of each stream, and publish its complete lines
+        """
+        output = self._output[stream]
+        start = output.rfind(b"\n") + 1
+        output += data
+        if len(output) > self.max_output:
+            excess = len(output) - self.max_output
+            del output[:excess]
+            start = max(start - excess, 0)
+        end = output.rfind(b"\n") + 1
+        if end > start:
+            for line in output[start:end - 1].split(b"\n"):
+                self._publish(OutputLine(stream, line.decode(
+                    errors="replace"
+                )))
+
+    def _publish(self, line: OutputLine) -> None:
+        """Send a line of output to the subscribers"""
+        self._history.append(line)
+        for subscription in self._subscriptions:
+            subscription.publish(line)
+
+    def flush_output(self) -> None:
+        """Publish the last lines of output not ended by a newline"""
+        for stream, output in self._output.items():
+            start = output.rfind(b"\n") + 1
+            if start < len(output):
+                self._publish(OutputLine(stream, output[start:].decode(
+                    errors="replace"
+                )))
+
+    def subscribe(self, max_lines: Optional[int] = None
+                  ) -> OutputSubscription:
+        """
+        Return a subscription to the output of the job, starting with
+        the recent lines if it is running. The subscription of a job
+        which has finished is closed right away.
+        """
+        subscription = OutputSubscription(max_lines or self.max_lines)
+        for line in self._history:
+            subscription.publish(line)
+        if self.done:
+            subscription.close()
+        else:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: OutputSubscription) -> None:
+        """Stop sending output to a subscription"""
+        self._subscriptions.discard(subscription)
+
+    def finish(self) -> None:
+        """
+        Record the end of the job and close the subscriptions.
+        The history of lines is only kept for running jobs.
+        """
+        self.finished_at = _utcnow()
+        self.flush_output()
+        self._history.clear()
+        for subscription in self._subscriptions:
+            subscription.close()
+        self._subscriptions.clear()
+
+    @property
+    def done(self) -> bool:
+        """Check if the job has finished"""
+        return self.status not in (JobStatus.PENDING, JobStatus.RUNNING)
+
+    @property
+    def duration(self) -> Optional[float]:
+        """Return the seconds the command ran for, once it has finished"""
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at).total_seconds()
+
+    @property
+    def succeeded(self) -> bool:
+        """Check if the command exited successfully"""
+        return self.status == JobStatus.SUCCEEDED
+
+    async def wait(self) -> None:
+        """Wait for the job to finish"""
+        if self.task is not None:
+            await asyncio.shield(self.task)
+
+    def to_model(self) -> Job:
+        """Return the status of the job"""
+        return Job(
+            id=self.id,
+            command=self.command,
+            key=self.key,
+            status=self.status,
+            exit_code=self.exit_code,
+            stdout=self.stdout,
+            stderr=self.stderr,
+            created_at=self.created_at,
+            started_at=self.started_at,
+            finished_at=self.finished_at,
+            duration=self.duration
+        )
+
+
+class JobRunner:  # pylint: disable=too-many-instance-attributes
+    """
+    Runs shell commands as asyncio subprocesses, with a bounded number
+    of concurrent commands, a timeout per command and captured output.
+    Jobs submitted with the same key run one at a time, in order.
+    Output is captured as it is produced, and its lines are streamed
+    to subscribers with buffers of stream_buffer lines.
+    Finished jobs are kept for status queries up to a bounded history.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self, max_concurrency: int, timeout: float,
+        max_jobs: int, max_output: int, stream_buffer: int = 1000
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.max_output = max_output
+        self.stream_buffer = stream_buffer
+        self._jobs: OrderedDict[str, CommandJob] = OrderedDict()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._lock_users: Counter[str] = Counter()
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """
+        Return the concurrency limit of the running event loop.
+        uvicorn runs a single loop, the check only matters when a new
+        loop is started, e.g. by the test client.
+        """
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._locks.clear()
+            self._lock_users.clear()
+        return self._semaphore
+
+    @asynccontextmanager
+    async def _hold_key(self, key: Optional[str]) -> AsyncIterator[None]:
+        """
+        Hold the lock of a key while a job runs. asyncio locks are
+        acquired in order, and are forgotten once no job uses them.
+        """
+        if key is None:
+            yield
+            return
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._lock_users[key] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._lock_users[key] -= 1
+            if not self._lock_users[key]:
+                del self._lock_users[key]
+                del self._locks[key]
+
+    @staticmethod
+    async def _read_output(job: CommandJob, stream: str,
+                           reader: Optional[asyncio.StreamReader]) -> None:
+        """Capture the output of a command as it is produced"""
+        assert reader is not None
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                return
+            job.write_output(stream, data)
+
+    async def _communicate(self, job: CommandJob,
+                           process: Process) -> None:
+        """Capture the output of a command until it exits"""
+        await asyncio.gather(
+            self._read_output(job, "stdout", process.stdout),
+            self._read_output(job, "stderr", process.stderr)
+        )
+        await process.wait()
+
+    async def _execute(self, job: CommandJob, delay: float) -> None:
+        """Run the command of a job and record its result"""
+        if delay > 0:
+            await asyncio.sleep(delay)
+        semaphore = self._get_semaphore()
+        # Jobs waiting for their key do not take a slot of the pool
+        async with self._hold_key(job.key), semaphore:
+            job.status = JobStatus.RUNNING
+            job.started_at = _utcnow()
+            try:
+                process = await asyncio.create_subprocess_shell(
+                    job.command,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    executable="/bin/bash",
+                    start_new_session=True
+                )
+            except OSError as os_error:
+                logging.exception("Error running %s", job.command)
+                job.status = JobStatus.FAILED
+                job.write_output("stderr", str(os_error).encode())
+                job.finish()
+                return
+            try:
+                await asyncio.wait_for(
+                    self._communicate(job, process), self.timeout
+                )
+            except asyncio.TimeoutError:
+                # The command runs in its own session, so the whole
+                # process group started by the shell is killed
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await process.wait()
+                job.status = JobStatus.TIMED_OUT
+            else:
+                job.status = JobStatus.SUCCEEDED \
+                    if process.returncode == 0 else JobStatus.FAILED
+            job.exit_code = process.returncode
+            job.finish()
+
+    def submit(self, command: str, delay: float = 0.0,
+               key: Optional[str] = None) -> CommandJob:
+        """
+        Start a job in the background and return it.
+        The command is started after the delay, in seconds, and once
+        the jobs submitted before it with the same key have finished.
+        """
+        job = CommandJob(command, key, self.max_output, self.stream_buffer)
+        job.task = asyncio.get_running_loop().create_task(
+            self._execute(job, delay)
+        )
+        job.task.add_done_callback(lambda _: self._evict())
+        self._jobs[job.id] = job
+        self._evict()
+        return job
+
+    async def run(self, command: str) -> CommandJob:
+        """Run a job and wait for it to finish"""
+        job = self.submit(command)
+        await job.wait()
+        return job
+
+    def get(self, job_id: str) -> Optional[CommandJob]:
+        """Return a job by its ID"""
+        return self._jobs.get(job_id)
+
+    def stats(self) -> JobStats:
+        """Return the number of jobs per status and their durations"""
+        statuses = Counter(job.status for job in self._jobs.values())
+        durations = [
+            duration for duration in
+            (job.duration for job in self._jobs.values())
+            if duration is not None
+        ]
+        return JobStats(
+            pending=statuses[JobStatus.PENDING],
+            running=statuses[JobStatus.RUNNING],
+            succeeded=statuses[JobStatus.SUCCEEDED],
+            failed=statuses[JobStatus.FAILED],
+            timed_out=statuses[JobStatus.TIMED_OUT],
+            average_duration=sum(durations) / len(durations)
+            if durations else None,
+            max_duration=max(durations, default=None)
+        )
+
+    def _evict(self) -> None:
+        """Forget the oldest finished jobs beyond the history limit"""
+        excess = len(self._jobs) - self.max_jobs
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id].done:
+                del self._jobs[job_id]
+                excess -= 1
+
+
+class ReloadCoalescer:
+    """
+    Coalesces runs of the same update command for the same directory.
+    The first request opens a debounce window at the end of which the
+    command is run; every request for the same command and directory
+    made before the command starts shares its job. Requests made once
+    the command has started get a new job, as the running command may
+    not see their changes.
+    """
+
+    def __init__(self, runner: JobRunner, debounce: float) -> None:
+        self.runner = runner
+        self.debounce = debounce
+        self._pending: Dict[Tuple[str, str], CommandJob] = {}
+
+    @staticmethod
+    def _can_join(job: CommandJob) -> bool:
+        """Check if a job has not started yet in the running loop"""
+        return (
+            job.status == JobStatus.PENDING
+            and job.task is not None
+            and job.task.get_loop() is asyncio.get_running_loop()
+        )
+
+    def submit(self, command: str, directory: str) -> CommandJob:
+        """Return the job which will run the command for the directory"""
+        key = (command, os.path.realpath(directory))
+        job = self._pending.get(key)
+        if job is not None and self._can_join(job):
+            return job
+        job = self.runner.submit(command, delay=self.debounce)
+        self._pending[key] = job
+
+        def _forget(_: "asyncio.Task[None]") -> None:
+            if self._pending.get(key) is job:
+                del self._pending[key]
+
+        assert job.task is not None
+        job.task.add_done_callback(_forget)
+        return job
+
+    async def run(self, command: str, directory: str) -> CommandJob:
+        """Wait for the job which runs the command for the directory"""
+        job = self.submit(command, directory)
+        await job.wait()
+        return job
+
+
+command_runner = JobRunner(
+    max_concurrency=get_settings().command_workers,
+    timeout=get_settings().command_timeout,
+    max_jobs=get_settings().job_history,
+    max_output=get_settings().command_output_limit,
+    stream_buffer=get_settings().job_stream_buffer
+)
+
+# docker-compose runs on its own pool, so that deployments do not
+# hold back config reloads
+compose_runner = JobRunner(
+    max_concurrency=get_settings().compose_workers,
+    timeout=get_settings().compose_timeout,
+    max_jobs=get_settings().job_history,
+    max_output=get_settings().command_output_limit,
+    stream_buffer=get_settings().job_stream_buffer
+)
+
+reload_coalescer = ReloadCoalescer(
+    command_runner,
+    debounce=get_settings().reload_debounce
+)
@@ -11,8 +11,13 @@ import uvicorn
 from fastapi import Depends, FastAPI
 
 from serverctl_deployd.config import Settings
-from serverctl_deployd.dependencies import check_authentication, get_settings
-from serverctl_deployd.routers import config, deployments, docker
+from serverctl_deployd.dependencies import (check_authentication,
+                                            get_deployment_registry,
+                                            get_settings)
+from serverctl_deployd.routers import (backups, config, deployments, docker,
+                                       snapshots)
+from serverctl_deployd.store import DB_FILENAME
+from serverctl_deployd.watcher import bucket_watcher
 
 rotating_file_handler = TimedRotatingFileHandler("logs/serverctl_deployd.log",
                                                  when="W0",
@@ -30,10 +35,28 @@ app: FastAPI = FastAPI(dependencies=[Depends(check_authentication)])
 
 
 app.include_router(config.router)
+app.include_router(backups.router)
+app.include_router(snapshots.router)
 app.include_router(deployments.router)
 app.include_router(docker.router)
 
 
+@app.on_event("startup")
+def load_deployment_registry() -> None:
+    """
+    Load the index of deployments before the first request,
+    once the deployment store has been created
+    """
+    if settings.deployments_dir.joinpath(DB_FILENAME).exists():
+        get_deployment_registry(settings).load()
+
+
+@app.on_event("shutdown")
+def stop_bucket_watcher() -> None:
+    """Stop the inotify watcher thread"""
+    bucket_watcher.stop()
+
+
 @app.get("/")
 async def root() -> dict[str, str]:
     """Basic route for testing"""
@@ -2,39 +2,131 @@
 Models for config buckets
 """
 
-from typing import Optional, Set
+from enum import Enum
+from pathlib import Path
+from typing import Dict, List, Optional, Set
 
 from pydantic import BaseModel
 from pydantic.fields import Field
 from pydantic.types import DirectoryPath
 
 
-class ListConfigBucket(BaseModel):
+class HashAlgorithm(str, Enum):
+    """Enum of the hashlib algorithms available for file checksums"""
+    SHA256 = "sha256"
+    SHA512 = "sha512"
+    SHA1 = "sha1"
+    MD5 = "md5"
+    BLAKE2B = "blake2b"
+    BLAKE2S = "blake2s"
+    SHA3_256 = "sha3_256"
+
+
+class Compression(str, Enum):
+    """Enum of the compressions available for bucket backups"""
+    NONE = "none"
+    GZIP = "gzip"
+    PGZIP = "pgzip"
+
+
+class BucketOptions(BaseModel):
+    """Class for the options of listing the files of a config bucket"""
+    ignore_patterns: Optional[Set[str]] = Field(
+        None, title="List of unix-shell style patterns for files to be ignored",
+        description="Files which match this pattern will be ignored.\
+            The expressions in this list should follow glob syntax"
+    )
+    recursive: bool = Field(
+        False, title="Include files in subdirectories",
+        description="Files in subdirectories are keyed by their path\
+            relative to the bucket. Directories which match the ignore\
+            patterns are skipped without being walked"
+    )
+    algorithm: HashAlgorithm = Field(
+        HashAlgorithm.SHA256, title="Hash algorithm of the file checksums",
+        description="Faster algorithms such as blake2b can be used when\
+            the checksums are only compared to detect changes"
+    )
+
+
+class ListConfigBucket(BucketOptions):
     """Class for obtaining list of files for a config bucket"""
     directory_path: DirectoryPath = Field(
         ..., title="Directory path for the bucket",
         description="This is the path of the directory\
             in which the config file(s) reside"
     )
-    ignore_patterns: Optional[Set[str]] = Field(
-        None, title="List of unix-shell style patterns for files to be ignored",
-        description="Files which match this pattern will be ignored.\
-            The expressions in this list should follow glob syntax"
+
+
+class BatchConfigBucket(BucketOptions):
+    """
+    Class for a bucket of a batch check. The directory is not
+    validated, so that a missing one is reported as its result
+    instead of failing the whole batch
+    """
+    directory_path: Path = Field(
+        ..., title="Directory path for the bucket",
+        description="This is the path of the directory\
+            in which the config file(s) reside"
+    )
+
+
+class DifferentialBackup(ListConfigBucket):
+    """Class for requesting a differential backup of a config bucket"""
+    manifest: Dict[str, str] = Field(
+        ..., title="File hashes of the previous backup",
+        description="Mapping of file names to their checksums,\
+            in the format returned by the /check route"
+    )
+
+
+class BucketDigestRequest(ListConfigBucket):
+    """Class for requesting the Merkle digest of a config bucket"""
+    path: str = Field(
+        "", title="Path of the node inside the bucket",
+        description="Relative path of the directory or file whose digest\
+            is requested. The root of the bucket is the empty path"
+    )
+    expand: bool = Field(
+        False, title="Include the digests of the children of the node"
     )
 
 
-class ConfigBucket(BaseModel):
+class BucketDigest(BaseModel):
+    """Class for the Merkle digest of a config bucket node"""
+    path: str = Field(..., title="Path of the node inside the bucket")
+    digest: str = Field(..., title="Digest of the node")
+    algorithm: HashAlgorithm = Field(
+        ..., title="Hash algorithm of the digest"
+    )
+    children: Optional[Dict[str, str]] = Field(
+        None, title="Digests of the children of the node",
+        description="Names of directories end with a slash"
+    )
+
+
+class BucketCheckResult(BaseModel):
+    """Class for the result of checking one bucket of a batch"""
+    index: int = Field(..., title="Position of the bucket in the batch")
+    directory_path: str = Field(..., title="Directory path for the bucket")
+    algorithm: HashAlgorithm = Field(
+        ..., title="Hash algorithm of the checksums"
+    )
+    hashes: Optional[Dict[str, str]] = Field(
+        None, title="File names of the bucket and their checksums"
+    )
+    error: Optional[str] = Field(
+        None, title="Reason the bucket could not be checked"
+    )
+
+
+class ConfigBucket(BucketOptions):
     """Class for validating config bucket creation and updation"""
     directory_path: DirectoryPath = Field(
         None, title="Directory path for the bucket",
         description="This is the path of the directory\
             in which the config file(s) reside"
     )
-    ignore_patterns: Optional[Set[str]] = Field(
-        None, title="List of unix-shell style patterns for files to be ignored",
-        description="Files which match this pattern will be ignored.\
-            The expressions in this list should follow glob syntax"
-    )
     update_command: Optional[str] = Field(
         None, title="Command to be run to reload the config file(s)"
     )
@@ -45,3 +137,86 @@ class UpdateCommand(BaseModel):
     update_command: str = Field(
         ..., title="Command to be run to reload the config file(s)"
     )
+
+
+class HashCacheStats(BaseModel):
+    """Class for hash cache statistics"""
+    hits: int = Field(..., title="Number of digests served from the cache")
+    misses: int = Field(..., title="Number of digests that had to be computed")
+    entries: int = Field(..., title="Number of digests currently cached")
+    max_entries: int = Field(..., title="Maximum number of cached digests")
+
+
+class BlockSignature(BaseModel):
+    """Class for the checksums of a block of a config file"""
+    weak: int = Field(
+        ..., title="Adler-32 checksum of the block",
+        description="Rolling checksum used to find candidate matches of\
+            the block at any offset of the new file"
+    )
+    strong: str = Field(
+        ..., title="sha256 checksum of the block",
+        description="Used to confirm the candidate matches of the weak\
+            checksum"
+    )
+
+
+class FileSignature(BaseModel):
+    """Class for the block checksums of a config file"""
+    file_hash: str = Field(..., title="sha256 checksum of the whole file")
+    file_size: int = Field(..., title="Size of the file in bytes")
+    block_size: int = Field(
+        ..., title="Size of the blocks in bytes",
+        description="The last block is shorter if the file size is not\
+            a multiple of the block size"
+    )
+    blocks: List[BlockSignature] = Field(
+        ..., title="Checksums of the blocks of the file, in order"
+    )
+
+
+class DeltaInstruction(BaseModel):
+    """Class for one instruction of a file delta"""
+    copy_block: Optional[int] = Field(
+        None, title="Index of the first block of the current file to copy"
+    )
+    block_count: int = Field(
+        1, title="Number of consecutive blocks to copy"
+    )
+    data: Optional[str] = Field(
+        None, title="Base64 encoded bytes to insert",
+        description="Each instruction either copies blocks or inserts data"
+    )
+
+
+class FileDelta(BaseModel):
+    """Class for a delta to apply to a config file"""
+    base_hash: str = Field(
+        ..., title="sha256 checksum of the file the delta was computed on",
+        description="The delta is rejected if the file has changed since"
+    )
+    block_size: int = Field(
+        ..., gt=0, title="Block size of the signature the delta refers to"
+    )
+    instructions: List[DeltaInstruction] = Field(
+        ..., title="Instructions rebuilding the new file, in order"
+    )
+    result_hash: Optional[str] = Field(
+        None, title="sha256 checksum of the new file",
+        description="If given, the delta is rejected unless the rebuilt\
+            file matches it"
+    )
+    update_command: str = Field(
+        ..., title="Command to be run to reload the config file(s)"
+    )
+
+
+class ArchiveRestore(BaseModel):
+    """Class for the result of restoring a backup archive"""
+    restored: List[str] = Field(..., title="Files written from the archive")
+    unchanged: List[str] = Field(
+        ..., title="Files skipped as they already had the archived content"
+    )
+    deleted: List[str] = Field(
+        ..., title="Files deleted as listed by a differential backup"
+    )
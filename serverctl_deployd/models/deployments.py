@@ -3,11 +3,13 @@ Models related to the deployments feature
 """
 
 from enum import Enum
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel
 from pydantic.fields import Field
 
+from serverctl_deployd.models.jobs import JobStatus
+
 
 class DBType(str, Enum):
     """Enum of supported databases"""
@@ -68,3 +70,64 @@ class UpdateDeployment(BaseModel):
     databases: Optional[Dict[str, UpdateDBConfig]] = Field(
         None, title="List of database services"
     )
+
+
+class ComposeAction(str, Enum):
+    """Enum of the docker-compose operations on deployments"""
+    UP = "up"
+    DOWN = "down"
+    RESTART = "restart"
+
+
+class BulkOperation(BaseModel):
+    """Class for running an operation on several deployments"""
+    action: ComposeAction = Field(
+        ..., title="Operation to run on the deployments",
+        description="restart runs down then up, recreating the containers"
+    )
+    names: Optional[List[str]] = Field(
+        None, title="Names of the deployments"
+    )
+    selector: Optional[str] = Field(
+        None, title="Glob pattern selecting deployments by name"
+    )
+    dependencies: Dict[str, List[str]] = Field(
+        {}, title="Deployments each deployment depends on",
+        description="Dependencies are brought up before and down after\
+            the deployments depending on them. A deployment is skipped\
+            if the operation failed on one of its dependencies. Only the\
+            deployments of the operation are ordered."
+    )
+
+
+class BulkItemResult(BaseModel):
+    """Class for the result of a bulk operation on one deployment"""
+    name: str = Field(..., title="Name of the deployment")
+    status: Optional[JobStatus] = Field(
+        None, title="Status of the docker-compose job",
+        description="null until the dependencies of the deployment are done"
+    )
+    skipped: bool = Field(
+        False, title="Whether the operation failed on a dependency"
+    )
+    job_id: Optional[str] = Field(
+        None, title="ID of the docker-compose job, once submitted"
+    )
+    exit_code: Optional[int] = Field(
+        None, title="Exit code of docker-compose, once it has finished"
+    )
+    duration: Optional[float] = Field(
+        None, title="Seconds docker-compose ran for"
+    )
+
+
+class BulkResult(BaseModel):
+    """Class for the status of a bulk operation"""
+    id: str = Field(..., title="ID of the bulk operation")
+    action: ComposeAction = Field(..., title="Operation run")
+    done: bool = Field(
+        ..., title="Whether the operation finished on every deployment"
+    )
+    results: List[BulkItemResult] = Field(
+        ..., title="Results per deployment, in the order they were given"
+    )
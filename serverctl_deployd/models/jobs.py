@@ -0,0 +1,61 @@
+"""
+Models for jobs running commands in the background
+"""
+
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel
+from pydantic.fields import Field
+
+
+class JobStatus(str, Enum):
+    """Enum of job states"""
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    TIMED_OUT = "timed_out"
+
+
+class Job(BaseModel):
+    """Class for the status of a command job"""
+    id: str = Field(..., title="ID of the job")
+    command: str = Field(..., title="Command run by the job")
+    key: Optional[str] = Field(
+        None, title="Resource the job holds while running",
+        description="Jobs with the same key run one at a time,\
+            in the order they were submitted"
+    )
+    status: JobStatus = Field(..., title="Status of the job")
+    exit_code: Optional[int] = Field(
+        None, title="Exit code of the command, once it has finished"
+    )
+    stdout: str = Field("", title="Standard output of the command")
+    stderr: str = Field("", title="Standard error of the command")
+    created_at: datetime = Field(..., title="Time the job was submitted")
+    started_at: Optional[datetime] = Field(
+        None, title="Time the command was started"
+    )
+    finished_at: Optional[datetime] = Field(
+        None, title="Time the command finished"
+    )
+    duration: Optional[float] = Field(
+        None, title="Seconds the command ran for, once it has finished"
+    )
+
+
+class JobStats(BaseModel):
+    """Class for statistics of the jobs kept by a job runner"""
+    pending: int = Field(..., title="Number of jobs waiting to start")
+    running: int = Field(..., title="Number of jobs running")
+    succeeded: int = Field(..., title="Number of jobs which succeeded")
+    failed: int = Field(..., title="Number of jobs which failed")
+    timed_out: int = Field(..., title="Number of jobs which were killed")
+    average_duration: Optional[float] = Field(
+        None, title="Average seconds the finished jobs ran for"
+    )
+    max_duration: Optional[float] = Field(
+        None, title="Longest seconds a finished job ran for"
+    )
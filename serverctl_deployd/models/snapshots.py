@@ -0,0 +1,59 @@
+"""
+Models for snapshots of config buckets
+"""
+
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from pydantic import BaseModel
+from pydantic.fields import Field
+
+
+class SnapshotInfo(BaseModel):
+    """Class for the summary of a snapshot"""
+    id: str = Field(..., title="ID of the snapshot")
+    directory_path: str = Field(..., title="Directory path of the bucket")
+    created_at: datetime = Field(..., title="Time the snapshot was taken")
+    file_count: int = Field(..., title="Number of files in the snapshot")
+
+
+class Snapshot(BaseModel):
+    """Class for a snapshot of a config bucket"""
+    id: str = Field(..., title="ID of the snapshot")
+    directory_path: str = Field(..., title="Directory path of the bucket")
+    ignore_patterns: Optional[Set[str]] = Field(
+        None, title="Ignore patterns the bucket was scanned with"
+    )
+    recursive: bool = Field(
+        False, title="Whether subdirectories were included"
+    )
+    created_at: datetime = Field(..., title="Time the snapshot was taken")
+    files: Dict[str, str] = Field(
+        ..., title="File names of the bucket and their sha256 checksums"
+    )
+
+    def info(self) -> SnapshotInfo:
+        """Return the summary of the snapshot"""
+        return SnapshotInfo(
+            id=self.id,
+            directory_path=self.directory_path,
+            created_at=self.created_at,
+            file_count=len(self.files)
+        )
+
+
+class SnapshotDiff(BaseModel):
+    """Class for the differences between two states of a bucket"""
+    added: List[str] = Field(..., title="Files only in the newer state")
+    removed: List[str] = Field(..., title="Files only in the older state")
+    changed: List[str] = Field(..., title="Files whose content differs")
+
+
+class SnapshotRestore(BaseModel):
+    """Class for restoring a snapshot"""
+    update_command: Optional[str] = Field(
+        None, title="Command to be run to reload the config file(s)"
+    )
+    prune: bool = Field(
+        False, title="Delete files which are not in the snapshot"
+    )
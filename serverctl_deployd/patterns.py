@@ -0,0 +1,69 @@
+"""
+Compiled matching of the ignore patterns of config buckets
+"""
+
+import re
+from fnmatch import translate
+from functools import lru_cache
+from typing import Callable, FrozenSet, Iterable, List, Optional
+
+_MAGIC_CHARS = re.compile(r"[*?[]")
+
+
+def _has_magic(pattern: str) -> bool:
+    """Check if a pattern uses any glob syntax"""
+    return _MAGIC_CHARS.search(pattern) is not None
+
+
+@lru_cache(maxsize=256)
+def _compile(patterns: FrozenSet[str]) -> Callable[[str], bool]:
+    """
+    Compile a set of glob patterns into a single predicate.
+    Literal names, '*suffix' and 'prefix*' patterns are matched with
+    plain string operations and the rest with one combined regex.
+    """
+    literals = set()
+    suffixes: List[str] = []
+    prefixes: List[str] = []
+    expressions: List[str] = []
+    for pattern in patterns:
+        if not _has_magic(pattern):
+            literals.add(pattern)
+        elif pattern.startswith("*") and not _has_magic(pattern[1:]):
+            suffixes.append(pattern[1:])
+        elif pattern.endswith("*") and not _has_magic(pattern[:-1]):
+            prefixes.append(pattern[:-1])
+        else:
+            expressions.append(translate(pattern))
+    suffix_tuple = tuple(suffixes)
+    prefix_tuple = tuple(prefixes)
+    combined = re.compile("|".join(expressions)) if expressions else None
+
+    def _match(name: str) -> bool:
+        return (
+            name in literals
+            or name.endswith(suffix_tuple)
+            or name.startswith(prefix_tuple)
+            or (combined is not None and combined.match(name) is not None)
+        )
+
+    def _is_ignored(relative_path: str) -> bool:
+        name = relative_path.rpartition("/")[2]
+        return _match(name) or (
+            name != relative_path and _match(relative_path)
+        )
+
+    return _is_ignored
+
+
+def ignore_matcher(
+    patterns: Optional[Iterable[str]]
+) -> Callable[[str], bool]:
+    """
+    Return a predicate telling if a file or directory matches any of
+    the glob patterns, either by its name or by its path relative to
+    the bucket. Compiled predicates are cached per set of patterns.
+    """
+    if not patterns:
+        return lambda relative_path: False
+    return _compile(frozenset(patterns))
@@ -0,0 +1,187 @@
+"""
+In-memory index of the deployment names, kept current by the
+deployment routes and by inotify events of the deployments directory
+"""
+
+import bisect
+import logging
+import os
+import threading
+from typing import List, Optional, Set
+
+from serverctl_deployd.inotify import (IN_CREATE, IN_DELETE, IN_DELETE_SELF,
+                                       IN_IGNORED, IN_ISDIR, IN_MOVE_SELF,
+                                       IN_MOVED_FROM, IN_MOVED_TO, IN_ONLYDIR,
+                                       IN_Q_OVERFLOW, Inotify)
+from serverctl_deployd.store import DB_FILENAME, DeploymentStore
+
+_DIRECTORY_EVENTS = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+                     | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+
+def _prefix_end(names: List[str], prefix: str, start: int) -> int:
+    """Return the index after the last sorted name starting with prefix"""
+    # Every name starting with prefix sorts below the prefix with its
+    # last character incremented, once the highest characters are dropped
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return len(names)
+    bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return bisect.bisect_left(names, bound, start)
+
+
+class DeploymentRegistry:  # pylint: disable=too-many-instance-attributes
+    """
+    Sorted index of the names of the deployments of a store, so that
+    existence checks, listings and prefix queries do not hit the store
+    or the filesystem. The routes report the deployments they create
+    and delete. Directories created, removed or renamed by others in
+    the deployments directory are checked against the store, and the
+    whole index is loaded again if the database file is replaced or
+    events were lost. Without inotify, the index is loaded again on
+    every query.
+    """
+
+    def __init__(self, store: DeploymentStore) -> None:
+        self.store = store
+        self._names: List[str] = []
+        self._index: Set[str] = set()
+        self._stale = True
+        self._dirty: Set[str] = set()
+        self._lock = threading.Lock()
+        self._inotify: Optional[Inotify] = None
+        self._watch_descriptor: Optional[int] = None
+        self._directory_fd: Optional[int] = None
+        try:
+            self._inotify = Inotify()
+        except OSError:
+            logging.warning("inotify is not available, deployments are "
+                            "loaded from the store on every query")
+
+    def _watch(self) -> None:
+        """Watch the deployments directory if it is not watched yet"""
+        if self._inotify is None or self._watch_descriptor is not None:
+            return
+        directory = self.store.deployments_dir
+        directory.mkdir(parents=True, exist_ok=True)
+        try:
+            # Kept open to tell when the directory is removed, as the
+            # removal is only reported once nothing else refers to it
+            self._directory_fd = os.open(directory, os.O_RDONLY)
+            self._watch_descriptor = self._inotify.add_watch(
+                str(directory), _DIRECTORY_EVENTS
+            )
+        except OSError:
+            logging.exception("Error watching %s", directory)
+            self._unwatch()
+
+    def _unwatch(self) -> None:
+        """Stop watching the deployments directory"""
+        if self._inotify is not None and self._watch_descriptor is not None:
+            self._inotify.remove_watch(self._watch_descriptor)
+        if self._directory_fd is not None:
+            os.close(self._directory_fd)
+        self._watch_descriptor = None
+        self._directory_fd = None
+
+    def _handle_event(self, watch_descriptor: int, mask: int,
+                      name: str) -> None:
+        """Record an inotify event of the deployments directory"""
+        if mask & IN_Q_OVERFLOW:
+            logging.warning("inotify queue overflowed, reloading "
+                            "deployments")
+            self._stale = True
+            return
+        if watch_descriptor != self._watch_descriptor:
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+            self._unwatch()
+            self._stale = True
+        elif name == DB_FILENAME:
+            self._stale = True
+        elif mask & IN_ISDIR:
+            self._dirty.add(name)
+
+    def _refresh(self) -> None:
+        """Apply the pending events, loading names from the store as needed"""
+        if self._inotify is not None:
+            for watch_descriptor, mask, name in self._inotify.read_events():
+                self._handle_event(watch_descriptor, mask, name)
+        if self._directory_fd is not None \
+                and os.fstat(self._directory_fd).st_nlink == 0:
+            self._unwatch()
+        if self._watch_descriptor is None:
+            self._stale = True
+        if self._stale:
+            # The watch is added before loading so that no change
+            # made during the load is missed
+            self._watch()
+            self._names = sorted(self.store.names())
+            self._index = set(self._names)
+            self._dirty.clear()
+            self._stale = self._watch_descriptor is None
+            return
+        for name in self._dirty:
+            if self.store.exists(name):
+                self._add(name)
+            else:
+                self._discard(name)
+        self._dirty.clear()
+
+    def _add(self, name: str) -> None:
+        """Add a name to the index"""
+        if name not in self._index:
+            self._index.add(name)
+            bisect.insort(self._names, name)
+
+    def _discard(self, name: str) -> None:
+        """Remove a name from the index"""
+        if name in self._index:
+            self._index.discard(name)
+            del self._names[bisect.bisect_left(self._names, name)]
+
+    def load(self) -> None:
+        """Load the names from the store and start watching"""
+        with self._lock:
+            self._stale = True
+            self._refresh()
+
+    def add(self, name: str) -> None:
+        """Record a deployment created in the store"""
+        with self._lock:
+            self._add(name)
+
+    def discard(self, name: str) -> None:
+        """Record a deployment deleted from the store"""
+        with self._lock:
+            self._discard(name)
+
+    def exists(self, name: str) -> bool:
+        """Check if a deployment exists"""
+        with self._lock:
+            self._refresh()
+            return name in self._index
+
+    def names(self, prefix: str = "", offset: int = 0,
+              limit: Optional[int] = None) -> List[str]:
+        """
+        Return the sorted names of the deployments starting with prefix,
+        skipping the first offset names and returning at most limit
+        """
+        with self._lock:
+            self._refresh()
+            start = bisect.bisect_left(self._names, prefix)
+            end = _prefix_end(self._names, prefix, start)
+            start = min(start + offset, end)
+            if limit is not None:
+                end = min(start + limit, end)
+            return self._names[start:end]
+
+    def close(self) -> None:
+        """Stop watching the deployments directory"""
+        with self._lock:
+            self._unwatch()
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+            self._stale = True
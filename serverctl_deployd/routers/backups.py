@@ -0,0 +1,159 @@
+"""
+Router for the backup and restore routes of config buckets
+"""
+
+import logging
+import zlib
+from typing import Optional
+
+from fastapi import APIRouter, Query, Request, status
+from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic.types import DirectoryPath
+from starlette.concurrency import run_in_threadpool
+
+from serverctl_deployd.archive import (AsyncStreamReader, InvalidArchive,
+                                       compress_stream, stage_archive,
+                                       tar_stream)
+from serverctl_deployd.buckets import commit_and_update, list_files
+from serverctl_deployd.hashing import hash_entries
+from serverctl_deployd.models.config import (ArchiveRestore, Compression,
+                                             DifferentialBackup,
+                                             ListConfigBucket)
+from serverctl_deployd.models.exceptions import GenericError
+from serverctl_deployd.staging import cleanup
+
+BACKUP_COMPRESSION_LEVEL = Query(
+    zlib.Z_DEFAULT_COMPRESSION, ge=-1, le=9,
+    title="Compression level of gzip and pgzip backups",
+    description="From 1 (fastest) to 9 (smallest), 0 for no compression\
+        or -1 for the zlib default"
+)
+
+router = APIRouter(
+    prefix="/config/buckets",
+    tags=["config"]
+)
+
+
+@router.post(
+    "/backup",
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"application/x-tar": {}}
+        }
+    },
+    response_class=StreamingResponse
+)
+def get_tar_archive(
+    config_bucket: ListConfigBucket,
+    compression: Compression = Compression.GZIP,
+    compression_level: int = BACKUP_COMPRESSION_LEVEL
+) -> StreamingResponse:
+    """
+    Returns the tar archive of config folder for backup.
+    The archive is compressed and streamed as it is built.
+    With pgzip compression, blocks of the archive are compressed
+    in parallel into a multi-member gzip stream.
+    """
+    file_list = list_files(
+        config_bucket.directory_path,
+        config_bucket.ignore_patterns,
+        config_bucket.recursive
+    )
+    return StreamingResponse(
+        compress_stream(tar_stream(file_list.items()), compression,
+                        compression_level),
+        media_type="application/x-tar"
+    )
+
+
+@router.post(
+    "/backup/diff",
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"application/x-tar": {}}
+        }
+    },
+    response_class=StreamingResponse
+)
+def get_differential_tar_archive(
+    backup: DifferentialBackup,
+    compression: Compression = Compression.GZIP,
+    compression_level: int = BACKUP_COMPRESSION_LEVEL
+) -> StreamingResponse:
+    """
+    Returns a tar archive of the files which were added or changed
+    since the manifest of a previous backup. Names of files that were
+    deleted since then are listed in the first member of the archive.
+    """
+    file_list = list_files(
+        backup.directory_path,
+        backup.ignore_patterns,
+        backup.recursive
+    )
+    file_hashes = hash_entries(file_list, backup.algorithm.value)
+    changed_files = [
+        (name, entry) for name, entry in file_list.items()
+        if backup.manifest.get(name) != file_hashes[name]
+    ]
+    deleted_files = sorted(set(backup.manifest) - set(file_hashes))
+    return StreamingResponse(
+        compress_stream(tar_stream(changed_files, deleted_files),
+                        compression, compression_level),
+        media_type="application/x-tar"
+    )
+
+
+@router.post(
+    "/restore",
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/x-tar": {}},
+            "required": True
+        }
+    },
+    responses={
+        status.HTTP_400_BAD_REQUEST: {"model": GenericError},
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": GenericError}
+    },
+    response_model=ArchiveRestore
+)
+async def restore_tar_archive(
+    request: Request,
+    directory_path: DirectoryPath,
+    update_command: Optional[str] = None,
+    skip_unchanged: bool = True
+) -> ArchiveRestore:
+    """
+    Restores a bucket from an archive made by /backup or /backup/diff,
+    uncompressed, gzip or pgzip. The archive is extracted as it is
+    uploaded, each file into a temporary file next to its target.
+    The files are then renamed into place together and the update
+    command is run once. If it fails, all the files are put back as
+    they were. Members which are not regular files or lead out of the
+    bucket are refused. With skip_unchanged, files which already have
+    the archived content are left untouched.
+    """
+    try:
+        staged_files, restore = await run_in_threadpool(
+            stage_archive, AsyncStreamReader(request.stream()),
+            str(directory_path), skip_unchanged
+        )
+    except InvalidArchive as invalid_archive:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(invalid_archive)
+        ) from invalid_archive
+    except OSError as os_error:
+        logging.exception("Error restoring an archive to %s", directory_path)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Internal server error"
+        ) from os_error
+    try:
+        await commit_and_update(staged_files, str(directory_path),
+                                update_command)
+    finally:
+        await run_in_threadpool(cleanup, staged_files)
+    return restore
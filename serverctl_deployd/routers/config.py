@@ -2,65 +2,82 @@
 Router for Config routes
 """
 
-import subprocess
-import tarfile
-from fnmatch import fnmatch
-from hashlib import sha256
-from io import BytesIO
-from os import DirEntry, scandir
-from typing import Any, Dict, List, Optional, Set
-
-from fastapi import APIRouter, Body, File, status
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from mimetypes import guess_type
+from typing import Dict, List, Optional, Union
+
+from fastapi import APIRouter, Body, Depends, File, Header, Query, status
 from fastapi.datastructures import UploadFile
 from fastapi.exceptions import HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic.types import DirectoryPath, FilePath
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import Response
 
-from serverctl_deployd.models.config import (ConfigBucket, ListConfigBucket,
+from serverctl_deployd.buckets import (commit_and_update, get_bucket_hashes,
+                                       list_files, run_update_command)
+from serverctl_deployd.conditional import (RangeNotSatisfiable, etag,
+                                           etag_matches, file_range,
+                                           parse_range)
+from serverctl_deployd.config import Settings
+from serverctl_deployd.delta import (MAX_BLOCK_SIZE, InvalidDelta, apply_delta,
+                                     file_signature)
+from serverctl_deployd.dependencies import get_settings
+from serverctl_deployd.hashing import (hash_cache, hash_file, merkle_tree,
+                                       node_digest)
+from serverctl_deployd.jobs import command_runner
+from serverctl_deployd.models.config import (BatchConfigBucket,
+                                             BucketCheckResult, BucketDigest,
+                                             BucketDigestRequest, ConfigBucket,
+                                             FileDelta, FileSignature,
+                                             HashCacheStats, ListConfigBucket,
                                              UpdateCommand)
 from serverctl_deployd.models.exceptions import GenericError
+from serverctl_deployd.models.jobs import Job
+from serverctl_deployd.patterns import ignore_matcher
+from serverctl_deployd.staging import StagedFile, cleanup, commit, stage_upload
+from serverctl_deployd.watcher import bucket_watcher
 
 
-def _list_files(path: DirectoryPath,
-                patterns: Optional[Set[str]]) -> List[DirEntry[str]]:
-    """
-    Get a list of DirEntry objects for a path,
-    to be used by other functions
-    """
-    file_list: List[DirEntry[str]] = []
-    with scandir(path) as listing:
-        for entry in listing:
-            if entry.is_file():
-                if not patterns or not any(
-                    fnmatch(entry.name, pattern)
-                    for pattern in patterns
-                ):
-                    file_list.append(entry)
-    return file_list
+def _check_bucket(index: int,
+                  config_bucket: BatchConfigBucket) -> BucketCheckResult:
+    """Get hashes of a bucket of a batch, capturing any error"""
+    result = BucketCheckResult(
+        index=index,
+        directory_path=str(config_bucket.directory_path),
+        algorithm=config_bucket.algorithm,
+        hashes=None,
+        error=None
+    )
+    try:
+        result.hashes = get_bucket_hashes(
+            config_bucket.directory_path,
+            config_bucket.ignore_patterns,
+            config_bucket.recursive,
+            config_bucket.algorithm
+        )
+    except FileNotFoundError:
+        result.error = "Directory does not exist"
+    except NotADirectoryError:
+        result.error = "Not a directory"
+    except PermissionError:
+        result.error = "Permission denied"
+    except OSError:
+        logging.exception("Error checking %s", config_bucket.directory_path)
+        result.error = "Internal server error"
+    return result
 
 
-def _get_hashes(path: DirectoryPath,
-                patterns: Optional[Set[str]]) -> Dict[str, str]:
-    """
-    Get hashes of files in a directory whose file names do not
-    match the glob patterns
-    """
-    file_hash_list: Dict[str, str] = {}
-    for entry in _list_files(path, patterns):
-        file_hash = sha256()
-        byte_array = bytearray(128 * 1024)
-        memory_view = memoryview(byte_array)
-        with open(entry.path, 'rb', buffering=0) as conf_file:
-            for buffer_size in iter(
-                lambda cf=conf_file, mv=memory_view:  # type: ignore
-                cf.readinto(mv), 0
-            ):
-                file_hash.update(memory_view[:buffer_size])
-        file_hash_str = file_hash.hexdigest()
-        file_hash_list.update({entry.name: file_hash_str})
-    return file_hash_list
+HASH_ALGORITHM_HEADER = "X-Hash-Algorithm"
 
+# Buckets of a batch are checked on their own pool, as their files
+# are hashed on the hashing pool
+check_pool = ThreadPoolExecutor(
+    max_workers=get_settings().batch_check_workers,
+    thread_name_prefix="check"
+)
 
 router = APIRouter(
     prefix="/config/buckets",
@@ -71,98 +88,301 @@ router = APIRouter(
 @router.post(
     "/",
     responses={
+        status.HTTP_202_ACCEPTED: {"model": Job},
         status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": GenericError}
     },
     response_model=Dict[str, str]
 )
-def validate_bucket(config_bucket: ConfigBucket) -> Dict[str, str]:
+async def validate_bucket(
+    config_bucket: ConfigBucket,
+    response: Response,
+    background: bool = False,
+    settings: Settings = Depends(get_settings)
+) -> Union[Dict[str, str], JSONResponse]:
     """
     Checks if the directory path and config updation command are valid.
-    If valid then returns a list of files and its hashes
+    If valid then returns a list of files and its hashes, computed with
+    the algorithm named in the X-Hash-Algorithm header.
+    In background mode the status of the command job is returned instead.
     """
     if config_bucket.update_command:
+        accepted = await run_update_command(
+            config_bucket.update_command,
+            str(config_bucket.directory_path),
+            background
+        )
+        if accepted is not None:
+            return accepted
+    if settings.watch_buckets and not config_bucket.recursive:
         try:
-            subprocess.run(
-                config_bucket.update_command,
-                shell=True,
-                executable="/bin/bash",
-                check=True
-            )
-        except subprocess.SubprocessError as execution_error:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Internal server error"
-            ) from execution_error
-    return _get_hashes(
+            await run_in_threadpool(bucket_watcher.watch,
+                                    str(config_bucket.directory_path))
+        except OSError:
+            logging.exception("Error watching %s",
+                              config_bucket.directory_path)
+    response.headers[HASH_ALGORITHM_HEADER] = config_bucket.algorithm.value
+    return await run_in_threadpool(
+        get_bucket_hashes,
         config_bucket.directory_path,
-        config_bucket.ignore_patterns
+        config_bucket.ignore_patterns,
+        config_bucket.recursive,
+        config_bucket.algorithm
     )
 
 
 @router.post("/files", response_model=List[str])
 def list_filenames(config_bucket: ListConfigBucket) -> List[str]:
     """Return list of file names for a config bucket"""
-    filename_list = [
-        entry.name for entry in _list_files(
-            config_bucket.directory_path,
-            config_bucket.ignore_patterns
+    if not config_bucket.recursive:
+        watched_hashes = bucket_watcher.get_hashes(
+            str(config_bucket.directory_path)
         )
-    ]
+        if watched_hashes is not None:
+            is_ignored = ignore_matcher(config_bucket.ignore_patterns)
+            return [name for name in watched_hashes if not is_ignored(name)]
+    filename_list = list(list_files(
+        config_bucket.directory_path,
+        config_bucket.ignore_patterns,
+        config_bucket.recursive
+    ))
     return filename_list
 
 
 @router.post("/check", response_model=Dict[str, str])
-def get_hashes(config_bucket: ListConfigBucket) -> Dict[str, str]:
+def get_hashes(config_bucket: ListConfigBucket,
+               response: Response) -> Dict[str, str]:
     """
-    Return list of file names for a bucket and their sha256 checksums
-    which will be verified by the serverctl API
+    Return list of file names for a bucket and their checksums
+    which will be verified by the serverctl API. The algorithm
+    is named in the X-Hash-Algorithm header.
     """
-    return _get_hashes(
+    response.headers[HASH_ALGORITHM_HEADER] = config_bucket.algorithm.value
+    return get_bucket_hashes(
         config_bucket.directory_path,
-        config_bucket.ignore_patterns
+        config_bucket.ignore_patterns,
+        config_bucket.recursive,
+        config_bucket.algorithm
     )
 
 
 @router.post(
-    "/backup",
+    "/check/batch",
+    response_model=List[BucketCheckResult],
     responses={
         status.HTTP_200_OK: {
-            "content": {"application/x-tar": {}}
+            "content": {"application/x-ndjson": {}}
         }
+    }
+)
+def get_batch_hashes(
+    config_buckets: List[BatchConfigBucket],
+    stream: bool = False
+) -> Union[List[BucketCheckResult], StreamingResponse]:
+    """
+    Check several buckets concurrently and return the result of
+    each bucket, or the reason it could not be checked.
+    With stream set, results are sent as newline delimited JSON
+    in the order the buckets finish.
+    """
+    futures = [
+        check_pool.submit(_check_bucket, index, config_bucket)
+        for index, config_bucket in enumerate(config_buckets)
+    ]
+    if stream:
+        return StreamingResponse(
+            (future.result().json() + "\n"
+             for future in as_completed(futures)),
+            media_type="application/x-ndjson"
+        )
+    return [future.result() for future in futures]
+
+
+@router.post(
+    "/digest",
+    responses={
+        status.HTTP_404_NOT_FOUND: {"model": GenericError}
     },
-    response_class=Response
+    response_model=BucketDigest,
+    response_model_exclude_none=True
 )
-def get_tar_archive(
-    config_bucket: ListConfigBucket
-) -> Response:
-    """Returns the tar archive of config folder for backup"""
-    file_list = _list_files(
-        config_bucket.directory_path,
-        config_bucket.ignore_patterns
+def get_bucket_digest(digest_request: BucketDigestRequest) -> BucketDigest:
+    """
+    Return the Merkle digest of a bucket, or of a directory or file in it.
+    Comparing root digests tells if anything changed in the bucket, and
+    expanding the nodes whose digests differ finds what changed.
+    """
+    file_hashes = get_bucket_hashes(
+        digest_request.directory_path,
+        digest_request.ignore_patterns,
+        digest_request.recursive,
+        digest_request.algorithm
     )
-    size = sum(entry.stat().st_size for entry in file_list)
-    byte_array = bytearray(size)
-    file_object = BytesIO(byte_array)
-    with tarfile.open(mode="w:gz", fileobj=file_object) as tar_file:
-        for entry in file_list:
-            tar_file.add(entry.path, arcname=entry.name)
-    return Response(
-        content=file_object.getvalue(),
-        media_type="application/x-tar"
+    algorithm = digest_request.algorithm
+    tree = merkle_tree(file_hashes, algorithm.value)
+    path = digest_request.path.strip("/")
+    if path in tree:
+        return BucketDigest(
+            path=path,
+            digest=node_digest(tree[path], algorithm.value),
+            algorithm=algorithm,
+            children=tree[path] if digest_request.expand else None
+        )
+    if path in file_hashes:
+        return BucketDigest(
+            path=path,
+            digest=file_hashes[path],
+            algorithm=algorithm,
+            children=None
+        )
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="Path not found in bucket"
     )
 
 
+@router.post(
+    "/watch",
+    responses={
+        status.HTTP_400_BAD_REQUEST: {"model": GenericError},
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": GenericError}
+    },
+    status_code=status.HTTP_204_NO_CONTENT
+)
+def watch_bucket(config_bucket: ListConfigBucket) -> Response:
+    """
+    Keep a live index of the file hashes of a bucket, updated from
+    inotify events, to answer /check and /files from memory
+    """
+    if config_bucket.recursive:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Recursive buckets can not be watched"
+        )
+    try:
+        bucket_watcher.watch(str(config_bucket.directory_path))
+    except OSError as os_error:
+        logging.exception("Error watching %s", config_bucket.directory_path)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Internal server error"
+        ) from os_error
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.get("/watch", response_model=List[str])
+def get_watched_buckets() -> List[str]:
+    """Return the list of watched bucket directories"""
+    return bucket_watcher.watched()
+
+
+@router.delete(
+    "/watch",
+    responses={
+        status.HTTP_404_NOT_FOUND: {"model": GenericError}
+    },
+    status_code=status.HTTP_204_NO_CONTENT
+)
+def unwatch_bucket(config_bucket: ListConfigBucket) -> Response:
+    """Stop watching a bucket"""
+    if not bucket_watcher.unwatch(str(config_bucket.directory_path)):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Bucket is not watched"
+        )
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@router.get(
+    "/jobs/{job_id}",
+    responses={
+        status.HTTP_404_NOT_FOUND: {"model": GenericError}
+    },
+    response_model=Job
+)
+def get_job(job_id: str) -> Job:
+    """Return the status and output of an update command job"""
+    job = command_runner.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job does not exist"
+        )
+    return job.to_model()
+
+
+@router.get("/cache", response_model=HashCacheStats)
+def get_hash_cache_stats() -> HashCacheStats:
+    """Return hit/miss counters of the file hash cache for monitoring"""
+    return hash_cache.stats()
+
+
+async def _check_if_match(file_path: FilePath,
+                          if_match: Optional[str]) -> None:
+    """Raise an error if a file does not match an If-Match header"""
+    if if_match is None:
+        return
+    file_hash = await run_in_threadpool(hash_file, str(file_path))
+    if not etag_matches(if_match, file_hash):
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="File does not match If-Match"
+        )
+
+
 @router.get(
     "/file", response_class=FileResponse,
     responses={
         status.HTTP_200_OK: {
             "content": {"text/plain": {}}
-        }
+        },
+        status.HTTP_206_PARTIAL_CONTENT: {
+            "content": {"text/plain": {}}
+        },
+        status.HTTP_304_NOT_MODIFIED: {},
+        status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE: {}
     }
 )
-async def get_file(file_path: FilePath) -> FileResponse:
-    """Returns the requested config file"""
-    return FileResponse(file_path)
+async def get_file(
+    file_path: FilePath,
+    if_none_match: Optional[str] = Header(None),
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_range: Optional[str] = Header(None)
+) -> Response:
+    """
+    Returns the requested config file. Its ETag is the sha256 digest
+    of its content, served from the hash cache when the file did not
+    change, so unchanged files can be revalidated with If-None-Match.
+    A single byte range can be requested with the Range header.
+    """
+    file_hash = await run_in_threadpool(hash_file, str(file_path))
+    headers = {"ETag": etag(file_hash), "Accept-Ranges": "bytes"}
+    if if_none_match is not None \
+            and etag_matches(if_none_match, file_hash, weak=True):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers=headers)
+    if range_header is not None and (
+        if_range is None or if_range.strip() == etag(file_hash)
+    ):
+        size = file_path.stat().st_size
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers=headers
+            )
+        if byte_range is not None:
+            first, last = byte_range
+            headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+            headers["Content-Length"] = str(last - first + 1)
+            return StreamingResponse(
+                file_range(str(file_path), first, last),
+                status_code=status.HTTP_206_PARTIAL_CONTENT,
+                media_type=guess_type(file_path)[0] or "text/plain",
+                headers=headers
+            )
+    return FileResponse(file_path, headers=headers)
 
 
 @router.put(
@@ -171,55 +391,234 @@ async def get_file(file_path: FilePath) -> FileResponse:
         status.HTTP_200_OK: {
             "content": {"text/plain": {}}
         },
+        status.HTTP_202_ACCEPTED: {"model": Job},
+        status.HTTP_412_PRECONDITION_FAILED: {"model": GenericError},
         status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": GenericError}
     }
 )
 async def update_file(
     file_path: FilePath,
+    background: bool = False,
+    if_match: Optional[str] = Header(None),
     update_command: str = Body(...),
     new_file: UploadFile = File(...)
-) -> FileResponse:
-    """Updates the requested config file"""
-    new_content: Any = await new_file.read()
-    file_path.write_bytes(new_content)
+) -> Response:
+    """
+    Updates the requested config file. The upload is streamed to a
+    temporary file which then replaces the config file at once, so the
+    file is never seen partly written. The sha256 digest of the new
+    content is returned in the X-File-Hash and ETag headers.
+    With If-Match, the file is only replaced if it still matches.
+    """
+    staged_files = [await stage_upload(new_file, str(file_path))]
     try:
-        subprocess.run(
-            update_command,
-            shell=True,
-            executable="/bin/bash",
-            check=True
-        )
-    except subprocess.SubprocessError as execution_error:
+        await _check_if_match(file_path, if_match)
+        await run_in_threadpool(commit, staged_files)
+    except OSError as os_error:
+        logging.exception("Error updating %s", file_path)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Internal server error"
-        ) from execution_error
-    return FileResponse(file_path)
+        ) from os_error
+    finally:
+        await run_in_threadpool(cleanup, staged_files)
+    file_hash = str(staged_files[0].digest)
+    headers = {"X-File-Hash": file_hash, "ETag": etag(file_hash)}
+    accepted = await run_update_command(
+        update_command, str(file_path.parent), background
+    )
+    if accepted is not None:
+        accepted.headers.update(headers)
+        return accepted
+    return FileResponse(file_path, headers=headers)
 
 
 @router.delete(
     "/file",
     responses={
+        status.HTTP_202_ACCEPTED: {"model": Job},
+        status.HTTP_412_PRECONDITION_FAILED: {"model": GenericError},
         status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": GenericError}
     },
     status_code=status.HTTP_204_NO_CONTENT
 )
-def delete_file(
+async def delete_file(
     file_path: FilePath,
-    update_command: UpdateCommand
+    update_command: UpdateCommand,
+    background: bool = False,
+    if_match: Optional[str] = Header(None)
 ) -> Response:
-    """Deletes the requested config file"""
+    """
+    Deletes the requested config file.
+    With If-Match, the file is only deleted if it still matches.
+    """
+    await _check_if_match(file_path, if_match)
     file_path.unlink()
+    accepted = await run_update_command(
+        update_command.update_command, str(file_path.parent), background
+    )
+    if accepted is not None:
+        return accepted
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+def _parse_expected_hashes(
+    expected_hashes: Optional[str]
+) -> Dict[str, Optional[str]]:
+    """
+    Parse the JSON object of expected file hashes of a batch update,
+    where null means that the file must not exist
+    """
+    if expected_hashes is None:
+        return {}
     try:
-        subprocess.run(
-            update_command.update_command,
-            shell=True,
-            executable="/bin/bash",
-            check=True
+        parsed = json.loads(expected_hashes)
+    except ValueError as value_error:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid expected hashes"
+        ) from value_error
+    if not isinstance(parsed, dict) or not all(
+        file_hash is None or isinstance(file_hash, str)
+        for file_hash in parsed.values()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid expected hashes"
         )
-    except subprocess.SubprocessError as execution_error:
+    return parsed
+
+
+@router.put(
+    "/files",
+    responses={
+        status.HTTP_400_BAD_REQUEST: {"model": GenericError},
+        status.HTTP_412_PRECONDITION_FAILED: {"model": GenericError},
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": GenericError}
+    },
+    response_model=Dict[str, str]
+)
+async def update_files(
+    directory_path: DirectoryPath,
+    update_command: str = Body(...),
+    expected_hashes: Optional[str] = Body(None),
+    files: List[UploadFile] = File(...)
+) -> Dict[str, str]:
+    """
+    Updates several files of a bucket at once. The files are staged
+    next to their targets and renamed into place together, then the
+    update command is run once. If expected hashes are given, nothing
+    is changed unless the current files match them. If the update
+    command fails, all the files are put back as they were.
+    Returns the hashes of the files of the bucket.
+    """
+    names = [upload.filename for upload in files]
+    if len(set(names)) != len(names) or any(
+        not name or "/" in name or name in (".", "..") for name in names
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid file names"
+        )
+    for name in names:
+        if (directory_path / name).is_dir():
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{name} is a directory"
+            )
+    expected = _parse_expected_hashes(expected_hashes)
+
+    staged_files: List[StagedFile] = []
+    try:
+        for upload in files:
+            staged_files.append(await stage_upload(
+                upload, str(directory_path / upload.filename)
+            ))
+        current_hashes = await run_in_threadpool(
+            get_bucket_hashes, directory_path, None
+        )
+        if any(current_hashes.get(name) != file_hash
+               for name, file_hash in expected.items()):
+            raise HTTPException(
+                status_code=status.HTTP_412_PRECONDITION_FAILED,
+                detail="Files do not match the expected hashes"
+            )
+        await commit_and_update(staged_files, str(directory_path),
+                                update_command)
+    finally:
+        await run_in_threadpool(cleanup, staged_files)
+    return await run_in_threadpool(get_bucket_hashes, directory_path, None)
+
+
+@router.get(
+    "/file/signature",
+    response_model=FileSignature
+)
+def get_file_signature(
+    file_path: FilePath,
+    block_size: Optional[int] = Query(None, gt=0, le=MAX_BLOCK_SIZE)
+) -> FileSignature:
+    """
+    Returns the rolling and strong checksums of the blocks of a config
+    file, from which a client computes a delta of its new version
+    """
+    return file_signature(str(file_path), block_size)
+
+
+@router.patch(
+    "/file",
+    responses={
+        status.HTTP_202_ACCEPTED: {"model": Job},
+        status.HTTP_400_BAD_REQUEST: {"model": GenericError},
+        status.HTTP_412_PRECONDITION_FAILED: {"model": GenericError},
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": GenericError}
+    },
+    status_code=status.HTTP_204_NO_CONTENT
+)
+async def patch_file(
+    file_path: FilePath,
+    delta: FileDelta,
+    background: bool = False
+) -> Response:
+    """
+    Updates the requested config file from a delta of copy and insert
+    instructions against the blocks of its signature, so that only the
+    changed parts of a large file are uploaded. The file is rebuilt in
+    a temporary file which then replaces it at once.
+    The sha256 digest of the new content is returned in the X-File-Hash
+    and ETag headers.
+    """
+    current_hash = await run_in_threadpool(hash_file, str(file_path))
+    if current_hash != delta.base_hash:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="File does not match the base hash"
+        )
+    try:
+        staged_files = [
+            await run_in_threadpool(apply_delta, str(file_path), delta)
+        ]
+    except InvalidDelta as invalid_delta:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(invalid_delta)
+        ) from invalid_delta
+    try:
+        await run_in_threadpool(commit, staged_files)
+    except OSError as os_error:
+        logging.exception("Error updating %s", file_path)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Internal server error"
-        ) from execution_error
-    return Response(status_code=status.HTTP_204_NO_CONTENT)
+        ) from os_error
+    finally:
+        await run_in_threadpool(cleanup, staged_files)
+    file_hash = str(staged_files[0].digest)
+    headers = {"X-File-Hash": file_hash, "ETag": etag(file_hash)}
+    accepted = await run_update_command(
+        delta.update_command, str(file_path.parent), background
+    )
+    if accepted is not None:
+        accepted.headers.update(headers)
+        return accepted
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=headers)
@@ -2,43 +2,106 @@
 Router for Deployment routes
 """
 
-import json
+import asyncio
+import re
 import shlex
-import subprocess
-from os import path, scandir
+from fnmatch import fnmatchcase
+from os import path
+from pathlib import Path
 from shutil import rmtree
-from typing import Any, Dict, Set
+from typing import AsyncIterator, Dict, List, Optional
 
-from fastapi import APIRouter, Depends, status
-from fastapi.encoders import jsonable_encoder
+from fastapi import APIRouter, Depends, Query, status
 from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import Response
 
+from serverctl_deployd.bulk import (DependencyCycle, bulk_scheduler,
+                                    prerequisites)
 from serverctl_deployd.config import Settings
-from serverctl_deployd.dependencies import get_settings
-from serverctl_deployd.models.deployments import (DBConfig, Deployment,
-                                                  UpdateDeployment)
+from serverctl_deployd.dependencies import (get_deployment_registry,
+                                            get_deployment_store, get_settings)
+from serverctl_deployd.jobs import (CommandJob, OutputSubscription,
+                                    compose_runner)
+from serverctl_deployd.models.deployments import (BulkOperation, BulkResult,
+                                                  ComposeAction, DBConfig,
+                                                  Deployment, UpdateDeployment)
 from serverctl_deployd.models.exceptions import GenericError
+from serverctl_deployd.models.jobs import Job, JobStats
+from serverctl_deployd.registry import DeploymentRegistry
+from serverctl_deployd.store import DeploymentExists, DeploymentStore
 
 
-def _merge_dicts(
-    current: Dict[Any, Any],
-    update: Dict[Any, Any]
-) -> Dict[Any, Any]:
+def _compose_command(deployment_path: Path, action: ComposeAction,
+                     settings: Settings) -> str:
+    """Return the docker-compose command of an action on a deployment"""
+    compose = f"{settings.compose_command} -f " \
+        + shlex.quote(path.join(deployment_path, "docker-compose.yml"))
+    if action == ComposeAction.UP:
+        return f"{compose} up -d"
+    if action == ComposeAction.DOWN:
+        return f"{compose} down"
+    return f"{compose} down && {compose} up -d"
+
+
+async def _submit_compose(name: str, action: ComposeAction,
+                          settings: Settings,
+                          registry: DeploymentRegistry) -> str:
+    """
+    Submit a docker-compose command for a deployment to the compose
+    runner and return the ID of its job. Commands of one deployment
+    run one at a time, in the order they were submitted.
+    """
+    if not await run_in_threadpool(registry.exists, name):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Deployment does not exist"
+        )
+    deployment_path = settings.deployments_dir.joinpath(name)
+    job = compose_runner.submit(
+        _compose_command(deployment_path, action, settings),
+        key=path.realpath(deployment_path)
+    )
+    return job.id
+
+
+# Seconds after which an idle event stream gets a comment,
+# so that proxies do not close it during long silent steps
+EVENT_STREAM_KEEPALIVE = 15.0
+# Line separators of the event stream format
+_EVENT_LINE_SEPARATOR = re.compile(r"\r\n|\r|\n")
+
+
+def _event(event: str, data: str) -> str:
+    """Format a server-sent event"""
+    lines = _EVENT_LINE_SEPARATOR.split(data)
+    return f"event: {event}\n" \
+        + "".join(f"data: {line}\n" for line in lines) + "\n"
+
+
+async def _job_events(job: CommandJob,
+                      subscription: OutputSubscription) -> AsyncIterator[str]:
     """
-    Merges two dicts: update into current.
-    Used for update_deployment()
+    Yield the output of a job as server-sent events as it is produced,
+    then the final status of the job in an "end" event
     """
-    for key in update:
-        if key in current:
-            if isinstance(current[key], dict) and isinstance(
-                    update[key], dict):
-                _merge_dicts(current[key], update[key])
-            elif update[key] and current[key] != update[key]:
-                current[key] = update[key]
-    return current
+    try:
+        async for line in subscription.lines(EVENT_STREAM_KEEPALIVE):
+            if line is None:
+                yield ": keepalive\n\n"
+            else:
+                yield _event(line.stream, line.text)
+        yield _event("end", job.to_model().json())
+    finally:
+        job.unsubscribe(subscription)
 
 
+JOB_WAIT = Query(
+    0, ge=0, le=600,
+    title="Seconds to wait for the job to finish before returning"
+)
+
 router: APIRouter = APIRouter(
     prefix="/deployments",
     tags=["deployments"]
@@ -54,17 +117,25 @@ router: APIRouter = APIRouter(
 )
 def create_deployment(
     deployment: Deployment,
-    settings: Settings = Depends(get_settings)
+    settings: Settings = Depends(get_settings),
+    store: DeploymentStore = Depends(get_deployment_store),
+    registry: DeploymentRegistry = Depends(get_deployment_registry)
 ) -> Deployment:
     """Create a deployment"""
     deployment_path = settings.deployments_dir.joinpath(deployment.name)
     try:
-        deployment_path.mkdir(parents=True)
-    except FileExistsError as dir_exists_error:
+        store.create(deployment.name, deployment.databases or {})
+        try:
+            deployment_path.mkdir(parents=True)
+        except FileExistsError:
+            store.delete(deployment.name)
+            raise
+    except (DeploymentExists, FileExistsError) as exists_error:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="A deployment with same name already exists"
-        ) from dir_exists_error
+        ) from exists_error
+    registry.add(deployment.name)
 
     compose_path = deployment_path.joinpath("docker-compose.yml")
     compose_path.write_text(deployment.compose_file,
@@ -75,28 +146,184 @@ def create_deployment(
         env_path.write_text(deployment.env_file,
                             encoding="utf-8")
 
-    if deployment.databases:
-        db_file = deployment_path.joinpath("databases.json")
-        db_file.touch()
+    return deployment
 
-        with open(db_file, "w", encoding="utf-8") as json_file:
-            db_json = jsonable_encoder(deployment.databases)
-            json.dump(db_json, json_file, indent=4)
 
-    return deployment
+@router.get("/jobs/stats", response_model=JobStats)
+def get_job_stats() -> JobStats:
+    """Return the number of docker-compose jobs and their durations"""
+    return compose_runner.stats()
+
+
+@router.get(
+    "/jobs/{job_id}",
+    responses={
+        status.HTTP_404_NOT_FOUND: {"model": GenericError}
+    },
+    response_model=Job
+)
+async def get_job(
+    job_id: str,
+    wait: float = JOB_WAIT
+) -> Job:
+    """
+    Return the status and output of a docker-compose job.
+    With wait, the response is held until the job finishes or the
+    wait is over, so that callers need not poll.
+    """
+    job = compose_runner.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job does not exist"
+        )
+    if wait > 0:
+        try:
+            await asyncio.wait_for(job.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+    return job.to_model()
+
+
+@router.get(
+    "/jobs/{job_id}/events",
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"text/event-stream": {}}
+        },
+        status.HTTP_404_NOT_FOUND: {"model": GenericError}
+    },
+    response_class=StreamingResponse
+)
+async def get_job_events(job_id: str) -> StreamingResponse:
+    """
+    Stream the output of a docker-compose job as server-sent events.
+    Each line is sent as it is produced, in a "stdout" or "stderr"
+    event, starting with the recent lines of a running job. A viewer
+    which falls behind skips the oldest lines, and gets a "dropped"
+    event with their number. The stream ends with an "end" event
+    holding the status of the job.
+    """
+    job = compose_runner.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job does not exist"
+        )
+    return StreamingResponse(
+        _job_events(job, job.subscribe()),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post(
+    "/bulk",
+    responses={
+        status.HTTP_400_BAD_REQUEST: {"model": GenericError},
+        status.HTTP_404_NOT_FOUND: {"model": GenericError}
+    },
+    response_model=BulkResult
+)
+async def bulk_operation(
+    operation: BulkOperation,
+    wait: float = JOB_WAIT,
+    settings: Settings = Depends(get_settings),
+    registry: DeploymentRegistry = Depends(get_deployment_registry)
+) -> BulkResult:
+    """
+    Run docker-compose up, down or restart on the named deployments
+    and those matching the selector. The deployments run concurrently
+    on the docker-compose pool, each after its dependencies for up and
+    restart, or after the deployments depending on it for down.
+    Returns the status of the operation per deployment, which is also
+    returned by /deployments/bulk/{bulk_id}.
+    """
+    if operation.names is None and operation.selector is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Either names or a selector is required"
+        )
+    deployments = await run_in_threadpool(registry.names)
+    names = list(dict.fromkeys(operation.names or []))
+    selected = set(names)
+    if not selected.issubset(deployments):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Deployment does not exist"
+        )
+    if operation.selector is not None:
+        names.extend(
+            name for name in deployments
+            if name not in selected and fnmatchcase(name, operation.selector)
+        )
+    try:
+        waits = prerequisites(names, operation.dependencies,
+                              reverse=operation.action == ComposeAction.DOWN)
+    except DependencyCycle as dependency_cycle:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(dependency_cycle)
+        ) from dependency_cycle
+
+    deployment_paths = {
+        name: settings.deployments_dir.joinpath(name) for name in names
+    }
+    run = bulk_scheduler.submit(
+        operation.action,
+        {
+            name: _compose_command(deployment_path, operation.action,
+                                   settings)
+            for name, deployment_path in deployment_paths.items()
+        },
+        {
+            name: path.realpath(deployment_path)
+            for name, deployment_path in deployment_paths.items()
+        },
+        waits
+    )
+    if wait > 0:
+        await run.wait(wait)
+    return run.to_model()
+
+
+@router.get(
+    "/bulk/{bulk_id}",
+    responses={
+        status.HTTP_404_NOT_FOUND: {"model": GenericError}
+    },
+    response_model=BulkResult
+)
+async def get_bulk_operation(
+    bulk_id: str,
+    wait: float = JOB_WAIT
+) -> BulkResult:
+    """Return the status of a bulk operation per deployment"""
+    run = bulk_scheduler.get(bulk_id)
+    if run is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Bulk operation does not exist"
+        )
+    if wait > 0:
+        await run.wait(wait)
+    return run.to_model()
 
 
-@router.get("/", response_model=Set[str])
+@router.get("/", response_model=List[str])
 def get_deployments(
-    settings: Settings = Depends(get_settings)
-) -> Set[str]:
-    """Get a list of all deployments"""
-    deployments: Set[str] = set()
-    if settings.deployments_dir.exists():
-        deployments.update(
-            item.name for item in scandir(settings.deployments_dir)
-            if item.is_dir())
-    return deployments
+    prefix: str = Query("", title="Prefix of the deployment names"),
+    offset: int = Query(0, ge=0, title="Number of deployments to skip"),
+    limit: Optional[int] = Query(
+        None, ge=1, title="Maximum number of deployments to return"
+    ),
+    registry: DeploymentRegistry = Depends(get_deployment_registry)
+) -> List[str]:
+    """
+    Get the sorted list of deployments, optionally only those whose
+    name starts with prefix, a page at a time with offset and limit
+    """
+    return registry.names(prefix, offset, limit)
 
 
 @router.get(
@@ -108,21 +335,16 @@ def get_deployments(
 )
 def get_deployment(
     name: str,
-    settings: Settings = Depends(get_settings)
+    store: DeploymentStore = Depends(get_deployment_store)
 ) -> Dict[str, DBConfig]:
     """Get database details of a deployment"""
-    deployment_path = settings.deployments_dir.joinpath(name)
-    if not deployment_path.exists():
+    databases = store.get_databases(name)
+    if databases is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Deployment does not exist"
         )
-    db_file = deployment_path.joinpath("databases.json")
-    json_data: Dict[str, DBConfig] = {}
-    if db_file.exists():
-        with open(db_file, "r", encoding="utf-8") as json_file:
-            json_data = json.load(json_file)
-    return json_data
+    return databases
 
 
 @ router.patch(
@@ -135,15 +357,20 @@ def get_deployment(
 def update_deployment(
     name: str,
     update: UpdateDeployment,
-    settings: Settings = Depends(get_settings)
+    settings: Settings = Depends(get_settings),
+    store: DeploymentStore = Depends(get_deployment_store)
 ) -> Response:
-    """Update a deployment"""
-    deployment_path = settings.deployments_dir.joinpath(name)
-    if not deployment_path.exists():
+    """
+    Update a deployment. Only the database configs which the deployment
+    already has are updated, each field in one transaction, so that
+    concurrent updates do not overwrite each other.
+    """
+    if not store.update(name, update.databases):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Deployment does not exist"
         )
+    deployment_path = settings.deployments_dir.joinpath(name)
 
     if update.compose_file:
         compose_path = deployment_path.joinpath("docker-compose.yml")
@@ -155,19 +382,6 @@ def update_deployment(
         env_path.write_text(update.env_file,
                             encoding="utf-8")
 
-    if update.databases:
-        db_file = deployment_path.joinpath("databases.json")
-        db_file.touch()
-
-        with open(db_file, "r+", encoding="utf-8") as json_file:
-            current_details = json.load(json_file)
-            update_json = jsonable_encoder(update.databases)
-            updated_details = _merge_dicts(current_details,
-                                           update_json)
-            json_file.seek(0)
-            json.dump(updated_details, json_file, indent=4)
-            json_file.truncate()
-
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -180,83 +394,60 @@ def update_deployment(
 )
 def delete_deployment(
     name: str,
-    settings: Settings = Depends(get_settings)
+    settings: Settings = Depends(get_settings),
+    store: DeploymentStore = Depends(get_deployment_store),
+    registry: DeploymentRegistry = Depends(get_deployment_registry)
 ) -> Response:
     """Delete a deployment"""
-    deployment_path = settings.deployments_dir.joinpath(name)
-    if not deployment_path.exists():
+    if not store.delete(name):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Deployment does not exist"
         )
-    rmtree(deployment_path)
+    registry.discard(name)
+    deployment_path = settings.deployments_dir.joinpath(name)
+    if deployment_path.exists():
+        rmtree(deployment_path)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 @ router.post(
     "/{name}/up",
     responses={
-        status.HTTP_404_NOT_FOUND: {"model": GenericError},
-        status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": GenericError}
+        status.HTTP_404_NOT_FOUND: {"model": GenericError}
     },
     response_model=Dict[str, str]
 )
-def compose_up(
+async def compose_up(
     name: str,
-    settings: Settings = Depends(get_settings)
+    settings: Settings = Depends(get_settings),
+    registry: DeploymentRegistry = Depends(get_deployment_registry)
 ) -> Dict[str, str]:
-    """docker-compose up"""
-    deployment_path = settings.deployments_dir.joinpath(name)
-    if not deployment_path.exists():
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Deployment does not exist"
-        )
-    compose_path = path.join(deployment_path, "docker-compose.yml")
-    try:
-        subprocess.Popen(  # pylint: disable=consider-using-with
-            f"docker-compose -f {shlex.quote(compose_path)} up -d &",
-            shell=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-    except OSError as os_error:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Internal server error"
-        ) from os_error
-    return {"message": "docker-compose up executed"}
+    """
+    docker-compose up, run in the background.
+    The status of the command is returned by /deployments/jobs/{job_id}.
+    """
+    job_id = await _submit_compose(name, ComposeAction.UP, settings,
+                                   registry)
+    return {"message": "docker-compose up executed", "job_id": job_id}
 
 
 @ router.post(
     "/{name}/down",
     responses={
-        status.HTTP_404_NOT_FOUND: {"model": GenericError},
-        status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": GenericError}
-    }
+        status.HTTP_404_NOT_FOUND: {"model": GenericError}
+    },
+    response_model=Dict[str, str]
 )
-def compose_down(
+async def compose_down(
     name: str,
-    settings: Settings = Depends(get_settings)
+    settings: Settings = Depends(get_settings),
+    registry: DeploymentRegistry = Depends(get_deployment_registry)
 ) -> Dict[str, str]:
-    """docker-compose down"""
-    deployment_path = settings.deployments_dir.joinpath(name)
-    if not deployment_path.exists():
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Deployment does not exist"
-        )
-    compose_path = path.join(deployment_path, "docker-compose.yml")
-    try:
-        subprocess.Popen(  # pylint: disable=consider-using-with
-            f"docker-compose -f {shlex.quote(compose_path)} down &",
-            shell=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-    except OSError as os_error:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Internal server error"
-        ) from os_error
-    return {"message": "docker-compose down executed"}
+    """
+    docker-compose down, run in the background.
+    The status of the command is returned by /deployments/jobs/{job_id}.
+    """
+    job_id = await _submit_compose(name, ComposeAction.DOWN, settings,
+                                   registry)
+    return {"message": "docker-compose down executed", "job_id": job_id}
@@ -0,0 +1,195 @@
+"""
+Router for the snapshot routes of config buckets
+"""
+
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Depends, status
+from fastapi.exceptions import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from serverctl_deployd.buckets import commit_and_update, get_bucket_hashes
+from serverctl_deployd.config import Settings
+from serverctl_deployd.dependencies import get_settings
+from serverctl_deployd.models.config import ListConfigBucket
+from serverctl_deployd.models.exceptions import GenericError
+from serverctl_deployd.models.snapshots import (Snapshot, SnapshotDiff,
+                                                SnapshotInfo, SnapshotRestore)
+from serverctl_deployd.snapshots import SnapshotStore, diff_files
+from serverctl_deployd.staging import (StagedFile, cleanup, stage_copy,
+                                       stage_deletion)
+
+router = APIRouter(
+    prefix="/config/buckets",
+    tags=["config"]
+)
+
+
+@router.post("/snapshots", response_model=SnapshotInfo)
+async def create_snapshot(
+    config_bucket: ListConfigBucket,
+    settings: Settings = Depends(get_settings)
+) -> SnapshotInfo:
+    """
+    Take a snapshot of a bucket in the snapshot store. Files are
+    stored once per checksum, so snapshots of unchanged files only
+    cost the manifest.
+    """
+    snapshot_store = SnapshotStore(settings.snapshots_dir)
+    file_hashes = await run_in_threadpool(
+        get_bucket_hashes,
+        config_bucket.directory_path,
+        config_bucket.ignore_patterns,
+        config_bucket.recursive
+    )
+    snapshot = await run_in_threadpool(
+        snapshot_store.create,
+        config_bucket.directory_path,
+        config_bucket.ignore_patterns,
+        config_bucket.recursive,
+        file_hashes
+    )
+    return snapshot.info()
+
+
+@router.get("/snapshots", response_model=List[SnapshotInfo])
+def list_snapshots(
+    directory_path: Optional[Path] = None,
+    settings: Settings = Depends(get_settings)
+) -> List[SnapshotInfo]:
+    """Return the snapshots in the store, optionally those of one bucket"""
+    return SnapshotStore(settings.snapshots_dir).list(directory_path)
+
+
+def _get_snapshot(snapshot_store: SnapshotStore,
+                  snapshot_id: str) -> Snapshot:
+    """Get a snapshot from the store or raise a 404 error"""
+    snapshot = snapshot_store.get(snapshot_id)
+    if snapshot is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Snapshot does not exist"
+        )
+    return snapshot
+
+
+def _get_snapshot_bucket_hashes(snapshot: Snapshot,
+                                missing_ok: bool = False) -> Dict[str, str]:
+    """
+    Get the current hashes of the bucket of a snapshot. With missing_ok,
+    a bucket directory which does not exist has no files.
+    """
+    try:
+        return get_bucket_hashes(
+            Path(snapshot.directory_path),
+            snapshot.ignore_patterns,
+            snapshot.recursive
+        )
+    except FileNotFoundError as not_found_error:
+        if missing_ok:
+            return {}
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Directory does not exist"
+        ) from not_found_error
+
+
+@router.get(
+    "/snapshots/{snapshot_id}",
+    responses={
+        status.HTTP_404_NOT_FOUND: {"model": GenericError}
+    },
+    response_model=Snapshot
+)
+def get_snapshot(
+    snapshot_id: str,
+    settings: Settings = Depends(get_settings)
+) -> Snapshot:
+    """Return the manifest of a snapshot"""
+    return _get_snapshot(SnapshotStore(settings.snapshots_dir), snapshot_id)
+
+
+@router.get(
+    "/snapshots/{snapshot_id}/diff",
+    responses={
+        status.HTTP_404_NOT_FOUND: {"model": GenericError}
+    },
+    response_model=SnapshotDiff
+)
+def diff_snapshot(
+    snapshot_id: str,
+    against: Optional[str] = None,
+    settings: Settings = Depends(get_settings)
+) -> SnapshotDiff:
+    """
+    Return the files which were added, removed or changed since a
+    snapshot, either in another snapshot or in the current bucket
+    """
+    snapshot_store = SnapshotStore(settings.snapshots_dir)
+    snapshot = _get_snapshot(snapshot_store, snapshot_id)
+    if against is None:
+        return diff_files(snapshot.files,
+                          _get_snapshot_bucket_hashes(snapshot))
+    return diff_files(snapshot.files,
+                      _get_snapshot(snapshot_store, against).files)
+
+
+@router.post(
+    "/snapshots/{snapshot_id}/restore",
+    responses={
+        status.HTTP_404_NOT_FOUND: {"model": GenericError},
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {"model": GenericError}
+    },
+    response_model=Dict[str, str]
+)
+async def restore_snapshot(
+    snapshot_id: str,
+    restore: SnapshotRestore,
+    settings: Settings = Depends(get_settings)
+) -> Dict[str, str]:
+    """
+    Restore the files of a bucket from a snapshot. Only the files that
+    differ from the snapshot are written, and with prune set the files
+    added since the snapshot are deleted. The files are replaced
+    together and the update command is run once. If it fails, all the
+    files are put back as they were. A bucket directory which was
+    removed is created again.
+    Returns the hashes of the files of the bucket.
+    """
+    snapshot_store = SnapshotStore(settings.snapshots_dir)
+    snapshot = _get_snapshot(snapshot_store, snapshot_id)
+    directory_path = Path(snapshot.directory_path)
+    # The directory of a removed bucket is created again while staging
+    current_hashes = await run_in_threadpool(
+        _get_snapshot_bucket_hashes, snapshot, True
+    )
+    diff = diff_files(current_hashes, snapshot.files)
+
+    staged_files: List[StagedFile] = []
+    try:
+        try:
+            for name in diff.added + diff.changed:
+                staged_files.append(await run_in_threadpool(
+                    stage_copy,
+                    str(snapshot_store.blob_path(snapshot.files[name])),
+                    str(directory_path / name)
+                ))
+            if restore.prune:
+                staged_files.extend(
+                    stage_deletion(str(directory_path / name))
+                    for name in diff.removed
+                )
+        except OSError as os_error:
+            logging.exception("Error restoring snapshot %s", snapshot_id)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Internal server error"
+            ) from os_error
+        await commit_and_update(staged_files, str(directory_path),
+                                restore.update_command)
+    finally:
+        await run_in_threadpool(cleanup, staged_files)
+    return await run_in_threadpool(_get_snapshot_bucket_hashes, snapshot,
+                                   True)
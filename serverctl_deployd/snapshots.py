@@ -0,0 +1,135 @@
+"""
+Content addressed store of config bucket snapshots
+"""
+
+import os
+import re
+import tempfile
+from datetime import datetime, timezone
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+from uuid import uuid4
+
+from serverctl_deployd.models.snapshots import (Snapshot, SnapshotDiff,
+                                                SnapshotInfo)
+
+CHUNK_SIZE = 128 * 1024
+
+_SNAPSHOT_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def diff_files(old: Dict[str, str], new: Dict[str, str]) -> SnapshotDiff:
+    """Compare two {name: hash} mappings of a bucket"""
+    return SnapshotDiff(
+        added=sorted(set(new) - set(old)),
+        removed=sorted(set(old) - set(new)),
+        changed=sorted(
+            name for name in set(old) & set(new) if old[name] != new[name]
+        )
+    )
+
+
+class SnapshotStore:
+    """
+    Snapshots of config buckets stored on disk. Each snapshot is a JSON
+    manifest of the sha256 checksums of the files of a bucket, and the
+    content of a file is stored once per checksum under blobs/, so
+    unchanged files cost nothing in later snapshots.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.blobs_dir = root / "blobs"
+        self.manifests_dir = root / "manifests"
+
+    def blob_path(self, file_hash: str) -> Path:
+        """Return the path of the blob of a checksum"""
+        return self.blobs_dir / file_hash[:2] / file_hash
+
+    def _store_blob(self, file_path: str, file_hash: str) -> str:
+        """
+        Copy a file into the store unless its blob already exists.
+        Returns the checksum of the stored content, which differs from
+        the given one if the file changed after it was hashed.
+        """
+        if self.blob_path(file_hash).exists():
+            return file_hash
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(
+            dir=self.blobs_dir, suffix=".tmp"
+        )
+        try:
+            content_hash = sha256()
+            with open(file_path, "rb") as conf_file, \
+                    os.fdopen(file_descriptor, "wb") as blob_file:
+                for chunk in iter(lambda: conf_file.read(CHUNK_SIZE), b""):
+                    content_hash.update(chunk)
+                    blob_file.write(chunk)
+                blob_file.flush()
+                os.fsync(blob_file.fileno())
+            stored_hash = content_hash.hexdigest()
+            blob_path = self.blob_path(stored_hash)
+            blob_path.parent.mkdir(exist_ok=True)
+            os.replace(temp_path, blob_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return stored_hash
+
+    def create(self, directory_path: Path,
+               ignore_patterns: Optional[Set[str]], recursive: bool,
+               file_hashes: Dict[str, str]) -> Snapshot:
+        """
+        Take a snapshot of a bucket from the checksums of its files,
+        storing the content of the files which are not stored yet
+        """
+        files = {
+            name: self._store_blob(str(directory_path / name), file_hash)
+            for name, file_hash in file_hashes.items()
+        }
+        snapshot = Snapshot(
+            id=uuid4().hex,
+            directory_path=str(directory_path),
+            ignore_patterns=ignore_patterns,
+            recursive=recursive,
+            created_at=datetime.now(timezone.utc),
+            files=files
+        )
+        self.manifests_dir.mkdir(parents=True, exist_ok=True)
+        manifest_path = self.manifests_dir / f"{snapshot.id}.json"
+        temp_path = manifest_path.with_suffix(".tmp")
+        temp_path.write_text(snapshot.json(), encoding="utf-8")
+        os.replace(temp_path, manifest_path)
+        return snapshot
+
+    def get(self, snapshot_id: str) -> Optional[Snapshot]:
+        """Return a snapshot, or None if it does not exist"""
+        if _SNAPSHOT_ID.fullmatch(snapshot_id) is None:
+            return None
+        try:
+            return Snapshot.parse_file(
+                self.manifests_dir / f"{snapshot_id}.json"
+            )
+        except FileNotFoundError:
+            return None
+
+    def list(self, directory_path: Optional[Path] = None
+             ) -> List[SnapshotInfo]:
+        """
+        Return the summaries of the snapshots, oldest first,
+        optionally only those of one bucket
+        """
+        if not self.manifests_dir.is_dir():
+            return []
+        snapshots = [
+            Snapshot.parse_file(manifest_path)
+            for manifest_path in self.manifests_dir.glob("*.json")
+        ]
+        if directory_path is not None:
+            snapshots = [
+                snapshot for snapshot in snapshots
+                if Path(snapshot.directory_path) == directory_path
+            ]
+        snapshots.sort(key=lambda snapshot: snapshot.created_at)
+        return [snapshot.info() for snapshot in snapshots]
@@ -0,0 +1,202 @@
+"""
+Atomic updates of config files through staged temporary files
+"""
+
+import logging
+import os
+import tempfile
+from dataclasses import dataclass
+from hashlib import sha256
+from typing import Any, Iterable, List, Optional
+from uuid import uuid4
+
+import aiofiles
+from fastapi.datastructures import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from serverctl_deployd.hashing import cache_hash
+
+UPLOAD_CHUNK_SIZE = 128 * 1024
+DEFAULT_FILE_MODE = 0o644
+
+
+@dataclass
+class StagedFile:
+    """
+    A temporary file waiting to replace its target,
+    or a deletion of the target if there is no staged file
+    """
+    target: str
+    staged: Optional[str]
+    digest: Optional[str] = None
+    backup: Optional[str] = None
+    replaced: bool = False
+
+
+def _staged_path(target: str) -> str:
+    """
+    Create an empty temporary file in the directory of the target,
+    with the permissions and the ownership of the target if it exists
+    """
+    directory, name = os.path.split(target)
+    file_descriptor, staged = tempfile.mkstemp(
+        dir=directory or ".", prefix=f".{name}.", suffix=".tmp"
+    )
+    os.close(file_descriptor)
+    try:
+        target_stat = os.stat(target)
+    except FileNotFoundError:
+        os.chmod(staged, DEFAULT_FILE_MODE)
+        return staged
+    try:
+        os.chown(staged, target_stat.st_uid, target_stat.st_gid)
+    except PermissionError:
+        logging.warning("Could not keep the owner of %s", target)
+    # chown() clears the setuid and setgid bits, the mode comes after
+    os.chmod(staged, target_stat.st_mode)
+    return staged
+
+
+def stage_deletion(target: str) -> StagedFile:
+    """Stage the deletion of a file, or of the symbolic link itself"""
+    return StagedFile(target=target, staged=None)
+
+
+def stage_chunks(chunks: Iterable[bytes], target: str) -> StagedFile:
+    """
+    Write a stream of bytes to a temporary file next to its target,
+    computing its sha256 digest on the way, and creating the directory
+    of the target if needed. The file is synced to disk so that it can
+    be renamed over the target. The temporary file is removed if the
+    stream fails. A symbolic link target is resolved, so that the file
+    it points to is replaced and the link is kept.
+    """
+    target = os.path.realpath(target)
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    staged = _staged_path(target)
+    file_hash = sha256()
+    try:
+        with open(staged, "wb") as staged_file:
+            for chunk in chunks:
+                file_hash.update(chunk)
+                staged_file.write(chunk)
+            staged_file.flush()
+            os.fsync(staged_file.fileno())
+    except BaseException:
+        os.unlink(staged)
+        raise
+    return StagedFile(target=target, staged=staged,
+                      digest=file_hash.hexdigest())
+
+
+def stage_copy(source: str, target: str) -> StagedFile:
+    """Copy a file to a temporary file next to its target"""
+    with open(source, "rb") as source_file:
+        return stage_chunks(
+            iter(lambda: source_file.read(UPLOAD_CHUNK_SIZE), b""), target
+        )
+
+
+async def stage_upload(upload: UploadFile, target: str) -> StagedFile:
+    """
+    Stream an upload in chunks to a temporary file next to its target,
+    computing its sha256 digest on the way. The file is synced to disk
+    so that it can be renamed over the target. The temporary file is
+    removed if the upload can not be written. A symbolic link target
+    is resolved, so that the file it points to is replaced and the link
+    is kept.
+    """
+    target = os.path.realpath(target)
+    staged_path = await run_in_threadpool(_staged_path, target)
+    file_hash = sha256()
+    try:
+        async with aiofiles.open(staged_path, "wb") as staged:
+            while True:
+                chunk: Any = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_hash.update(chunk)
+                await staged.write(chunk)
+            await staged.flush()
+            await run_in_threadpool(os.fsync, staged.fileno())
+    except BaseException:
+        os.unlink(staged_path)
+        raise
+    return StagedFile(target=target, staged=staged_path,
+                      digest=file_hash.hexdigest())
+
+
+def _sync_directory(directory: str) -> None:
+    """Flush the entries of a directory, making renames in it durable"""
+    directory_fd = os.open(directory or ".", os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def commit(staged_files: List[StagedFile]) -> None:
+    """
+    Rename staged files over their targets, and delete the targets of
+    staged deletions. Replaced and deleted targets are kept as hard
+    links so that they can be restored by rollback().
+    If a rename fails, the files already replaced are rolled back.
+    Digests computed while staging are stored in the hash cache.
+    """
+    try:
+        for staged_file in staged_files:
+            exists = os.path.lexists(staged_file.target)
+            if staged_file.staged is None and not exists:
+                continue
+            if exists:
+                directory, name = os.path.split(staged_file.target)
+                backup = os.path.join(directory,
+                                      f".{name}.{uuid4().hex}.bak")
+                os.link(staged_file.target, backup,
+                        follow_symlinks=False)
+                staged_file.backup = backup
+            if staged_file.staged is None:
+                os.unlink(staged_file.target)
+            else:
+                os.replace(staged_file.staged, staged_file.target)
+            staged_file.replaced = True
+        for directory in {os.path.dirname(staged_file.target)
+                          for staged_file in staged_files}:
+            _sync_directory(directory)
+    except OSError:
+        rollback(staged_files)
+        raise
+    for staged_file in staged_files:
+        if staged_file.digest is not None:
+            cache_hash(staged_file.target, staged_file.digest)
+
+
+def rollback(staged_files: List[StagedFile]) -> None:
+    """Put back the files replaced or deleted by commit()"""
+    for staged_file in reversed(staged_files):
+        if not staged_file.replaced:
+            continue
+        try:
+            if staged_file.backup is not None:
+                os.replace(staged_file.backup, staged_file.target)
+                staged_file.backup = None
+            else:
+                os.unlink(staged_file.target)
+            staged_file.replaced = False
+        except OSError:
+            logging.exception("Error restoring %s", staged_file.target)
+
+
+def cleanup(staged_files: List[StagedFile]) -> None:
+    """Remove the leftover temporary and backup files"""
+    for staged_file in staged_files:
+        leftovers = [staged_file.backup]
+        if not staged_file.replaced:
+            leftovers.append(staged_file.staged)
+        for leftover in leftovers:
+            if leftover is None:
+                continue
+            try:
+                os.unlink(leftover)
+            except FileNotFoundError:
+                pass
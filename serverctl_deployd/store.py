@@ -0,0 +1,265 @@
+"""
+SQLite store of deployment records and their database configs
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Set
+
+from pydantic import ValidationError, parse_obj_as
+
+from serverctl_deployd.models.deployments import DBConfig, UpdateDBConfig
+
+DB_FILENAME = ".deployments.db"
+SCHEMA_VERSION = 1
+# Seconds a writer waits for another one to commit
+BUSY_TIMEOUT = 10.0
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS deployments (
+        name TEXT PRIMARY KEY,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS databases (
+        deployment TEXT NOT NULL
+            REFERENCES deployments (name) ON DELETE CASCADE,
+        service TEXT NOT NULL,
+        dbtype TEXT NOT NULL,
+        username TEXT NOT NULL,
+        password TEXT NOT NULL,
+        PRIMARY KEY (deployment, service)
+    ) WITHOUT ROWID
+    """
+)
+
+
+class DeploymentExists(Exception):
+    """A deployment with the same name is already stored"""
+
+
+def _now() -> str:
+    """Return the current time in UTC, in ISO format"""
+    return datetime.now(timezone.utc).isoformat()
+
+
+class DeploymentStore:
+    """
+    Deployment records and the configs of their databases, stored in
+    an SQLite database in WAL mode so that readers never wait for a
+    writer. Each thread uses its own connection. Changes are made in
+    immediate transactions, so concurrent updates of a deployment are
+    applied one after the other instead of overwriting each other.
+    Compose and .env files stay in the directory of each deployment.
+    """
+
+    def __init__(self, deployments_dir: Path) -> None:
+        self.deployments_dir = deployments_dir
+        self.db_path = deployments_dir / DB_FILENAME
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Return the connection of the current thread. A new connection
+        is opened if the database file was removed since, in which case
+        the database is created again.
+        """
+        connection: Optional[sqlite3.Connection] = getattr(
+            self._local, "connection", None
+        )
+        if connection is not None:
+            if os.fstat(self._local.db_fd).st_nlink > 0:
+                return connection
+            connection.close()
+            os.close(self._local.db_fd)
+            self._local.connection = None
+        self.deployments_dir.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(
+            self.db_path, timeout=BUSY_TIMEOUT, isolation_level=None
+        )
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+        self._initialize(connection)
+        # Kept open to tell when the database file is removed
+        self._local.db_fd = os.open(self.db_path, os.O_RDONLY)
+        self._local.connection = connection
+        return connection
+
+    @staticmethod
+    @contextmanager
+    def _transaction(connection: sqlite3.Connection
+                     ) -> Iterator[sqlite3.Connection]:
+        """
+        Run statements in a transaction which holds the write lock
+        from the start, rolled back if anything fails
+        """
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _initialize(self, connection: sqlite3.Connection) -> None:
+        """
+        Create the tables of a new database, and import the deployments
+        found in the deployments directory
+        """
+        with self._transaction(connection):
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                return
+            for statement in _SCHEMA:
+                connection.execute(statement)
+            self._import_directory(connection)
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _import_directory(self, connection: sqlite3.Connection) -> None:
+        """
+        Import the deployments of the directory layout used before the
+        store: one directory per deployment, with the configs of its
+        databases in databases.json. The files are left in place.
+        """
+        now = _now()
+        imported = 0
+        for entry in os.scandir(self.deployments_dir):
+            if not entry.is_dir():
+                continue
+            connection.execute(
+                "INSERT OR IGNORE INTO deployments VALUES (?, ?, ?)",
+                (entry.name, now, now)
+            )
+            imported += 1
+            db_file = Path(entry.path, "databases.json")
+            try:
+                databases = parse_obj_as(
+                    Dict[str, DBConfig],
+                    json.loads(db_file.read_text(encoding="utf-8"))
+                )
+            except FileNotFoundError:
+                continue
+            except (ValueError, ValidationError):
+                logging.warning("Skipping invalid database configs in %s",
+                                db_file)
+                continue
+            self._insert_databases(connection, entry.name, databases)
+        if imported:
+            logging.info("Imported %d deployments from %s", imported,
+                         self.deployments_dir)
+
+    @staticmethod
+    def _insert_databases(connection: sqlite3.Connection, name: str,
+                          databases: Dict[str, DBConfig]) -> None:
+        """Store the database configs of a deployment"""
+        connection.executemany(
+            "INSERT OR REPLACE INTO databases VALUES (?, ?, ?, ?, ?)",
+            [
+                (name, service, config.dbtype.value, config.username,
+                 config.password)
+                for service, config in databases.items()
+            ]
+        )
+
+    def names(self) -> Set[str]:
+        """Return the names of all the deployments"""
+        return {
+            name for name, in
+            self._connection().execute("SELECT name FROM deployments")
+        }
+
+    def exists(self, name: str) -> bool:
+        """Check if a deployment is stored"""
+        return self._connection().execute(
+            "SELECT 1 FROM deployments WHERE name = ?", (name,)
+        ).fetchone() is not None
+
+    def create(self, name: str, databases: Dict[str, DBConfig]) -> None:
+        """
+        Store a new deployment and the configs of its databases.
+        Raises DeploymentExists if the name is taken.
+        """
+        now = _now()
+        connection = self._connection()
+        try:
+            with self._transaction(connection):
+                connection.execute(
+                    "INSERT INTO deployments VALUES (?, ?, ?)",
+                    (name, now, now)
+                )
+                self._insert_databases(connection, name, databases)
+        except sqlite3.IntegrityError as integrity_error:
+            raise DeploymentExists(name) from integrity_error
+
+    def get_databases(self, name: str) -> Optional[Dict[str, DBConfig]]:
+        """
+        Return the database configs of a deployment,
+        or None if it does not exist
+        """
+        rows = self._connection().execute(
+            """
+            SELECT service, dbtype, username, password
+            FROM deployments LEFT JOIN databases ON deployment = name
+            WHERE name = ?
+            """, (name,)
+        ).fetchall()
+        if not rows:
+            return None
+        return {
+            service: DBConfig(dbtype=dbtype, username=username,
+                              password=password)
+            for service, dbtype, username, password in rows
+            if service is not None
+        }
+
+    def update(self, name: str,
+               databases: Optional[Dict[str, UpdateDBConfig]]) -> bool:
+        """
+        Mark a deployment as updated, and update the given fields of
+        the configs of its existing databases.
+        Returns False if the deployment does not exist.
+        """
+        connection = self._connection()
+        with self._transaction(connection):
+            if not connection.execute(
+                "UPDATE deployments SET updated_at = ? WHERE name = ?",
+                (_now(), name)
+            ).rowcount:
+                return False
+            connection.executemany(
+                """
+                UPDATE databases SET
+                    dbtype = coalesce(?, dbtype),
+                    username = coalesce(?, username),
+                    password = coalesce(?, password)
+                WHERE deployment = ? AND service = ?
+                """,
+                [
+                    (config.dbtype.value if config.dbtype else None,
+                     config.username or None, config.password or None,
+                     name, service)
+                    for service, config in (databases or {}).items()
+                ]
+            )
+        return True
+
+    def delete(self, name: str) -> bool:
+        """
+        Delete a deployment and its database configs.
+        Returns False if the deployment does not exist.
+        """
+        connection = self._connection()
+        with self._transaction(connection):
+            return connection.execute(
+                "DELETE FROM deployments WHERE name = ?", (name,)
+            ).rowcount > 0
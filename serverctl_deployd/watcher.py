@@ -0,0 +1,253 @@
+"""
+inotify based watcher which keeps a live index of
+file hashes for registered config bucket directories
+"""
+
+import logging
+import os
+import select
+import stat
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from serverctl_deployd.dependencies import get_settings
+from serverctl_deployd.hashing import hash_entries, hash_file
+from serverctl_deployd.inotify import (IN_ATTRIB, IN_CLOSE_WRITE, IN_CREATE,
+                                       IN_DELETE, IN_DELETE_SELF, IN_IGNORED,
+                                       IN_MODIFY, IN_MOVE_SELF, IN_MOVED_FROM,
+                                       IN_MOVED_TO, IN_ONLYDIR, IN_Q_OVERFLOW,
+                                       Inotify)
+
+
+@dataclass
+class _WatchedBucket:
+    """Live index of a watched bucket directory"""
+    path: str
+    watch_descriptor: int
+    hashes: Dict[str, str] = field(default_factory=dict)
+    symlinks: Set[str] = field(default_factory=set)
+    dirty: Set[str] = field(default_factory=set)
+    first_event: float = 0.0
+    last_event: float = 0.0
+
+
+_BUCKET_EVENTS = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+                  | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+                  | IN_MOVE_SELF | IN_ONLYDIR)
+
+
+class BucketWatcher:
+    """
+    Keeps a {filename: sha256} index of watched directories up to date
+    from inotify events. Bursts of events are coalesced: a directory is
+    rehashed once it has been quiet for the debounce interval, and only
+    the files named in its events are rehashed.
+    """
+
+    def __init__(self, debounce: float) -> None:
+        self.debounce = debounce
+        self._buckets: Dict[str, _WatchedBucket] = {}
+        self._descriptors: Dict[int, _WatchedBucket] = {}
+        self._lock = threading.RLock()
+        self._inotify: Optional[Inotify] = None
+        self._thread: Optional[threading.Thread] = None
+        self._wake_pipe: Tuple[int, int] = (-1, -1)
+
+    def _ensure_started(self) -> Inotify:
+        """Start the event thread on first use"""
+        if self._inotify is None:
+            self._inotify = Inotify()
+            self._wake_pipe = os.pipe()
+            self._thread = threading.Thread(
+                target=self._run, name="bucket-watcher", daemon=True
+            )
+            self._thread.start()
+        return self._inotify
+
+    def watch(self, directory: str) -> None:
+        """Start watching a directory and build its index"""
+        path = os.path.realpath(directory)
+        with self._lock:
+            if path in self._buckets:
+                return
+            inotify = self._ensure_started()
+            # The watch is added before the scan so that no change
+            # made during the scan is missed
+            bucket = _WatchedBucket(
+                path, inotify.add_watch(path, _BUCKET_EVENTS)
+            )
+            with os.scandir(path) as listing:
+                entries = {
+                    entry.name: entry for entry in listing if entry.is_file()
+                }
+            bucket.hashes = hash_entries(entries)
+            bucket.symlinks = {
+                name for name, entry in entries.items() if entry.is_symlink()
+            }
+            self._buckets[path] = bucket
+            self._descriptors[bucket.watch_descriptor] = bucket
+
+    def unwatch(self, directory: str) -> bool:
+        """Stop watching a directory. Returns False if it was not watched"""
+        with self._lock:
+            bucket = self._buckets.pop(os.path.realpath(directory), None)
+            if bucket is None:
+                return False
+            self._descriptors.pop(bucket.watch_descriptor, None)
+            if self._inotify is not None:
+                self._inotify.remove_watch(bucket.watch_descriptor)
+            return True
+
+    def watched(self) -> List[str]:
+        """Return the list of watched directories"""
+        with self._lock:
+            return sorted(self._buckets)
+
+    def get_hashes(self, directory: str) -> Optional[Dict[str, str]]:
+        """
+        Return a copy of the index of a directory, or None if the
+        directory is not watched. Pending events are applied first so
+        that the answer is never older than the request.
+        """
+        with self._lock:
+            self._read_events()
+            bucket = self._buckets.get(os.path.realpath(directory))
+            if bucket is None:
+                return None
+            self._flush(bucket)
+            # Changes to the targets of symlinks are not reported by
+            # inotify, so those are always checked against the hash cache
+            for name in bucket.symlinks:
+                try:
+                    bucket.hashes[name] = hash_file(
+                        os.path.join(bucket.path, name)
+                    )
+                except OSError:
+                    bucket.dirty.add(name)
+            self._flush(bucket)
+            return dict(bucket.hashes)
+
+    def _flush(self, bucket: _WatchedBucket) -> None:
+        """Rehash the files named in the pending events of a bucket"""
+        for name in bucket.dirty:
+            file_path = os.path.join(bucket.path, name)
+            try:
+                is_file = stat.S_ISREG(os.stat(file_path).st_mode)
+                if is_file:
+                    bucket.hashes[name] = hash_file(file_path)
+            except OSError:
+                is_file = False
+            if is_file:
+                if os.path.islink(file_path):
+                    bucket.symlinks.add(name)
+                else:
+                    bucket.symlinks.discard(name)
+            else:
+                bucket.hashes.pop(name, None)
+                bucket.symlinks.discard(name)
+        bucket.dirty.clear()
+        bucket.first_event = 0.0
+
+    def _rescan(self, bucket: _WatchedBucket) -> None:
+        """Mark every file of a bucket as dirty after lost events"""
+        try:
+            with os.scandir(bucket.path) as listing:
+                bucket.dirty.update(entry.name for entry in listing)
+        except OSError:
+            logging.exception("Error rescanning %s", bucket.path)
+        bucket.dirty.update(bucket.hashes)
+
+    def _handle_event(self, watch_descriptor: int, mask: int,
+                      name: str, now: float) -> None:
+        """Record an inotify event against its bucket"""
+        if mask & IN_Q_OVERFLOW:
+            logging.warning("inotify queue overflowed, rescanning buckets")
+            for watched_bucket in self._buckets.values():
+                self._rescan(watched_bucket)
+                watched_bucket.first_event = \
+                    watched_bucket.first_event or now
+                watched_bucket.last_event = now
+            return
+        bucket = self._descriptors.get(watch_descriptor)
+        if bucket is None:
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+            # The directory itself is gone, so its index can not be
+            # trusted any more and requests fall back to scanning
+            logging.info("Stopped watching %s", bucket.path)
+            self._buckets.pop(bucket.path, None)
+            self._descriptors.pop(watch_descriptor, None)
+            return
+        if name:
+            bucket.dirty.add(name)
+            bucket.first_event = bucket.first_event or now
+            bucket.last_event = now
+
+    def _read_events(self) -> None:
+        """Apply the events waiting in the inotify queue"""
+        if self._inotify is None:
+            return
+        now = time.monotonic()
+        for watch_descriptor, mask, name in self._inotify.read_events():
+            self._handle_event(watch_descriptor, mask, name, now)
+
+    def _run(self) -> None:
+        """Event loop of the watcher thread"""
+        assert self._inotify is not None
+        inotify_fd, wake_fd = self._inotify.fileno(), self._wake_pipe[0]
+        timeout: Optional[float] = None
+        while True:
+            readable, _, _ = select.select([inotify_fd, wake_fd], [], [],
+                                           timeout)
+            if wake_fd in readable:
+                return
+            with self._lock:
+                self._read_events()
+                timeout = self._flush_quiet_buckets(time.monotonic())
+
+    def _flush_quiet_buckets(self, now: float) -> Optional[float]:
+        """
+        Flush buckets which have been quiet for the debounce interval,
+        or which have had events pending for ten intervals. Returns how
+        long to wait before the next bucket is due.
+        """
+        timeout: Optional[float] = None
+        for bucket in self._buckets.values():
+            if not bucket.dirty:
+                continue
+            due = min(bucket.last_event + self.debounce,
+                      bucket.first_event + 10 * self.debounce)
+            if due <= now:
+                try:
+                    self._flush(bucket)
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("Error updating index of %s",
+                                      bucket.path)
+                    bucket.dirty.clear()
+                    bucket.first_event = 0.0
+            elif timeout is None or due - now < timeout:
+                timeout = due - now
+        return timeout
+
+    def stop(self) -> None:
+        """Stop the watcher thread and drop all indexes"""
+        with self._lock:
+            if self._inotify is None or self._thread is None:
+                return
+            os.write(self._wake_pipe[1], b"\0")
+            thread = self._thread
+        thread.join()
+        with self._lock:
+            assert self._inotify is not None
+            self._inotify.close()
+            os.close(self._wake_pipe[0])
+            os.close(self._wake_pipe[1])
+            self._inotify = None
+            self._thread = None
+            self._buckets.clear()
+            self._descriptors.clear()
+
+
+bucket_watcher = BucketWatcher(get_settings().watch_debounce)
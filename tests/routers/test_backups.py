@@ -0,0 +1,301 @@
+"""
+Tests for the backup and restore routes of config buckets
+"""
+
+import filecmp
+import json
+import os
+import tarfile
+from io import BytesIO
+from pathlib import Path
+from shutil import rmtree
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+from requests.models import Response
+
+from serverctl_deployd.archive import TOMBSTONE_MEMBER
+from serverctl_deployd.main import app
+from tests.fakes.fake_config_directory import (MOCK_CONF_DIRPATH,
+                                               MOCK_CONF_FILE_CONTENT,
+                                               MOCK_CONF_FILEPATH,
+                                               MOCK_CONF_NEW_CONTENT,
+                                               MOCK_FILE_HASH,
+                                               make_mock_config_dir)
+
+client = TestClient(app)
+
+
+def test_get_tar_archive() -> None:
+    """Test for getting tar archive backup and verifying its contents"""
+    make_mock_config_dir()
+
+    response: Response = client.post(
+        "/config/buckets/backup",
+        json={"directory_path": MOCK_CONF_DIRPATH}
+    )
+    assert response.status_code == 200
+
+    with open("tests/fakes/mock_conf.tar.gz", "wb") as bin_file:
+        bin_file.write(response.content)
+    backup_path = Path("tests/fakes/backup_conf")
+    backup_path.mkdir(exist_ok=True)
+    with tarfile.open("tests/fakes/mock_conf.tar.gz", "r|gz") as tar_file:
+        tar_file.extractall(path=backup_path)
+    _, mismatch, error = filecmp.cmpfiles(
+        backup_path,
+        MOCK_CONF_DIRPATH,
+        ["mock.conf", "leave_this.conf"]
+    )
+    assert mismatch == []
+    assert error == []
+
+    os.remove("tests/fakes/mock_conf.tar.gz")
+    rmtree(backup_path)
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_get_tar_archive_compression() -> None:
+    """Test for the compressions of tar archive backups"""
+    make_mock_config_dir()
+
+    for compression, is_gzip in (("none", False), ("pgzip", True)):
+        response: Response = client.post(
+            "/config/buckets/backup",
+            params={"compression": compression, "compression_level": "1"},
+            json={"directory_path": MOCK_CONF_DIRPATH}
+        )
+        assert response.status_code == 200
+        assert response.content.startswith(b"\x1f\x8b") == is_gzip
+        with tarfile.open(fileobj=BytesIO(response.content),
+                          mode="r:*") as tar_file:
+            member = tar_file.extractfile("mock.conf")
+            assert member is not None
+            assert member.read().decode() == MOCK_CONF_FILE_CONTENT
+
+    # Invalid compression level
+    response = client.post(
+        "/config/buckets/backup",
+        params={"compression_level": "10"},
+        json={"directory_path": MOCK_CONF_DIRPATH}
+    )
+    assert response.status_code == 422
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_get_tar_archive_large_file() -> None:
+    """Test that files larger than one chunk are streamed intact"""
+    make_mock_config_dir()
+    large_content = os.urandom(3 * 128 * 1024 + 1000)
+    Path(MOCK_CONF_DIRPATH + "large.bin").write_bytes(large_content)
+
+    response: Response = client.post(
+        "/config/buckets/backup",
+        json={"directory_path": MOCK_CONF_DIRPATH}
+    )
+    assert response.status_code == 200
+
+    with tarfile.open(fileobj=BytesIO(response.content),
+                      mode="r:gz") as tar_file:
+        assert sorted(tar_file.getnames()) == [
+            "large.bin", "leave_this.conf", "mock.conf"
+        ]
+        large_member = tar_file.extractfile("large.bin")
+        assert large_member is not None
+        assert large_member.read() == large_content
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_get_differential_tar_archive() -> None:
+    """Test that a differential backup only holds changed files"""
+    make_mock_config_dir()
+
+    response: Response = client.post(
+        "/config/buckets/backup/diff",
+        json={
+            "directory_path": MOCK_CONF_DIRPATH,
+            "manifest": {
+                "mock.conf": MOCK_FILE_HASH,
+                "leave_this.conf": "outdated-hash",
+                "removed.conf": MOCK_FILE_HASH
+            }
+        }
+    )
+    assert response.status_code == 200
+
+    with tarfile.open(fileobj=BytesIO(response.content),
+                      mode="r:gz") as tar_file:
+        assert tar_file.getnames() == [
+            TOMBSTONE_MEMBER, "leave_this.conf"
+        ]
+        tombstone_member = tar_file.extractfile(TOMBSTONE_MEMBER)
+        assert tombstone_member is not None
+        assert json.load(tombstone_member) == ["removed.conf"]
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def _tar_archive(*members: tarfile.TarInfo) -> bytes:
+    """Build an uncompressed tar archive of empty members"""
+    archive = BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar_file:
+        for member in members:
+            tar_file.addfile(member, BytesIO(b""))
+    return archive.getvalue()
+
+
+def test_restore_tar_archive() -> None:
+    """Test restoring a bucket from its backups"""
+    make_mock_config_dir()
+    backup: Response = client.post(
+        "/config/buckets/backup",
+        params={"compression": "pgzip"},
+        json={"directory_path": MOCK_CONF_DIRPATH}
+    )
+    assert backup.status_code == 200
+    Path(MOCK_CONF_FILEPATH).write_text(MOCK_CONF_NEW_CONTENT,
+                                        encoding="utf-8")
+    os.remove(MOCK_CONF_DIRPATH + "leave_this.conf")
+
+    # A failed update command puts the files back
+    response: Response = client.post(
+        "/config/buckets/restore",
+        params={"directory_path": MOCK_CONF_DIRPATH,
+                "update_command": "false"},
+        data=backup.content
+    )
+    assert response.status_code == 500
+    assert Path(MOCK_CONF_FILEPATH).read_text(encoding="utf-8") \
+        == MOCK_CONF_NEW_CONTENT
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == ["mock.conf"]
+
+    response = client.post(
+        "/config/buckets/restore",
+        params={"directory_path": MOCK_CONF_DIRPATH,
+                "update_command": "true"},
+        data=backup.content
+    )
+    assert response.status_code == 200
+    assert sorted(response.json()["restored"]) == [
+        "leave_this.conf", "mock.conf"
+    ]
+    assert Path(MOCK_CONF_FILEPATH).read_text(encoding="utf-8") \
+        == MOCK_CONF_FILE_CONTENT
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == [
+        "leave_this.conf", "mock.conf"
+    ]
+
+    # Files which already have the archived content are skipped
+    response = client.post(
+        "/config/buckets/restore",
+        params={"directory_path": MOCK_CONF_DIRPATH},
+        data=backup.content
+    )
+    assert response.status_code == 200
+    assert response.json()["restored"] == []
+    assert sorted(response.json()["unchanged"]) == [
+        "leave_this.conf", "mock.conf"
+    ]
+
+    # Files deleted since a differential backup are deleted
+    backup = client.post(
+        "/config/buckets/backup/diff",
+        params={"compression": "none"},
+        json={
+            "directory_path": MOCK_CONF_DIRPATH,
+            "manifest": {"removed.conf": MOCK_FILE_HASH}
+        }
+    )
+    Path(MOCK_CONF_DIRPATH + "removed.conf").touch()
+    response = client.post(
+        "/config/buckets/restore",
+        params={"directory_path": MOCK_CONF_DIRPATH},
+        data=backup.content
+    )
+    assert response.status_code == 200
+    assert response.json()["deleted"] == ["removed.conf"]
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == [
+        "leave_this.conf", "mock.conf"
+    ]
+
+    # Directories of the bucket are neither deleted nor replaced
+    Path(MOCK_CONF_DIRPATH + "sub").mkdir()
+    tombstones = json.dumps(["sub"]).encode()
+    tombstone_member = tarfile.TarInfo(TOMBSTONE_MEMBER)
+    tombstone_member.size = len(tombstones)
+    tombstone_archive = BytesIO()
+    with tarfile.open(fileobj=tombstone_archive, mode="w") as tar_file:
+        tar_file.addfile(tombstone_member, BytesIO(tombstones))
+    for archive_content in (tombstone_archive.getvalue(),
+                            _tar_archive(tarfile.TarInfo("sub"))):
+        response = client.post(
+            "/config/buckets/restore",
+            params={"directory_path": MOCK_CONF_DIRPATH},
+            data=archive_content
+        )
+        assert response.status_code == 400
+    assert Path(MOCK_CONF_DIRPATH + "sub").is_dir()
+    Path(MOCK_CONF_DIRPATH + "sub").rmdir()
+
+    # Members below a file of the bucket are refused, even if the file
+    # only appears once the names were checked
+    response = client.post(
+        "/config/buckets/restore",
+        params={"directory_path": MOCK_CONF_DIRPATH},
+        data=_tar_archive(tarfile.TarInfo("mock.conf/nested.conf"))
+    )
+    assert response.status_code == 400
+    assert response.json() == {
+        "detail": "Member mock.conf/nested.conf is below a file of the bucket"
+    }
+    with patch("serverctl_deployd.staging.os.makedirs",
+               side_effect=FileExistsError):
+        response = client.post(
+            "/config/buckets/restore",
+            params={"directory_path": MOCK_CONF_DIRPATH},
+            data=_tar_archive(tarfile.TarInfo("added/nested.conf"))
+        )
+    assert response.status_code == 400
+    assert response.json() == {
+        "detail": "Members conflict with the files of the bucket"
+    }
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == [
+        "leave_this.conf", "mock.conf"
+    ]
+
+    # Members leading out of the bucket and links are refused
+    symlink_member = tarfile.TarInfo("link.conf")
+    symlink_member.type = tarfile.SYMTYPE
+    symlink_member.linkname = "/etc/passwd"
+    for archive in (
+        _tar_archive(tarfile.TarInfo("new.conf"),
+                     tarfile.TarInfo("../escaped.conf")),
+        _tar_archive(tarfile.TarInfo("/tmp/escaped.conf")),
+        _tar_archive(symlink_member),
+        b"not an archive"
+    ):
+        response = client.post(
+            "/config/buckets/restore",
+            params={"directory_path": MOCK_CONF_DIRPATH},
+            data=archive
+        )
+        assert response.status_code == 400
+    assert not Path("tests/fakes/escaped.conf").exists()
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == [
+        "leave_this.conf", "mock.conf"
+    ]
+
+    # Links of the bucket pointing out of it are not written through
+    os.symlink(os.path.abspath("tests/fakes/escaped.conf"),
+               MOCK_CONF_DIRPATH + "link.conf")
+    response = client.post(
+        "/config/buckets/restore",
+        params={"directory_path": MOCK_CONF_DIRPATH},
+        data=_tar_archive(tarfile.TarInfo("link.conf"))
+    )
+    assert response.status_code == 400
+    assert not Path("tests/fakes/escaped.conf").exists()
+
+    rmtree(MOCK_CONF_DIRPATH)
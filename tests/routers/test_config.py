@@ -2,15 +2,20 @@
 Tests for config management routes
 """
 
-import filecmp
+import base64
+import hashlib
+import json
 import os
-import tarfile
+import time
 from pathlib import Path
 from shutil import rmtree
+from typing import Any, Dict
+from unittest.mock import patch
 
 from fastapi.testclient import TestClient
 from requests.models import Response
 
+from serverctl_deployd.hashing import hash_cache, hash_file, node_digest
 from serverctl_deployd.main import app
 from tests.fakes.fake_config_directory import (MOCK_CONF_DIRPATH,
                                                MOCK_CONF_FILE_CONTENT,
@@ -87,6 +92,273 @@ def test_get_hashes() -> None:
     assert response.json() == {
         "mock.conf": MOCK_FILE_HASH
     }
+    assert response.headers["X-Hash-Algorithm"] == "sha256"
+
+    # Other hash algorithm
+    response = client.post(
+        "/config/buckets/check",
+        json={
+            "directory_path": MOCK_CONF_DIRPATH,
+            "ignore_patterns": ["leave*"],
+            "algorithm": "blake2b"
+        })
+    assert response.status_code == 200
+    assert response.json() == {
+        "mock.conf": hashlib.blake2b(MOCK_CONF_FILE_CONTENT.encode()).hexdigest()
+    }
+    assert response.headers["X-Hash-Algorithm"] == "blake2b"
+
+    # Unknown hash algorithm
+    response = client.post(
+        "/config/buckets/check",
+        json={
+            "directory_path": MOCK_CONF_DIRPATH,
+            "algorithm": "crc32"
+        })
+    assert response.status_code == 422
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_get_batch_hashes() -> None:
+    """Test for the batch check route i.e /check/batch"""
+    make_mock_config_dir()
+    Path(MOCK_CONF_DIRPATH + "denied").mkdir()
+
+    def _scandir(path: str) -> Any:
+        if path.endswith("denied"):
+            raise PermissionError()
+        return os.scandir(path)
+
+    request_json = [
+        {"directory_path": MOCK_CONF_DIRPATH, "ignore_patterns": ["leave*"]},
+        {"directory_path": MOCK_CONF_DIRPATH + "denied"},
+        {"directory_path": MOCK_CONF_DIRPATH + "missing"},
+        {"directory_path": MOCK_CONF_DIRPATH + "mock.conf"}
+    ]
+    expected = [
+        {
+            "index": 0,
+            "directory_path": MOCK_CONF_DIRPATH.rstrip("/"),
+            "algorithm": "sha256",
+            "hashes": {"mock.conf": MOCK_FILE_HASH},
+            "error": None
+        },
+        {
+            "index": 1,
+            "directory_path": MOCK_CONF_DIRPATH + "denied",
+            "algorithm": "sha256",
+            "hashes": None,
+            "error": "Permission denied"
+        },
+        {
+            "index": 2,
+            "directory_path": MOCK_CONF_DIRPATH + "missing",
+            "algorithm": "sha256",
+            "hashes": None,
+            "error": "Directory does not exist"
+        },
+        {
+            "index": 3,
+            "directory_path": MOCK_CONF_DIRPATH + "mock.conf",
+            "algorithm": "sha256",
+            "hashes": None,
+            "error": "Not a directory"
+        }
+    ]
+    with patch("serverctl_deployd.buckets.scandir",
+               side_effect=_scandir):
+        response: Response = client.post(
+            "/config/buckets/check/batch",
+            json=request_json
+        )
+        assert response.status_code == 200
+        assert response.json() == expected
+
+        # Streamed results
+        response = client.post(
+            "/config/buckets/check/batch",
+            params={"stream": True},
+            json=request_json
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert sorted(results, key=lambda result: result["index"]) \
+            == expected
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_recursive_bucket() -> None:
+    """Test for recursive buckets with pruning of ignored directories"""
+    make_mock_config_dir()
+    Path(MOCK_CONF_DIRPATH + "conf.d/ssl").mkdir(parents=True)
+    Path(MOCK_CONF_DIRPATH + "conf.d/ssl/ssl.conf").write_text(
+        MOCK_CONF_FILE_CONTENT, encoding="utf8"
+    )
+    Path(MOCK_CONF_DIRPATH + ".git").mkdir()
+    Path(MOCK_CONF_DIRPATH + ".git/HEAD").write_text(
+        MOCK_CONF_FILE_CONTENT, encoding="utf8"
+    )
+
+    with patch("serverctl_deployd.buckets.scandir",
+               wraps=os.scandir) as scandir_mock:
+        response: Response = client.post(
+            "/config/buckets/check",
+            json={
+                "directory_path": MOCK_CONF_DIRPATH,
+                "ignore_patterns": ["leave*", ".git"],
+                "recursive": True
+            })
+    assert response.status_code == 200
+    assert response.json() == {
+        "mock.conf": MOCK_FILE_HASH,
+        "conf.d/ssl/ssl.conf": MOCK_FILE_HASH
+    }
+    scanned = [call.args[0] for call in scandir_mock.call_args_list]
+    assert not any(directory.endswith(".git") for directory in scanned)
+
+    # Patterns can match relative paths as well
+    response = client.post(
+        "/config/buckets/files",
+        json={
+            "directory_path": MOCK_CONF_DIRPATH,
+            "ignore_patterns": ["leave*", ".git", "conf.d/*"],
+            "recursive": True
+        })
+    assert response.json() == ["mock.conf"]
+
+    # Subdirectories are not included by default
+    response = client.post(
+        "/config/buckets/files",
+        json={"directory_path": MOCK_CONF_DIRPATH}
+    )
+    assert sorted(response.json()) == ["leave_this.conf", "mock.conf"]
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_get_bucket_digest() -> None:
+    """Test for the Merkle digest route i.e /digest"""
+    make_mock_config_dir()
+
+    # Root digest
+    response: Response = client.post(
+        "/config/buckets/digest",
+        json={
+            "directory_path": MOCK_CONF_DIRPATH,
+            "ignore_patterns": ["leave*"]
+        })
+    assert response.status_code == 200
+    assert response.json() == {
+        "path": "",
+        "digest": node_digest({"mock.conf": MOCK_FILE_HASH}),
+        "algorithm": "sha256"
+    }
+
+    # Expanded root
+    response = client.post(
+        "/config/buckets/digest",
+        json={
+            "directory_path": MOCK_CONF_DIRPATH,
+            "ignore_patterns": ["leave*"],
+            "expand": True
+        })
+    assert response.json()["children"] == {"mock.conf": MOCK_FILE_HASH}
+
+    # File digest
+    response = client.post(
+        "/config/buckets/digest",
+        json={
+            "directory_path": MOCK_CONF_DIRPATH,
+            "path": "mock.conf"
+        })
+    assert response.json() == {
+        "path": "mock.conf",
+        "digest": MOCK_FILE_HASH,
+        "algorithm": "sha256"
+    }
+
+    # Path not in bucket
+    response = client.post(
+        "/config/buckets/digest",
+        json={
+            "directory_path": MOCK_CONF_DIRPATH,
+            "ignore_patterns": ["leave*"],
+            "path": "leave_this.conf"
+        })
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Path not found in bucket"}
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_watch_bucket() -> None:
+    """Test for watching a bucket i.e /watch"""
+    make_mock_config_dir()
+
+    # Valid request
+    response: Response = client.post(
+        "/config/buckets/watch",
+        json={"directory_path": MOCK_CONF_DIRPATH}
+    )
+    assert response.status_code == 204
+    response = client.get("/config/buckets/watch")
+    assert response.json() == [os.path.realpath(MOCK_CONF_DIRPATH)]
+
+    # Watched buckets are answered from the index
+    with open(MOCK_CONF_FILEPATH, 'w', encoding="utf8") as conf_file:
+        conf_file.write(MOCK_CONF_NEW_CONTENT)
+    response = client.post(
+        "/config/buckets/check",
+        json={
+            "directory_path": MOCK_CONF_DIRPATH,
+            "ignore_patterns": ["leave*"]
+        })
+    assert response.json() == {"mock.conf": hash_file(MOCK_CONF_FILEPATH)}
+    response = client.post(
+        "/config/buckets/files",
+        json={
+            "directory_path": MOCK_CONF_DIRPATH,
+            "ignore_patterns": ["leave*"]
+        })
+    assert response.json() == ["mock.conf"]
+
+    response = client.delete(
+        "/config/buckets/watch",
+        json={"directory_path": MOCK_CONF_DIRPATH}
+    )
+    assert response.status_code == 204
+
+    # Bucket not watched
+    response = client.delete(
+        "/config/buckets/watch",
+        json={"directory_path": MOCK_CONF_DIRPATH}
+    )
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Bucket is not watched"}
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_get_hash_cache_stats() -> None:
+    """Test for the hash cache statistics route i.e /cache"""
+    make_mock_config_dir()
+    hash_cache.clear()
+
+    for _ in range(2):
+        client.post(
+            "/config/buckets/check",
+            json={
+                "directory_path": MOCK_CONF_DIRPATH,
+                "ignore_patterns": ["leave*"]
+            })
+    response: Response = client.get("/config/buckets/cache")
+    assert response.status_code == 200
+    assert response.json()["hits"] == 1
+    assert response.json()["misses"] == 1
+    assert response.json()["entries"] == 1
 
     rmtree(MOCK_CONF_DIRPATH)
 
@@ -106,6 +378,109 @@ def test_get_file() -> None:
     rmtree(MOCK_CONF_DIRPATH)
 
 
+def test_get_file_conditional() -> None:
+    """Test for ETags, conditional and range requests of config files"""
+    make_mock_config_dir()
+    mock_etag = f'"{MOCK_FILE_HASH}"'
+
+    response: Response = client.get(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH}
+    )
+    assert response.headers["ETag"] == mock_etag
+
+    # Unchanged file
+    response = client.get(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH},
+        headers={"If-None-Match": mock_etag}
+    )
+    assert response.status_code == 304
+    assert response.content == b""
+    # If-None-Match uses the weak comparison
+    response = client.get(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH},
+        headers={"If-None-Match": f"W/{mock_etag}"}
+    )
+    assert response.status_code == 304
+
+    # Byte ranges
+    response = client.get(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH},
+        headers={"Range": "bytes=4-10"}
+    )
+    assert response.status_code == 206
+    assert response.content.decode() == MOCK_CONF_FILE_CONTENT[4:11]
+    assert response.headers["Content-Range"] == \
+        f"bytes 4-10/{len(MOCK_CONF_FILE_CONTENT)}"
+    response = client.get(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH},
+        headers={"Range": "bytes=-5"}
+    )
+    assert response.status_code == 206
+    assert response.content.decode() == MOCK_CONF_FILE_CONTENT[-5:]
+    response = client.get(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH},
+        headers={"Range": "bytes=1000-"}
+    )
+    assert response.status_code == 416
+
+    # Range of a file that changed since the If-Range ETag
+    response = client.get(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH},
+        headers={"Range": "bytes=4-10", "If-Range": '"outdated"'}
+    )
+    assert response.status_code == 200
+    assert response.content.decode() == MOCK_CONF_FILE_CONTENT
+
+    # Preconditions of updates. If-Match uses the strong comparison,
+    # so a weak tag never matches
+    for if_match in ('"outdated"', f"W/{mock_etag}"):
+        response = client.put(
+            "/config/buckets/file",
+            params={"file_path": MOCK_CONF_FILEPATH},
+            headers={"If-Match": if_match},
+            data={"update_command": "echo updated"},
+            files={"new_file": ("mock.conf", MOCK_CONF_NEW_CONTENT)}
+        )
+        assert response.status_code == 412
+        assert response.json() == {"detail": "File does not match If-Match"}
+        assert hash_file(MOCK_CONF_FILEPATH) == MOCK_FILE_HASH
+        response = client.delete(
+            "/config/buckets/file",
+            params={"file_path": MOCK_CONF_FILEPATH},
+            headers={"If-Match": if_match},
+            json={"update_command": "echo updated"}
+        )
+        assert response.status_code == 412
+        assert os.path.exists(MOCK_CONF_FILEPATH)
+
+    response = client.put(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH},
+        headers={"If-Match": mock_etag},
+        data={"update_command": "echo updated"},
+        files={"new_file": ("mock.conf", MOCK_CONF_NEW_CONTENT)}
+    )
+    assert response.status_code == 200
+    new_etag = response.headers["ETag"]
+    response = client.delete(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH},
+        headers={"If-Match": new_etag},
+        json={"update_command": "echo updated"}
+    )
+    assert response.status_code == 204
+    assert not os.path.exists(MOCK_CONF_FILEPATH)
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
 def test_update_file() -> None:
     """Test for updating config file"""
     make_mock_config_dir()
@@ -129,6 +504,11 @@ def test_update_file() -> None:
         )
         assert response.status_code == 200
         assert response.content.decode() == MOCK_CONF_NEW_CONTENT
+        assert response.headers["X-File-Hash"] == hashlib.sha256(
+            MOCK_CONF_NEW_CONTENT.encode()
+        ).hexdigest()
+        assert not [name for name in os.listdir(MOCK_CONF_DIRPATH)
+                    if name.startswith(".")]
 
         # Unsuccessful or invalid command
         response = client.put(
@@ -145,6 +525,221 @@ def test_update_file() -> None:
     rmtree(MOCK_CONF_DIRPATH)
 
 
+def test_update_file_symlink() -> None:
+    """Test that updating a symbolic link replaces the file it points to"""
+    Path(MOCK_CONF_DIRPATH + "avail").mkdir(parents=True)
+    Path(MOCK_CONF_DIRPATH + "enabled").mkdir()
+    Path(MOCK_CONF_DIRPATH + "avail/site").write_text(
+        MOCK_CONF_FILE_CONTENT, encoding="utf8"
+    )
+    os.symlink("../avail/site", MOCK_CONF_DIRPATH + "enabled/site")
+
+    response: Response = client.put(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_DIRPATH + "enabled/site"},
+        data={"update_command": "echo updated"},
+        files={"new_file": ("site", MOCK_CONF_NEW_CONTENT)},
+    )
+    assert response.status_code == 200
+    assert os.readlink(MOCK_CONF_DIRPATH + "enabled/site") == "../avail/site"
+    assert Path(MOCK_CONF_DIRPATH + "avail/site").read_text("utf8") \
+        == MOCK_CONF_NEW_CONTENT
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH + "avail")) == ["site"]
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH + "enabled")) == ["site"]
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_update_files() -> None:
+    """Test for updating several config files at once"""
+    make_mock_config_dir()
+    new_hash = hashlib.sha256(MOCK_CONF_NEW_CONTENT.encode()).hexdigest()
+
+    # Valid request
+    response: Response = client.put(
+        "/config/buckets/files",
+        params={"directory_path": MOCK_CONF_DIRPATH},
+        data={
+            "update_command": "echo updated",
+            "expected_hashes": json.dumps({
+                "mock.conf": MOCK_FILE_HASH,
+                "added.conf": None
+            })
+        },
+        files=[
+            ("files", ("mock.conf", MOCK_CONF_NEW_CONTENT)),
+            ("files", ("added.conf", MOCK_CONF_NEW_CONTENT))
+        ]
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "mock.conf": new_hash,
+        "leave_this.conf": MOCK_FILE_HASH,
+        "added.conf": new_hash
+    }
+    assert not [name for name in os.listdir(MOCK_CONF_DIRPATH)
+                if name.startswith(".")]
+
+    # Files that changed since the expected hashes were taken
+    response = client.put(
+        "/config/buckets/files",
+        params={"directory_path": MOCK_CONF_DIRPATH},
+        data={
+            "update_command": "echo updated",
+            "expected_hashes": json.dumps({"mock.conf": MOCK_FILE_HASH})
+        },
+        files=[("files", ("mock.conf", MOCK_CONF_FILE_CONTENT))]
+    )
+    assert response.status_code == 412
+    assert response.json() == {
+        "detail": "Files do not match the expected hashes"
+    }
+    assert hash_file(MOCK_CONF_FILEPATH) == new_hash
+
+    # Unsuccessful command rolls back every file
+    response = client.put(
+        "/config/buckets/files",
+        params={"directory_path": MOCK_CONF_DIRPATH},
+        data={"update_command": "invalid command"},
+        files=[
+            ("files", ("mock.conf", MOCK_CONF_FILE_CONTENT)),
+            ("files", ("another.conf", MOCK_CONF_FILE_CONTENT))
+        ]
+    )
+    assert response.status_code == 500
+    assert response.json() == {"detail": "Internal server error"}
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == [
+        "added.conf", "leave_this.conf", "mock.conf"
+    ]
+    assert hash_file(MOCK_CONF_FILEPATH) == new_hash
+
+    # Invalid file names
+    response = client.put(
+        "/config/buckets/files",
+        params={"directory_path": MOCK_CONF_DIRPATH},
+        data={"update_command": "echo updated"},
+        files=[
+            ("files", ("mock.conf", MOCK_CONF_FILE_CONTENT)),
+            ("files", ("mock.conf", MOCK_CONF_FILE_CONTENT))
+        ]
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid file names"}
+
+    # Directories of the bucket are not replaced
+    Path(MOCK_CONF_DIRPATH + "sub").mkdir()
+    response = client.put(
+        "/config/buckets/files",
+        params={"directory_path": MOCK_CONF_DIRPATH},
+        data={"update_command": "echo updated"},
+        files=[
+            ("files", ("mock.conf", MOCK_CONF_FILE_CONTENT)),
+            ("files", ("sub", MOCK_CONF_FILE_CONTENT))
+        ]
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "sub is a directory"}
+    assert Path(MOCK_CONF_DIRPATH + "sub").is_dir()
+    assert hash_file(MOCK_CONF_FILEPATH) == new_hash
+    assert not [name for name in os.listdir(MOCK_CONF_DIRPATH)
+                if name.startswith(".")]
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_patch_file() -> None:
+    """Test for updating a config file from a delta of its blocks"""
+    make_mock_config_dir()
+
+    response: Response = client.get(
+        "/config/buckets/file/signature",
+        params={"file_path": MOCK_CONF_FILEPATH, "block_size": "8"}
+    )
+    assert response.status_code == 200
+    signature = response.json()
+    assert signature["file_hash"] == MOCK_FILE_HASH
+    assert signature["file_size"] == len(MOCK_CONF_FILE_CONTENT)
+    assert len(signature["blocks"]) == 3
+
+    # Keep the first block "FakeSett" and send the rest
+    delta: Dict[str, Any] = {
+        "base_hash": MOCK_FILE_HASH,
+        "block_size": 8,
+        "instructions": [
+            {"copy_block": 0},
+            {"data": base64.b64encode(b"ing   updated-fake-value").decode()}
+        ],
+        "update_command": "echo updated"
+    }
+    response = client.patch(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH},
+        json=delta
+    )
+    assert response.status_code == 204
+    new_hash = hashlib.sha256(MOCK_CONF_NEW_CONTENT.encode()).hexdigest()
+    assert response.headers["X-File-Hash"] == new_hash
+    assert Path(MOCK_CONF_FILEPATH).read_text(encoding="utf-8") == \
+        MOCK_CONF_NEW_CONTENT
+
+    # File changed since the signature
+    response = client.patch(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH},
+        json=delta
+    )
+    assert response.status_code == 412
+    assert response.json() == {"detail": "File does not match the base hash"}
+
+    # Invalid delta
+    delta["base_hash"] = new_hash
+    delta["instructions"] = [{"copy_block": 10}]
+    response = client.patch(
+        "/config/buckets/file",
+        params={"file_path": MOCK_CONF_FILEPATH},
+        json=delta
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Copied blocks are out of the file"}
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_update_command_job() -> None:
+    """Test for running update commands in the background"""
+    make_mock_config_dir()
+
+    with TestClient(app) as background_client:
+        response: Response = background_client.post(
+            "/config/buckets/",
+            params={"background": True},
+            json={
+                "directory_path": MOCK_CONF_DIRPATH,
+                "update_command": "echo updated"
+            })
+        assert response.status_code == 202
+        job_id = response.json()["id"]
+
+        for _ in range(50):
+            response = background_client.get(
+                f"/config/buckets/jobs/{job_id}"
+            )
+            if response.json()["status"] != "running":
+                break
+            time.sleep(0.1)
+        assert response.status_code == 200
+        assert response.json()["status"] == "succeeded"
+        assert response.json()["exit_code"] == 0
+        assert response.json()["stdout"] == "updated\n"
+
+        # Job not found
+        response = background_client.get("/config/buckets/jobs/invalid")
+        assert response.status_code == 404
+        assert response.json() == {"detail": "Job does not exist"}
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
 def test_delete_file() -> None:
     """Test for deleting config file"""
     make_mock_config_dir()
@@ -186,32 +781,3 @@ def test_delete_file() -> None:
     }
 
     rmtree(MOCK_CONF_DIRPATH)
-
-
-def test_get_tar_archive() -> None:
-    """Test for getting tar archive backup and verifying its contents"""
-    make_mock_config_dir()
-
-    response: Response = client.post(
-        "/config/buckets/backup",
-        json={"directory_path": MOCK_CONF_DIRPATH}
-    )
-    assert response.status_code == 200
-
-    with open("tests/fakes/mock_conf.tar.gz", "wb") as bin_file:
-        bin_file.write(response.content)
-    backup_path = Path("tests/fakes/backup_conf")
-    backup_path.mkdir(exist_ok=True)
-    with tarfile.open("tests/fakes/mock_conf.tar.gz", "r|gz") as tar_file:
-        tar_file.extractall(path=backup_path)
-    _, mismatch, error = filecmp.cmpfiles(
-        backup_path,
-        MOCK_CONF_DIRPATH,
-        ["mock.conf", "leave_this.conf"]
-    )
-    assert mismatch == []
-    assert error == []
-
-    os.remove("tests/fakes/mock_conf.tar.gz")
-    rmtree(backup_path)
-    rmtree(MOCK_CONF_DIRPATH)
@@ -5,7 +5,6 @@ Tests for routes at deployments endpoint
 import json
 from shutil import rmtree
 from typing import Any, Dict
-from unittest.mock import patch
 
 from fastapi.testclient import TestClient
 from requests.models import Response
@@ -26,7 +25,8 @@ client = TestClient(app)
 
 def settings_override() -> Settings:
     """Override settings with fake data file directory"""
-    return Settings(deployments_dir="tests/fakes/.serverctl")
+    return Settings(deployments_dir="tests/fakes/.serverctl",
+                    compose_command="echo docker-compose")
 
 
 app.dependency_overrides[get_settings] = settings_override
@@ -54,9 +54,10 @@ def test_create_deployment() -> None:
         env_content = env_file.read()
         assert env_content == MOCK_ENV_FILE
 
-    with open(MOCK_DB_JSON_PATH, "r", encoding="utf-8") as json_file:
-        env_content = json.load(json_file)
-        assert env_content == request_json["databases"]
+    # Database configs are kept in the deployment store
+    assert not MOCK_DB_JSON_PATH.exists()
+    response = client.get("/deployments/test-deployment")
+    assert response.json() == request_json["databases"]
 
     # Deployment name already exists
     response = client.post("/deployments/", json=request_json)
@@ -77,7 +78,17 @@ def test_get_deployments() -> None:
     # Successful request
     response: Response = client.get("/deployments/")
     assert response.status_code == 200
-    assert set(response.json()) == mock_deployment_list
+    assert response.json() == sorted(mock_deployment_list)
+
+    # Deployments matching a prefix, a page at a time
+    response = client.get("/deployments/",
+                          params={"prefix": "sample", "offset": "1",
+                                  "limit": "1"})
+    assert response.status_code == 200
+    assert response.json() == ["sample2"]
+
+    response = client.get("/deployments/", params={"limit": "0"})
+    assert response.status_code == 422
 
     rmtree(MOCK_DEPLOYMENTS_PATH)
 
@@ -125,9 +136,8 @@ def test_update_deployment() -> None:
     assert compose_file_content == request_json["compose_file"]
     env_file_content = MOCK_ENV_PATH.read_text(encoding="utf-8")
     assert env_file_content == request_json["env_file"]
-    with open(MOCK_DB_JSON_PATH, "r", encoding="utf-8") as json_file:
-        json_data = json.load(json_file)
-        assert json_data == UPDATED_DB_CONFIG_CONTENT
+    response = client.get("/deployments/test-deployment")
+    assert response.json() == UPDATED_DB_CONFIG_CONTENT
 
     # Deployment not found
     response = client.patch(
@@ -162,29 +172,37 @@ def test_delete_deployment() -> None:
 
 
 def test_compose_up() -> None:
-    """Test for docker-compose down"""
+    """Test for docker-compose up"""
     make_fake_deployment()
 
-    # Successful request
-    with patch("serverctl_deployd.routers.deployments.subprocess.Popen"):
-        response: Response = client.post("/deployments/test-deployment/up")
+    with TestClient(app) as job_client:
+        # Successful request
+        response: Response = job_client.post(
+            "/deployments/test-deployment/up"
+        )
         assert response.status_code == 200
-        assert response.json() == {"message": "docker-compose up executed"}
+        assert response.json()["message"] == "docker-compose up executed"
+        job_id = response.json()["job_id"]
 
-    # Deployment not found
-    with patch("serverctl_deployd.routers.deployments.subprocess.Popen"):
-        response = client.post("/deployments/non-existent-deployment/up")
+        response = job_client.get(f"/deployments/jobs/{job_id}",
+                                  params={"wait": "5"})
+        assert response.status_code == 200
+        assert response.json()["status"] == "succeeded"
+        assert response.json()["stdout"] == (
+            f"docker-compose -f {TEST_DEPLOYMENT_PATH}/docker-compose.yml"
+            " up -d\n"
+        )
+        assert response.json()["duration"] >= 0
+
+        # Deployment not found
+        response = job_client.post("/deployments/non-existent-deployment/up")
         assert response.status_code == 404
         assert response.json() == {"detail": "Deployment does not exist"}
 
-    # OSError
-    with patch(
-        "serverctl_deployd.routers.deployments.subprocess.Popen",
-        side_effect=OSError()
-    ):
-        response = client.post("/deployments/test-deployment/up")
-        assert response.status_code == 500
-        assert response.json() == {"detail": "Internal server error"}
+        # Job not found
+        response = job_client.get("/deployments/jobs/invalid")
+        assert response.status_code == 404
+        assert response.json() == {"detail": "Job does not exist"}
 
     rmtree(MOCK_DEPLOYMENTS_PATH)
 
@@ -193,25 +211,157 @@ def test_compose_down() -> None:
     """Test for docker-compose down"""
     make_fake_deployment()
 
-    # Successful request
-    with patch("serverctl_deployd.routers.deployments.subprocess.Popen"):
-        response: Response = client.post("/deployments/test-deployment/down")
+    with TestClient(app) as job_client:
+        # Successful request
+        response: Response = job_client.post(
+            "/deployments/test-deployment/down"
+        )
         assert response.status_code == 200
-        assert response.json() == {"message": "docker-compose down executed"}
+        assert response.json()["message"] == "docker-compose down executed"
+        job_id = response.json()["job_id"]
 
-    # Deployment not found
-    with patch("serverctl_deployd.routers.deployments.subprocess.Popen"):
-        response = client.post("/deployments/non-existent-deployment/down")
+        response = job_client.get(f"/deployments/jobs/{job_id}",
+                                  params={"wait": "5"})
+        assert response.status_code == 200
+        assert response.json()["status"] == "succeeded"
+        assert response.json()["stdout"].endswith(" down\n")
+
+        response = job_client.get("/deployments/jobs/stats")
+        assert response.status_code == 200
+        assert response.json()["succeeded"] >= 1
+
+        # Deployment not found
+        response = job_client.post(
+            "/deployments/non-existent-deployment/down"
+        )
         assert response.status_code == 404
         assert response.json() == {"detail": "Deployment does not exist"}
 
-    # OSError
-    with patch(
-        "serverctl_deployd.routers.deployments.subprocess.Popen",
-        side_effect=OSError()
-    ):
-        response = client.post("/deployments/test-deployment/down")
-        assert response.status_code == 500
-        assert response.json() == {"detail": "Internal server error"}
+    rmtree(MOCK_DEPLOYMENTS_PATH)
+
+
+def test_compose_events() -> None:
+    """Test for streaming the output of docker-compose jobs"""
+    make_fake_deployment()
+    app.dependency_overrides[get_settings] = lambda: Settings(
+        deployments_dir=MOCK_DEPLOYMENTS_PATH,
+        compose_command="sleep 0.2; echo pulling >&2; echo docker-compose"
+    )
+
+    try:
+        with TestClient(app) as job_client:
+            response: Response = job_client.post(
+                "/deployments/test-deployment/up"
+            )
+            job_id = response.json()["job_id"]
+
+            response = job_client.get(f"/deployments/jobs/{job_id}/events")
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith(
+                "text/event-stream"
+            )
+            events = response.text.split("\n\n")
+            assert events[0] == "event: stderr\ndata: pulling"
+            assert events[1].startswith(
+                "event: stdout\ndata: docker-compose -f "
+            )
+            assert events[2].startswith("event: end\ndata: {")
+            assert json.loads(events[2].split("data: ", 1)[1])["status"] \
+                == "succeeded"
+
+            # Job not found
+            response = job_client.get("/deployments/jobs/invalid/events")
+            assert response.status_code == 404
+    finally:
+        app.dependency_overrides[get_settings] = settings_override
+        rmtree(MOCK_DEPLOYMENTS_PATH)
+
+
+def test_bulk_operation() -> None:
+    """Test for running docker-compose on several deployments"""
+    for name in ("db", "web-1", "web-2", "other"):
+        MOCK_DEPLOYMENTS_PATH.joinpath(name).mkdir(parents=True)
+
+    with TestClient(app) as job_client:
+        # Successful request
+        response: Response = job_client.post(
+            "/deployments/bulk",
+            params={"wait": "5"},
+            json={
+                "action": "down",
+                "names": ["db"],
+                "selector": "web-*",
+                "dependencies": {"web-1": ["db"], "web-2": ["db"]}
+            }
+        )
+        assert response.status_code == 200
+        assert response.json()["done"]
+        results = response.json()["results"]
+        assert [result["name"] for result in results] == [
+            "db", "web-1", "web-2"
+        ]
+        assert all(result["status"] == "succeeded" for result in results)
+
+        # Dependencies are brought down last
+        jobs = [
+            job_client.get(f"/deployments/jobs/{result['job_id']}").json()
+            for result in results
+        ]
+        assert jobs[0]["stdout"].endswith(" down\n")
+        assert jobs[0]["started_at"] >= max(
+            jobs[1]["finished_at"], jobs[2]["finished_at"]
+        )
+
+        response = job_client.get(
+            f"/deployments/bulk/{response.json()['id']}"
+        )
+        assert response.status_code == 200
+        assert response.json()["action"] == "down"
+
+        # Restart runs down then up
+        response = job_client.post(
+            "/deployments/bulk",
+            params={"wait": "5"},
+            json={"action": "restart", "names": ["other"]}
+        )
+        job = job_client.get(
+            f"/deployments/jobs/{response.json()['results'][0]['job_id']}"
+        ).json()
+        assert " down\ndocker-compose " in job["stdout"]
+        assert job["stdout"].endswith(" up -d\n")
+
+        # Dependency cycle
+        response = job_client.post(
+            "/deployments/bulk",
+            json={
+                "action": "up",
+                "names": ["db", "web-1"],
+                "dependencies": {"web-1": ["db"], "db": ["web-1"]}
+            }
+        )
+        assert response.status_code == 400
+
+        # No deployments given
+        response = job_client.post("/deployments/bulk",
+                                   json={"action": "up"})
+        assert response.status_code == 400
+        assert response.json() == {
+            "detail": "Either names or a selector is required"
+        }
+
+        # Deployment not found
+        response = job_client.post(
+            "/deployments/bulk",
+            json={"action": "up", "names": ["non-existent-deployment"]}
+        )
+        assert response.status_code == 404
+        assert response.json() == {"detail": "Deployment does not exist"}
+
+        # Bulk operation not found
+        response = job_client.get("/deployments/bulk/invalid")
+        assert response.status_code == 404
+        assert response.json() == {
+            "detail": "Bulk operation does not exist"
+        }
 
     rmtree(MOCK_DEPLOYMENTS_PATH)
@@ -0,0 +1,119 @@
+"""
+Tests for the snapshot routes of config buckets
+"""
+
+import os
+from pathlib import Path
+from shutil import rmtree
+
+from fastapi.testclient import TestClient
+from requests.models import Response
+
+from serverctl_deployd.config import Settings
+from serverctl_deployd.dependencies import get_settings
+from serverctl_deployd.main import app
+from tests.fakes.fake_config_directory import (MOCK_CONF_DIRPATH,
+                                               MOCK_CONF_FILEPATH,
+                                               MOCK_CONF_NEW_CONTENT,
+                                               MOCK_FILE_HASH,
+                                               make_mock_config_dir)
+
+client = TestClient(app)
+
+
+def test_snapshots() -> None:
+    """Test for creating, diffing and restoring bucket snapshots"""
+    make_mock_config_dir()
+    snapshots_dir = Path("tests/fakes/snapshots")
+    previous_override = app.dependency_overrides.get(get_settings)
+    app.dependency_overrides[get_settings] = lambda: Settings(
+        snapshots_dir=snapshots_dir
+    )
+    request_json = {"directory_path": MOCK_CONF_DIRPATH}
+
+    try:
+        response: Response = client.post("/config/buckets/snapshots",
+                                          json=request_json)
+        assert response.status_code == 200
+        first_id = response.json()["id"]
+        assert response.json()["file_count"] == 2
+
+        # Unchanged files are stored once
+        response = client.post("/config/buckets/snapshots",
+                               json=request_json)
+        second_id = response.json()["id"]
+        assert len(list(snapshots_dir.glob("blobs/*/*"))) == 1
+
+        response = client.get("/config/buckets/snapshots")
+        assert [snapshot["id"] for snapshot in response.json()] == [
+            first_id, second_id
+        ]
+        response = client.get(f"/config/buckets/snapshots/{first_id}")
+        assert response.json()["files"] == {
+            "mock.conf": MOCK_FILE_HASH,
+            "leave_this.conf": MOCK_FILE_HASH
+        }
+
+        # Diff against the current bucket
+        Path(MOCK_CONF_FILEPATH).write_text(MOCK_CONF_NEW_CONTENT,
+                                            encoding="utf-8")
+        Path(MOCK_CONF_DIRPATH + "added.conf").write_text(
+            MOCK_CONF_NEW_CONTENT, encoding="utf-8"
+        )
+        os.remove(MOCK_CONF_DIRPATH + "leave_this.conf")
+        response = client.get(f"/config/buckets/snapshots/{first_id}/diff")
+        assert response.json() == {
+            "added": ["added.conf"],
+            "removed": ["leave_this.conf"],
+            "changed": ["mock.conf"]
+        }
+        response = client.get(f"/config/buckets/snapshots/{first_id}/diff",
+                              params={"against": second_id})
+        assert response.json() == {"added": [], "removed": [], "changed": []}
+
+        # Unsuccessful command rolls back the restore
+        response = client.post(
+            f"/config/buckets/snapshots/{first_id}/restore",
+            json={"update_command": "invalid command", "prune": True}
+        )
+        assert response.status_code == 500
+        assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == [
+            "added.conf", "mock.conf"
+        ]
+
+        response = client.post(
+            f"/config/buckets/snapshots/{first_id}/restore",
+            json={"update_command": "echo restored", "prune": True}
+        )
+        assert response.status_code == 200
+        assert response.json() == {
+            "mock.conf": MOCK_FILE_HASH,
+            "leave_this.conf": MOCK_FILE_HASH
+        }
+
+        # A removed bucket is created again
+        rmtree(MOCK_CONF_DIRPATH)
+        response = client.post(
+            f"/config/buckets/snapshots/{first_id}/restore",
+            json={"update_command": "echo restored"}
+        )
+        assert response.status_code == 200
+        assert response.json() == {
+            "mock.conf": MOCK_FILE_HASH,
+            "leave_this.conf": MOCK_FILE_HASH
+        }
+        assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == [
+            "leave_this.conf", "mock.conf"
+        ]
+
+        # Snapshot not found
+        response = client.get("/config/buckets/snapshots/invalid")
+        assert response.status_code == 404
+        assert response.json() == {"detail": "Snapshot does not exist"}
+    finally:
+        if previous_override is None:
+            del app.dependency_overrides[get_settings]
+        else:
+            app.dependency_overrides[get_settings] = previous_override
+        rmtree(snapshots_dir, ignore_errors=True)
+        rmtree(MOCK_CONF_DIRPATH)
@@ -0,0 +1,25 @@
+"""
+Tests for the streaming backup archives
+"""
+
+import gzip
+import os
+
+from serverctl_deployd.archive import parallel_gzip_stream
+
+
+def test_parallel_gzip_stream() -> None:
+    """Test that blocks are compressed into ordered gzip members"""
+    data = os.urandom(1000) * 50
+    chunks = [data[offset:offset + 300]
+              for offset in range(0, len(data), 300)]
+
+    members = list(parallel_gzip_stream(chunks, level=1, block_size=4096))
+    assert len(members) == -(-len(data) // 4096)
+    assert all(gzip.decompress(member) for member in members)
+    assert gzip.decompress(b"".join(members)) == data
+
+    # An empty stream is still a valid gzip stream
+    empty_stream = b"".join(parallel_gzip_stream([]))
+    assert empty_stream
+    assert gzip.decompress(empty_stream) == b""
@@ -0,0 +1,69 @@
+"""
+Tests for the scheduling of operations over many deployments
+"""
+
+import pytest
+
+from serverctl_deployd.bulk import (BulkScheduler, DependencyCycle,
+                                    prerequisites)
+from serverctl_deployd.jobs import JobRunner
+from serverctl_deployd.models.deployments import ComposeAction
+from serverctl_deployd.models.jobs import JobStatus
+
+
+def test_prerequisites() -> None:
+    """Test the ordering of deployments by their dependencies"""
+    names = ["db", "web", "worker"]
+    dependencies = {"web": ["db", "cache"], "worker": ["db", "web"]}
+    assert prerequisites(names, dependencies) == {
+        "db": set(), "web": {"db"}, "worker": {"db", "web"}
+    }
+    assert prerequisites(names, dependencies, reverse=True) == {
+        "db": {"web", "worker"}, "web": {"worker"}, "worker": set()
+    }
+
+    with pytest.raises(DependencyCycle):
+        prerequisites(names, {"db": ["worker"], **dependencies})
+    with pytest.raises(DependencyCycle):
+        prerequisites(names, {"db": ["db"]})
+
+
+@pytest.mark.asyncio
+async def test_bulk_run() -> None:
+    """Test that deployments run after their dependencies succeeded"""
+    runner = JobRunner(max_concurrency=4, timeout=5, max_jobs=10,
+                       max_output=1024)
+    scheduler = BulkScheduler(runner, max_runs=10)
+    names = ["db", "web", "worker", "broken", "frontend"]
+    commands = {
+        "db": "sleep 0.1", "web": "true", "worker": "true",
+        "broken": "exit 1", "frontend": "true"
+    }
+    run = scheduler.submit(
+        ComposeAction.UP, commands, {name: name for name in names},
+        prerequisites(names, {
+            "web": ["db"], "worker": ["db"], "frontend": ["web", "broken"]
+        })
+    )
+    assert scheduler.get(run.id) is run
+
+    result = run.to_model()
+    assert not result.done
+    assert result.results[1].status is None
+
+    await run.wait(5)
+    result = run.to_model()
+    assert result.done
+    assert [item.status for item in result.results] == [
+        JobStatus.SUCCEEDED, JobStatus.SUCCEEDED, JobStatus.SUCCEEDED,
+        JobStatus.FAILED, None
+    ]
+    assert result.results[3].exit_code == 1
+    assert result.results[4].skipped
+    assert result.results[4].job_id is None
+
+    db_job = runner.get(str(result.results[0].job_id))
+    web_job = runner.get(str(result.results[1].job_id))
+    assert db_job is not None and web_job is not None
+    assert db_job.finished_at is not None and web_job.started_at is not None
+    assert web_job.started_at >= db_job.finished_at
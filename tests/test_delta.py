@@ -0,0 +1,121 @@
+"""
+Tests for the block signatures and deltas of config files
+"""
+
+import base64
+import hashlib
+import os
+import zlib
+from shutil import rmtree
+from typing import Dict, List
+
+import pytest
+
+from serverctl_deployd.delta import (InvalidDelta, apply_delta,
+                                     default_block_size, file_signature)
+from serverctl_deployd.models.config import (DeltaInstruction, FileDelta,
+                                             FileSignature)
+from serverctl_deployd.staging import cleanup, commit
+from tests.fakes.fake_config_directory import (MOCK_CONF_DIRPATH,
+                                               MOCK_CONF_FILEPATH,
+                                               make_mock_config_dir)
+
+
+def _copy(block: int, block_count: int = 1) -> DeltaInstruction:
+    """Build an instruction copying blocks"""
+    return DeltaInstruction(copy_block=block, block_count=block_count,
+                            data=None)
+
+
+def _insert(data: bytes) -> DeltaInstruction:
+    """Build an instruction inserting data"""
+    return DeltaInstruction(copy_block=None, block_count=1,
+                            data=base64.b64encode(data).decode())
+
+
+def compute_delta(signature: FileSignature,
+                  new_content: bytes) -> List[DeltaInstruction]:
+    """Compute a delta like a client would, matching blocks anywhere"""
+    block_size = signature.block_size
+    blocks: Dict[int, List[int]] = {}
+    for index, block in enumerate(signature.blocks):
+        blocks.setdefault(block.weak, []).append(index)
+    instructions: List[DeltaInstruction] = []
+    literal = bytearray()
+    offset = 0
+    while offset < len(new_content):
+        window = new_content[offset:offset + block_size]
+        strong = hashlib.sha256(window).hexdigest()
+        match = next((
+            index for index in blocks.get(zlib.adler32(window), [])
+            if signature.blocks[index].strong == strong
+        ), None)
+        if match is None:
+            literal.append(new_content[offset])
+            offset += 1
+            continue
+        if literal:
+            instructions.append(_insert(bytes(literal)))
+            literal.clear()
+        instructions.append(_copy(match))
+        offset += len(window)
+    if literal:
+        instructions.append(_insert(bytes(literal)))
+    return instructions
+
+
+def test_default_block_size() -> None:
+    """Test that block sizes grow with the file and stay bounded"""
+    assert default_block_size(0) == 2048
+    assert default_block_size(300 * 1024 * 1024) == 17 * 1024
+    assert default_block_size(1 << 40) == 128 * 1024
+
+
+def test_apply_delta() -> None:
+    """Test that a file is rebuilt from a small delta"""
+    make_mock_config_dir()
+    content = os.urandom(20 * 2048 + 100)
+    with open(MOCK_CONF_FILEPATH, "wb") as conf_file:
+        conf_file.write(content)
+    new_content = content[:5000] + b"inserted line\n" + content[7000:]
+
+    signature = file_signature(MOCK_CONF_FILEPATH, 2048)
+    assert signature.file_hash == hashlib.sha256(content).hexdigest()
+    assert len(signature.blocks) == 21
+
+    instructions = compute_delta(signature, new_content)
+    inserted = sum(
+        len(base64.b64decode(instruction.data))
+        for instruction in instructions if instruction.data is not None
+    )
+    assert inserted < 3 * 2048
+
+    delta = FileDelta(
+        base_hash=signature.file_hash,
+        block_size=2048,
+        instructions=instructions,
+        result_hash=hashlib.sha256(new_content).hexdigest(),
+        update_command="true"
+    )
+    staged_files = [apply_delta(MOCK_CONF_FILEPATH, delta)]
+    commit(staged_files)
+    cleanup(staged_files)
+    with open(MOCK_CONF_FILEPATH, "rb") as conf_file:
+        assert conf_file.read() == new_content
+
+    # Blocks out of the file
+    delta.instructions = [_copy(20, block_count=2)]
+    delta.result_hash = None
+    with pytest.raises(InvalidDelta):
+        apply_delta(MOCK_CONF_FILEPATH, delta)
+
+    # Rebuilt file does not match the result hash
+    delta.instructions = [_insert(b"\0\0\0")]
+    delta.result_hash = signature.file_hash
+    with pytest.raises(InvalidDelta):
+        apply_delta(MOCK_CONF_FILEPATH, delta)
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == [
+        "leave_this.conf", "mock.conf"
+    ]
+
+    rmtree(MOCK_CONF_DIRPATH)
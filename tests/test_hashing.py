@@ -0,0 +1,134 @@
+"""
+Tests for the file hashing helpers
+"""
+
+import hashlib
+import os
+from shutil import rmtree
+from unittest.mock import patch
+
+from serverctl_deployd.config import Settings
+from serverctl_deployd.hashing import (HashCache, hash_cache, hash_entries,
+                                       hash_file, merkle_tree, node_digest)
+from tests.fakes.fake_config_directory import (MOCK_CONF_DIRPATH,
+                                               MOCK_CONF_FILE_CONTENT,
+                                               MOCK_CONF_FILEPATH,
+                                               MOCK_CONF_NEW_CONTENT,
+                                               MOCK_FILE_HASH,
+                                               make_mock_config_dir)
+
+
+def test_hash_cache_eviction() -> None:
+    """Test LRU eviction and hit/miss counters of the hash cache"""
+    cache = HashCache(2)
+    cache.put(("sha256", 1, 1, 1, 1), "a")
+    cache.put(("sha256", 1, 2, 1, 1), "b")
+    assert cache.get(("sha256", 1, 1, 1, 1)) == "a"
+    cache.put(("sha256", 1, 3, 1, 1), "c")
+
+    # ("sha256", 1, 2, 1, 1) was the least recently used entry
+    assert cache.get(("sha256", 1, 2, 1, 1)) is None
+    assert cache.get(("sha256", 1, 3, 1, 1)) == "c"
+    stats = cache.stats()
+    assert stats.hits == 2
+    assert stats.misses == 1
+    assert stats.entries == 2
+    assert stats.max_entries == 2
+
+
+def test_hash_file() -> None:
+    """Test that unchanged files are served from the hash cache"""
+    make_mock_config_dir()
+    hash_cache.clear()
+
+    assert hash_file(MOCK_CONF_FILEPATH) == MOCK_FILE_HASH
+    assert hash_file(MOCK_CONF_FILEPATH) == MOCK_FILE_HASH
+    assert hash_cache.stats().hits == 1
+
+    # Digests of other algorithms are cached separately
+    assert hash_file(MOCK_CONF_FILEPATH, "blake2b") == hashlib.blake2b(
+        MOCK_CONF_FILE_CONTENT.encode()
+    ).hexdigest()
+    assert hash_cache.stats().hits == 1
+    assert hash_file(MOCK_CONF_FILEPATH) == MOCK_FILE_HASH
+
+    # A modified file must be hashed again
+    with open(MOCK_CONF_FILEPATH, 'w', encoding='utf8') as conf_file:
+        conf_file.write(MOCK_CONF_NEW_CONTENT)
+    file_stat = os.stat(MOCK_CONF_FILEPATH)
+    os.utime(MOCK_CONF_FILEPATH,
+             ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1))
+    assert hash_file(MOCK_CONF_FILEPATH) != MOCK_FILE_HASH
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_hash_entries() -> None:
+    """Test that parallel hashing matches hashing files one by one"""
+    make_mock_config_dir()
+    hash_cache.clear()
+    for index in range(16):
+        with open(
+            f"{MOCK_CONF_DIRPATH}parallel{index}.conf",
+            'w', encoding='utf8'
+        ) as conf_file:
+            conf_file.write(MOCK_CONF_NEW_CONTENT * (index + 1))
+
+    with os.scandir(MOCK_CONF_DIRPATH) as listing:
+        entries = {entry.name: entry for entry in listing}
+    file_hashes = hash_entries(entries)
+    assert list(file_hashes) == list(entries)
+    assert file_hashes["mock.conf"] == MOCK_FILE_HASH
+    hash_cache.clear()
+    for name, entry in entries.items():
+        assert file_hashes[name] == hash_file(entry.path)
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_hash_file_mmap() -> None:
+    """Test that files hashed from a memory mapping match read files"""
+    make_mock_config_dir()
+    content = os.urandom(300 * 1024)
+    with open(MOCK_CONF_FILEPATH, 'wb') as conf_file:
+        conf_file.write(content)
+    empty_file_path = MOCK_CONF_DIRPATH + "empty.conf"
+    open(empty_file_path, 'wb').close()  # pylint: disable=consider-using-with
+
+    for mmap_threshold in (0, 1):
+        hash_cache.clear()
+        with patch("serverctl_deployd.hashing.get_settings",
+                   return_value=Settings(hash_mmap_threshold=mmap_threshold)):
+            assert hash_file(MOCK_CONF_FILEPATH) == \
+                hashlib.sha256(content).hexdigest()
+            assert hash_file(empty_file_path) == \
+                hashlib.sha256(b"").hexdigest()
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_merkle_tree() -> None:
+    """Test that directory digests are built from their children"""
+    tree = merkle_tree({
+        "nginx.conf": "a",
+        "sites-enabled/default": "b",
+        "sites-enabled/conf.d/ssl.conf": "c"
+    })
+    assert tree["sites-enabled/conf.d"] == {"ssl.conf": "c"}
+    assert tree["sites-enabled"] == {
+        "default": "b",
+        "conf.d/": node_digest({"ssl.conf": "c"})
+    }
+    assert tree[""] == {
+        "nginx.conf": "a",
+        "sites-enabled/": node_digest(tree["sites-enabled"])
+    }
+
+    # A change deep in the tree changes the root digest
+    changed_tree = merkle_tree({
+        "nginx.conf": "a",
+        "sites-enabled/default": "b",
+        "sites-enabled/conf.d/ssl.conf": "d"
+    })
+    assert node_digest(changed_tree[""]) != node_digest(tree[""])
+    assert changed_tree[""]["nginx.conf"] == tree[""]["nginx.conf"]
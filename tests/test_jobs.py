@@ -0,0 +1,144 @@
+"""
+Tests for the command job runner
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from serverctl_deployd.jobs import JobRunner, OutputLine, ReloadCoalescer
+from serverctl_deployd.models.jobs import JobStatus
+
+
+@pytest.mark.asyncio
+async def test_job_runner() -> None:
+    """Test exit codes and captured output of jobs"""
+    runner = JobRunner(max_concurrency=2, timeout=5, max_jobs=10,
+                       max_output=1024)
+
+    job = await runner.run("echo updated; echo warning >&2")
+    assert job.status == JobStatus.SUCCEEDED
+    assert job.exit_code == 0
+    assert job.stdout == "updated\n"
+    assert job.stderr == "warning\n"
+    assert runner.get(job.id) is job
+
+    job = await runner.run("exit 3")
+    assert job.status == JobStatus.FAILED
+    assert job.exit_code == 3
+
+
+@pytest.mark.asyncio
+async def test_job_runner_timeout() -> None:
+    """Test that commands running past the timeout are killed"""
+    runner = JobRunner(max_concurrency=2, timeout=0.2, max_jobs=10,
+                       max_output=1024)
+    start = time.monotonic()
+    job = await runner.run("sleep 5")
+    assert job.status == JobStatus.TIMED_OUT
+    assert time.monotonic() - start < 2
+
+
+@pytest.mark.asyncio
+async def test_job_runner_concurrency() -> None:
+    """Test that at most max_concurrency commands run at once"""
+    runner = JobRunner(max_concurrency=1, timeout=5, max_jobs=1,
+                       max_output=1024)
+    first = runner.submit("sleep 0.2")
+    second = runner.submit("sleep 0.2")
+    await asyncio.sleep(0.1)
+    assert first.status == JobStatus.RUNNING
+    assert second.status == JobStatus.PENDING
+    await second.wait()
+    assert first.finished_at is not None and second.started_at is not None
+    assert second.started_at >= first.finished_at
+
+    # Only the most recent finished job is kept
+    assert runner.get(first.id) is None
+    assert runner.get(second.id) is second
+
+
+@pytest.mark.asyncio
+async def test_reload_coalescer() -> None:
+    """Test that updates within the debounce window share one run"""
+    runner = JobRunner(max_concurrency=2, timeout=5, max_jobs=10,
+                       max_output=1024)
+    coalescer = ReloadCoalescer(runner, debounce=0.1)
+    command = "echo reloaded"
+
+    jobs = [coalescer.submit(command, "tests/fakes") for _ in range(5)]
+    other_directory_job = coalescer.submit(command, "tests")
+    assert all(job is jobs[0] for job in jobs)
+    assert other_directory_job is not jobs[0]
+
+    await jobs[0].wait()
+    assert jobs[0].status == JobStatus.SUCCEEDED
+    assert jobs[0].stdout == "reloaded\n"
+
+    # Updates after the command started get a new run
+    job = await coalescer.run(command, "tests/fakes")
+    assert job is not jobs[0]
+    assert job.status == JobStatus.SUCCEEDED
+
+
+@pytest.mark.asyncio
+async def test_job_runner_keys() -> None:
+    """Test that jobs with the same key run one at a time, in order"""
+    runner = JobRunner(max_concurrency=3, timeout=5, max_jobs=10,
+                       max_output=1024)
+    first = runner.submit("sleep 0.2", key="deployment")
+    second = runner.submit("sleep 0.2", key="deployment")
+    other = runner.submit("sleep 0.2", key="other-deployment")
+    await asyncio.sleep(0.1)
+    assert first.status == JobStatus.RUNNING
+    assert second.status == JobStatus.PENDING
+    assert other.status == JobStatus.RUNNING
+    stats = runner.stats()
+    assert (stats.running, stats.pending) == (2, 1)
+
+    await second.wait()
+    assert first.finished_at is not None and second.started_at is not None
+    assert second.started_at >= first.finished_at
+    assert second.duration is not None and second.duration >= 0.2
+
+    stats = runner.stats()
+    assert stats.succeeded == 3
+    assert stats.max_duration is not None and stats.max_duration >= 0.2
+
+
+@pytest.mark.asyncio
+async def test_job_output_subscription() -> None:
+    """Test that output lines are streamed to subscribers in order"""
+    runner = JobRunner(max_concurrency=2, timeout=5, max_jobs=10,
+                       max_output=1024)
+    job = runner.submit("echo first; sleep 0.1; echo second >&2; printf last")
+    subscription = job.subscribe()
+    lines = [line async for line in subscription.lines(keepalive=0.05)]
+    assert [line for line in lines if line is not None] == [
+        OutputLine("stdout", "first"),
+        OutputLine("stderr", "second"),
+        OutputLine("stdout", "last")
+    ]
+    # Keepalives were sent while the command was silent
+    assert None in lines
+    assert job.stdout == "first\nlast"
+
+    # Subscriptions to finished jobs end right away
+    assert [line async for line in job.subscribe().lines(1)] == []
+
+
+@pytest.mark.asyncio
+async def test_job_output_subscription_overflow() -> None:
+    """Test that slow subscribers skip the oldest lines"""
+    runner = JobRunner(max_concurrency=2, timeout=5, max_jobs=10,
+                       max_output=1024)
+    job = runner.submit("seq 10")
+    subscription = job.subscribe(max_lines=3)
+    await job.wait()
+    assert [line async for line in subscription.lines(1)] == [
+        OutputLine("dropped", "7"),
+        OutputLine("stdout", "8"),
+        OutputLine("stdout", "9"),
+        OutputLine("stdout", "10")
+    ]
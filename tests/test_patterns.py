@@ -0,0 +1,37 @@
+"""
+Tests for the compiled ignore pattern matcher
+"""
+
+from fnmatch import fnmatch
+
+from serverctl_deployd.patterns import ignore_matcher
+
+PATTERNS = {
+    "*.swp", "leave*", ".git", "conf.d/*", "*.bak[0-9]", "?tmp", "*"
+}
+NAMES = [
+    "mock.conf", "mock.conf.swp", "leave_this.conf", ".git", "git",
+    "conf.d/ssl.conf", "sites/conf.d/ssl.conf", "nginx.bak1", "nginx.bak",
+    "xtmp", "xxtmp", "sites/.git", ""
+]
+
+
+def test_ignore_matcher() -> None:
+    """Test that compiled patterns match like fnmatch on name or path"""
+    for size in range(len(PATTERNS) + 1):
+        patterns = set(sorted(PATTERNS)[:size])
+        is_ignored = ignore_matcher(patterns)
+        for name in NAMES:
+            expected = any(
+                fnmatch(name.rpartition("/")[2], pattern)
+                or fnmatch(name, pattern)
+                for pattern in patterns
+            )
+            assert is_ignored(name) == expected, (patterns, name)
+
+
+def test_ignore_matcher_cache() -> None:
+    """Test that a set of patterns is compiled only once"""
+    assert ignore_matcher({"*.swp", "leave*"}) \
+        is ignore_matcher({"leave*", "*.swp"})
+    assert not ignore_matcher(None)("mock.conf")
@@ -0,0 +1,65 @@
+"""
+Tests for the in-memory index of deployments
+"""
+
+from shutil import rmtree
+
+from serverctl_deployd.registry import DeploymentRegistry
+from serverctl_deployd.store import DeploymentStore
+from tests.fakes.fake_deployments import MOCK_DEPLOYMENTS_PATH
+
+
+def test_deployment_registry() -> None:
+    """Test listing and prefix queries of the deployment names"""
+    store = DeploymentStore(MOCK_DEPLOYMENTS_PATH)
+    for name in ("web-2", "db", "web-1", "web", "webhook"):
+        store.create(name, {})
+    registry = DeploymentRegistry(store)
+    registry.load()
+
+    assert registry.names() == ["db", "web", "web-1", "web-2", "webhook"]
+    assert registry.names("web-") == ["web-1", "web-2"]
+    assert registry.names("web", offset=1, limit=2) == ["web-1", "web-2"]
+    assert registry.names("web", offset=10) == []
+    assert registry.names("x") == []
+    assert registry.exists("db")
+    assert not registry.exists("web-3")
+
+    store.create("web-3", {})
+    registry.add("web-3")
+    store.delete("db")
+    registry.discard("db")
+    assert registry.names() == ["web", "web-1", "web-2", "web-3", "webhook"]
+
+    registry.close()
+    rmtree(MOCK_DEPLOYMENTS_PATH)
+
+
+def test_deployment_registry_changes() -> None:
+    """Test that changes made by others are picked up"""
+    store = DeploymentStore(MOCK_DEPLOYMENTS_PATH)
+    store.create("app", {})
+    registry = DeploymentRegistry(store)
+    assert registry.names() == ["app"]
+
+    # Another process creating and deleting deployments
+    other_store = DeploymentStore(MOCK_DEPLOYMENTS_PATH)
+    other_store.create("other", {})
+    MOCK_DEPLOYMENTS_PATH.joinpath("other").mkdir()
+    assert registry.exists("other")
+    other_store.delete("app")
+    MOCK_DEPLOYMENTS_PATH.joinpath("app").mkdir()
+    MOCK_DEPLOYMENTS_PATH.joinpath("app").rmdir()
+    assert registry.names() == ["other"]
+
+    # Directories which are not deployments are left out
+    MOCK_DEPLOYMENTS_PATH.joinpath("not-a-deployment").mkdir()
+    assert not registry.exists("not-a-deployment")
+
+    # The index is loaded again when the directory is replaced
+    rmtree(MOCK_DEPLOYMENTS_PATH)
+    MOCK_DEPLOYMENTS_PATH.joinpath("imported").mkdir(parents=True)
+    assert registry.names() == ["imported"]
+
+    registry.close()
+    rmtree(MOCK_DEPLOYMENTS_PATH)
@@ -0,0 +1,106 @@
+"""
+Tests for the staged updates of config files
+"""
+
+import errno
+import hashlib
+import os
+from io import BytesIO
+from shutil import rmtree
+from stat import S_IMODE
+from unittest.mock import patch
+
+import pytest
+from fastapi.datastructures import UploadFile
+
+from serverctl_deployd.hashing import hash_cache, hash_file
+from serverctl_deployd.staging import (UPLOAD_CHUNK_SIZE, cleanup, commit,
+                                       rollback, stage_upload)
+from tests.fakes.fake_config_directory import (MOCK_CONF_DIRPATH,
+                                               MOCK_CONF_FILEPATH,
+                                               MOCK_FILE_HASH,
+                                               make_mock_config_dir)
+
+
+@pytest.mark.asyncio
+async def test_stage_upload() -> None:
+    """Test that uploads are streamed, hashed and renamed into place"""
+    make_mock_config_dir()
+    hash_cache.clear()
+    content = os.urandom(3 * UPLOAD_CHUNK_SIZE + 1)
+
+    staged_file = await stage_upload(
+        UploadFile("mock.conf", BytesIO(content)), MOCK_CONF_FILEPATH
+    )
+    assert staged_file.digest == hashlib.sha256(content).hexdigest()
+    # The target is untouched until the staged file is committed
+    assert hash_file(MOCK_CONF_FILEPATH) == MOCK_FILE_HASH
+
+    commit([staged_file])
+    cleanup([staged_file])
+    with open(MOCK_CONF_FILEPATH, "rb") as conf_file:
+        assert conf_file.read() == content
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == [
+        "leave_this.conf", "mock.conf"
+    ]
+
+    # The digest computed while staging was stored in the hash cache
+    hits = hash_cache.hits
+    assert hash_file(MOCK_CONF_FILEPATH) == staged_file.digest
+    assert hash_cache.hits == hits + 1
+
+    # The temporary file is removed when the disk is full
+    with patch("serverctl_deployd.staging.os.fsync",
+               side_effect=OSError(errno.ENOSPC, "No space left on device")):
+        with pytest.raises(OSError):
+            await stage_upload(UploadFile("mock.conf", BytesIO(content)),
+                               MOCK_CONF_FILEPATH)
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == [
+        "leave_this.conf", "mock.conf"
+    ]
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(os.geteuid() != 0, reason="changing owners needs root")
+async def test_stage_upload_ownership() -> None:
+    """Test that replaced files keep their owner, group and mode"""
+    make_mock_config_dir()
+    os.chown(MOCK_CONF_FILEPATH, 65534, 65534)
+    os.chmod(MOCK_CONF_FILEPATH, 0o640)
+
+    staged_file = await stage_upload(
+        UploadFile("mock.conf", BytesIO(b"new")), MOCK_CONF_FILEPATH
+    )
+    commit([staged_file])
+    cleanup([staged_file])
+    conf_stat = os.stat(MOCK_CONF_FILEPATH)
+    assert (conf_stat.st_uid, conf_stat.st_gid) == (65534, 65534)
+    assert S_IMODE(conf_stat.st_mode) == 0o640
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+@pytest.mark.asyncio
+async def test_rollback() -> None:
+    """Test that rolled back files are restored or removed"""
+    make_mock_config_dir()
+    new_file_path = MOCK_CONF_DIRPATH + "new.conf"
+
+    staged_files = [
+        await stage_upload(UploadFile("mock.conf", BytesIO(b"new")),
+                           MOCK_CONF_FILEPATH),
+        await stage_upload(UploadFile("new.conf", BytesIO(b"new")),
+                           new_file_path)
+    ]
+    commit(staged_files)
+    rollback(staged_files)
+    cleanup(staged_files)
+
+    assert hash_file(MOCK_CONF_FILEPATH) == MOCK_FILE_HASH
+    assert sorted(os.listdir(MOCK_CONF_DIRPATH)) == [
+        "leave_this.conf", "mock.conf"
+    ]
+
+    rmtree(MOCK_CONF_DIRPATH)
@@ -0,0 +1,83 @@
+"""
+Tests for the SQLite store of deployments
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from shutil import rmtree
+
+import pytest
+
+from serverctl_deployd.models.deployments import (DBConfig, DBType,
+                                                  UpdateDBConfig)
+from serverctl_deployd.store import DeploymentExists, DeploymentStore
+from tests.fakes.fake_deployments import (MOCK_DB_CONFIG_CONTENT,
+                                          MOCK_DEPLOYMENTS_PATH,
+                                          make_fake_deployment)
+
+
+def test_import_directory() -> None:
+    """Test that deployments of the directory layout are imported once"""
+    make_fake_deployment()
+    MOCK_DEPLOYMENTS_PATH.joinpath("no-databases").mkdir()
+    MOCK_DEPLOYMENTS_PATH.joinpath("invalid").mkdir()
+    MOCK_DEPLOYMENTS_PATH.joinpath("invalid", "databases.json").write_text(
+        "{", encoding="utf-8"
+    )
+
+    store = DeploymentStore(MOCK_DEPLOYMENTS_PATH)
+    assert store.names() == {"test-deployment", "no-databases", "invalid"}
+    databases = store.get_databases("test-deployment")
+    assert databases is not None
+    assert {
+        service: config.dict() for service, config in databases.items()
+    } == MOCK_DB_CONFIG_CONTENT
+    assert store.get_databases("no-databases") == {}
+    assert store.get_databases("non-existent-deployment") is None
+
+    # Directories added later are not imported
+    MOCK_DEPLOYMENTS_PATH.joinpath("added-later").mkdir()
+    assert "added-later" not in DeploymentStore(MOCK_DEPLOYMENTS_PATH).names()
+
+    rmtree(MOCK_DEPLOYMENTS_PATH)
+
+
+def test_deployment_store() -> None:
+    """Test creating, updating and deleting deployments"""
+    store = DeploymentStore(MOCK_DEPLOYMENTS_PATH)
+    store.create("app", {
+        "db": DBConfig(dbtype=DBType.MYSQL, username="root", password="pw")
+    })
+    with pytest.raises(DeploymentExists):
+        store.create("app", {})
+
+    assert store.update("app", {
+        "db": UpdateDBConfig(dbtype=None, username="user", password=""),
+        "unknown": UpdateDBConfig(dbtype=DBType.MONGODB, username="root",
+                                  password="pw")
+    })
+    assert store.get_databases("app") == {
+        "db": DBConfig(dbtype=DBType.MYSQL, username="user", password="pw")
+    }
+    assert not store.update("non-existent-deployment", None)
+
+    assert store.delete("app")
+    assert not store.delete("app")
+    assert not store.exists("app")
+
+    # The database is created again if its file is removed
+    store.create("app", {})
+    rmtree(MOCK_DEPLOYMENTS_PATH)
+    assert store.names() == set()
+
+    rmtree(MOCK_DEPLOYMENTS_PATH)
+
+
+def test_deployment_store_threads() -> None:
+    """Test that concurrent writers from many threads are all applied"""
+    store = DeploymentStore(MOCK_DEPLOYMENTS_PATH)
+    names = [f"deployment-{index}" for index in range(100)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda name: store.create(name, {}), names))
+    assert store.names() == set(names)
+
+    rmtree(MOCK_DEPLOYMENTS_PATH)
@@ -0,0 +1,68 @@
+"""
+Tests for the inotify bucket watcher
+"""
+
+import os
+import time
+from pathlib import Path
+from shutil import rmtree
+
+from serverctl_deployd.hashing import hash_file
+from serverctl_deployd.watcher import BucketWatcher
+from tests.fakes.fake_config_directory import (MOCK_CONF_DIRPATH,
+                                               MOCK_CONF_FILE_CONTENT,
+                                               MOCK_CONF_FILEPATH,
+                                               MOCK_CONF_NEW_CONTENT,
+                                               MOCK_FILE_HASH,
+                                               make_mock_config_dir)
+
+
+def test_bucket_watcher() -> None:
+    """Test that the index follows writes, renames and deletions"""
+    make_mock_config_dir()
+    watcher = BucketWatcher(0.05)
+    watcher.watch(MOCK_CONF_DIRPATH)
+    assert watcher.watched() == [os.path.realpath(MOCK_CONF_DIRPATH)]
+    assert watcher.get_hashes(MOCK_CONF_DIRPATH) == {
+        "mock.conf": MOCK_FILE_HASH,
+        "leave_this.conf": MOCK_FILE_HASH
+    }
+
+    # Editor style save: write a temp file and rename it into place
+    Path(MOCK_CONF_DIRPATH + ".mock.conf.swp").write_text(
+        MOCK_CONF_NEW_CONTENT, encoding="utf8"
+    )
+    os.replace(MOCK_CONF_DIRPATH + ".mock.conf.swp", MOCK_CONF_FILEPATH)
+    os.remove(MOCK_CONF_DIRPATH + "leave_this.conf")
+    # Changes are picked up by the watcher thread after the debounce
+    time.sleep(0.3)
+    assert watcher.get_hashes(MOCK_CONF_DIRPATH) == {
+        "mock.conf": hash_file(MOCK_CONF_FILEPATH)
+    }
+
+    # Changes are applied on request, even within the debounce interval
+    Path(MOCK_CONF_DIRPATH + "new.conf").write_text(
+        MOCK_CONF_FILE_CONTENT, encoding="utf8"
+    )
+    hashes = watcher.get_hashes(MOCK_CONF_DIRPATH)
+    assert hashes is not None
+    assert hashes["new.conf"] == MOCK_FILE_HASH
+
+    assert watcher.unwatch(MOCK_CONF_DIRPATH)
+    assert watcher.get_hashes(MOCK_CONF_DIRPATH) is None
+    assert not watcher.unwatch(MOCK_CONF_DIRPATH)
+    watcher.stop()
+
+    rmtree(MOCK_CONF_DIRPATH)
+
+
+def test_bucket_watcher_directory_removed() -> None:
+    """Test that a removed directory is no longer answered from memory"""
+    make_mock_config_dir()
+    watcher = BucketWatcher(0.05)
+    watcher.watch(MOCK_CONF_DIRPATH)
+
+    rmtree(MOCK_CONF_DIRPATH)
+    assert watcher.get_hashes(MOCK_CONF_DIRPATH) is None
+    assert watcher.watched() == []
+    watcher.stop()